@@ -0,0 +1,71 @@
+"""
+Micro-benchmark comparing writing downloaded results to CSV a row at a time
+(with a per-row callback for progress and uniqueness tracking) against writing
+them a batch at a time, as `mssql_table_to_csv` now does
+
+Run with:
+
+    python -m benchmarks.csv_writing [NUM_ROWS]
+"""
+import csv
+import datetime
+import os
+import sys
+import time
+
+from cohortextractor.unique_check import UniqueCheck
+
+
+BATCH_SIZE = 32000
+
+
+def make_batches(num_rows):
+    row_template = ("M", 47, 23.5, 1, datetime.date(2020, 3, 1), "E02000001")
+    rows = [(patient_id,) + row_template for patient_id in range(num_rows)]
+    return [rows[i : i + BATCH_SIZE] for i in range(0, num_rows, BATCH_SIZE)]
+
+
+def write_row_at_a_time(csvfile, batches):
+    writer = csv.writer(csvfile)
+    unique_check = UniqueCheck(ordered=True)
+
+    def row_callback(row):
+        unique_check.add(row[0])
+        if unique_check.count % 1000000 == 0:
+            pass
+
+    for batch in batches:
+        for row in batch:
+            writer.writerow(row)
+            row_callback(row)
+    unique_check.assert_unique_ids()
+
+
+def write_batch_at_a_time(csvfile, batches):
+    writer = csv.writer(csvfile)
+    unique_check = UniqueCheck(ordered=True)
+
+    def batch_callback(rows):
+        previous_count = unique_check.count
+        unique_check.add_batch([row[0] for row in rows])
+        if unique_check.count // 1000000 > previous_count // 1000000:
+            pass
+
+    for batch in batches:
+        writer.writerows(batch)
+        batch_callback(batch)
+    unique_check.assert_unique_ids()
+
+
+def main(num_rows=1000000):
+    batches = make_batches(num_rows)
+    for function in [write_row_at_a_time, write_batch_at_a_time]:
+        with open(os.devnull, "w", newline="") as csvfile:
+            start = time.perf_counter()
+            function(csvfile, batches)
+            duration = time.perf_counter() - start
+        print(f"{function.__name__}: {num_rows / duration:,.0f} rows/s")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
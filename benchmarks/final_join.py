@@ -0,0 +1,98 @@
+"""
+Benchmark of the query which joins all the column tables together, comparing
+the plan the optimiser picks over unindexed tables (as before column tables
+were indexed) against the same join over tables clustered on patient_id, with
+and without the `OPTION (MERGE JOIN)` hint which `USE_MERGE_JOIN` adds
+
+This needs a SQL Server to run against. It builds its own synthetic column
+tables as session-scoped temporary tables, so nothing is left behind.
+
+Run with:
+
+    DATABASE_URL=mssql://... python -m benchmarks.final_join [NUM_ROWS] [NUM_COLUMNS]
+"""
+import os
+import sys
+import time
+
+from cohortextractor.mssql_utils import mssql_dbapi_connection_from_url
+
+
+def create_tables(cursor, num_rows, num_columns, index_type):
+    cursor.execute(
+        f"""
+        SELECT TOP {num_rows}
+          ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) AS patient_id
+        INTO #population
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b CROSS JOIN sys.all_objects c
+        """
+    )
+    names = [f"#column_{n}" for n in range(num_columns)]
+    for n, name in enumerate(names):
+        # Each column covers a different subset of the population, like most
+        # real columns, and is written in an arbitrary order
+        cursor.execute(
+            f"""
+            SELECT patient_id, patient_id % 97 AS value
+            INTO {name}
+            FROM #population
+            WHERE patient_id % {n + 2} = 0
+            ORDER BY NEWID()
+            """
+        )
+    if index_type:
+        for table in ["#population"] + names:
+            cursor.execute(
+                f"CREATE {index_type} INDEX ix_patient_id ON {table} (patient_id)"
+            )
+    return names
+
+
+def run_join(cursor, names, hint):
+    output_columns = ",\n".join(f"ISNULL({name}.value, 0)" for name in names)
+    joins = "\n".join(
+        f"LEFT JOIN {name} ON {name}.patient_id = #population.patient_id"
+        for name in names
+    )
+    cursor.execute(
+        f"""
+        SELECT #population.patient_id, {output_columns}
+        FROM #population
+        {joins}
+        {hint}
+        """
+    )
+    while cursor.fetchmany(32000):
+        pass
+
+
+def drop_tables(cursor, names):
+    for table in ["#population"] + names:
+        cursor.execute(f"DROP TABLE {table}")
+
+
+def main(num_rows=1000000, num_columns=30):
+    connection = mssql_dbapi_connection_from_url(os.environ["DATABASE_URL"])
+    cursor = connection.cursor()
+    variants = [
+        ("no index", None, ""),
+        ("non-unique clustered index", "CLUSTERED", ""),
+        ("unique clustered index", "UNIQUE CLUSTERED", ""),
+        (
+            "unique clustered index, merge join",
+            "UNIQUE CLUSTERED",
+            "OPTION (MERGE JOIN)",
+        ),
+    ]
+    for label, index_type, hint in variants:
+        names = create_tables(cursor, num_rows, num_columns, index_type)
+        start = time.perf_counter()
+        run_join(cursor, names, hint)
+        duration = time.perf_counter() - start
+        drop_tables(cursor, names)
+        print(f"{label}: {duration:.2f}s")
+    connection.close()
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of `generate_ages`, comparing the cost per call of the
+current implementation against the previous one, which re-read and re-parsed
+the population bands and built a new `rv_discrete` distribution on every call
+
+Run with:
+
+    python -m benchmarks.generate_ages [NUM_ROWS ...]
+"""
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.stats import rv_discrete
+
+import cohortextractor
+from cohortextractor.expectation_generators import generate_ages
+
+
+def previous_generate_ages(population, max_age=110):
+    df = pd.read_csv(
+        os.path.join(
+            os.path.dirname(cohortextractor.__file__), "uk_population_bands_2018.csv"
+        )
+    )
+    bands = df["band"].str.split("-").apply(pd.Series)
+    df = df.join(bands)[[0, 1, "range"]]
+    df.columns = ["start", "end", "count"]
+    df["count"] = df["count"].str.replace(",", "").astype("int")
+    ages = pd.DataFrame(np.arange(max_age), columns=["age"])
+    total = df["count"].sum()
+
+    def lookup_age(age):
+        for index, row in df.iterrows():
+            if age <= int(row["end"]):
+                return row["count"]
+
+    ages["p"] = ages.age.apply(lookup_age) / total / 5
+    excess = ages.p.sum() - 1
+    biggest = ages[ages.p == ages.p.max()]
+    ages.loc[biggest.index[0], "p"] -= excess
+    distribution = rv_discrete(name="uk_population", values=(ages.age, ages.p))
+    return distribution.rvs(size=population)
+
+
+def time_call(function, num_rows, repeat=3):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(num_rows)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(*sizes):
+    sizes = sizes or (1000000, 10000000)
+    # The first call parses the bands; every later call uses the cached values
+    start = time.perf_counter()
+    generate_ages(1)
+    print(f"generate_ages first call: {(time.perf_counter() - start) * 1000:.1f}ms")
+    for num_rows in sizes:
+        for function in [previous_generate_ages, generate_ages]:
+            duration = time_call(function, num_rows)
+            print(f"{function.__name__}({num_rows:,}): {duration * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main(*map(int, sys.argv[1:]))
@@ -8,6 +8,7 @@ import cohortextractor
 from collections import defaultdict
 import csv
 import glob
+import json
 import logging
 import importlib
 import os
@@ -32,6 +33,14 @@ import seaborn as sns
 from prettytable import PrettyTable
 
 from cohortextractor.localrun import localrun
+from cohortextractor.output_formats import (
+    OUTPUT_EXTENSIONS,
+    find_output_file,
+    get_output_format,
+    glob_output_files,
+    open_csv_file,
+    read_dataframe,
+)
 
 notebook_tag = "opencorona-research"
 target_dir = "/home/app/notebook"
@@ -129,6 +138,8 @@ def generate_cohort(
     selected_study_name=None,
     index_date_range=None,
     skip_existing=False,
+    combine_index_dates=False,
+    output_format="csv",
 ):
     preflight_generation_check()
     study_definitions = list_study_definitions()
@@ -146,6 +157,8 @@ def generate_cohort(
             expectations_population,
             index_date_range=index_date_range,
             skip_existing=skip_existing,
+            combine_index_dates=combine_index_dates,
+            output_format=output_format,
         )
 
 
@@ -156,12 +169,20 @@ def _generate_cohort(
     expectations_population,
     index_date_range=None,
     skip_existing=False,
+    combine_index_dates=False,
+    output_format="csv",
 ):
     print("Running. Please wait...")
     study = load_study_definition(study_name)
 
     os.makedirs(output_dir, exist_ok=True)
-    for index_date in _generate_date_range(index_date_range):
+    index_dates = _generate_date_range(index_date_range)
+    if combine_index_dates and index_date_range and not expectations_population:
+        _generate_cohort_for_index_dates(
+            study, output_dir, suffix, index_dates, skip_existing, output_format
+        )
+        return
+    for index_date in index_dates:
         if index_date is not None:
             study.set_index_date(index_date)
             date_suffix = f"_{index_date}"
@@ -169,7 +190,7 @@ def _generate_cohort(
             date_suffix = ""
         # If this is changed then the glob pattern in `_generate_measures()`
         # must be updated
-        output_file = f"{output_dir}/input{suffix}{date_suffix}.csv"
+        output_file = f"{output_dir}/input{suffix}{date_suffix}.{output_format}"
         if skip_existing and os.path.exists(output_file):
             print(f"Not regenerating pre-existing file at {output_file}")
         else:
@@ -180,6 +201,23 @@ def _generate_cohort(
             print(f"Successfully created cohort and covariates at {output_file}")
 
 
+def _generate_cohort_for_index_dates(
+    study, output_dir, suffix, index_dates, skip_existing, output_format="csv"
+):
+    filenames = {}
+    for index_date in index_dates:
+        # This must match the filename used in `_generate_cohort()` above
+        output_file = f"{output_dir}/input{suffix}_{index_date}.{output_format}"
+        if skip_existing and os.path.exists(output_file):
+            print(f"Not regenerating pre-existing file at {output_file}")
+        else:
+            filenames[index_date] = output_file
+    if filenames:
+        study.to_csvs_for_index_dates(filenames)
+    for output_file in filenames.values():
+        print(f"Successfully created cohort and covariates at {output_file}")
+
+
 def _generate_date_range(date_range_str):
     # Bail out with an "empty" range: this means we don't need separate
     # codepaths to handle the range, single date, and no date supplied cases
@@ -255,10 +293,17 @@ def _generate_measures(output_dir, study_name, suffix, skip_existing=False):
     print("Running. Please wait...")
     measures = load_study_definition(study_name, value="measures")
     measure_outputs = defaultdict(list)
-    for file in glob.glob(f"{output_dir}/input{suffix}*.csv"):
+    files_by_date = {}
+    for file in glob_output_files(f"{output_dir}/input{suffix}*"):
         date = _get_date_from_filename(file)
         if date is None:
             continue
+        if date in files_by_date:
+            raise RuntimeError(
+                f"Found more than one input file for {date}: "
+                f"{files_by_date[date]} and {file}"
+            )
+        files_by_date[date] = file
         patient_df = None
         for measure in measures:
             output_file = f"{output_dir}/measure_{measure.id}_{date}.csv"
@@ -301,14 +346,16 @@ def _calculate_measure_df(patient_df, measure):
 
 
 def _get_date_from_filename(filename):
-    match = re.search(r"_(\d\d\d\d\-\d\d\-\d\d)\.csv$", filename)
+    extensions = "|".join(map(re.escape, OUTPUT_EXTENSIONS))
+    match = re.search(rf"_(\d\d\d\d\-\d\d\-\d\d)\.({extensions})$", filename)
     return datetime.date.fromisoformat(match.group(1)) if match else None
 
 
 def _load_csv_for_measures(file, measures):
     """
-    Given a CSV file name and a list of measures, load the file into a Pandas
-    dataframe with types as appropriate for the supplied measures
+    Given a CSV (or Parquet or Feather) file name and a list of measures, load
+    the file into a Pandas dataframe with types as appropriate for the supplied
+    measures
     """
     numeric_columns = set()
     group_by_columns = set()
@@ -322,7 +369,11 @@ def _load_csv_for_measures(file, measures):
     dtype = {col: "category" for col in group_by_columns}
     for col in numeric_columns:
         dtype[col] = "float64"
-    df = pandas.read_csv(file, dtype=dtype, usecols=list(dtype.keys()))
+    if get_output_format(file) == "csv":
+        with open_csv_file(file) as csvfile:
+            df = pandas.read_csv(csvfile, dtype=dtype, usecols=list(dtype.keys()))
+    else:
+        df = read_dataframe(file, columns=list(dtype.keys())).astype(dtype)
     df["population"] = 1
     return df
 
@@ -331,25 +382,25 @@ def _combine_csv_files_with_dates(filename, input_files):
     """
     Takes a list of CSV files which have dates in their filenames and combines
     them into a single CSV file with an additional "date" column indicating the
-    date for each row
+    date for each row. Any of the files may be compressed, as indicated by
+    their extensions.
     """
     input_files = sorted(input_files)
-    with open(input_files[0]) as first_file:
+    with open_csv_file(input_files[0]) as first_file:
         reader = csv.reader(first_file)
         headers = next(reader)
-    with open(filename, "w", newline="") as csvfile:
+    with open_csv_file(filename, "w") as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow(headers + ["date"])
         for file in input_files:
             date = _get_date_from_filename(file)
-            with open(file) as input_csvfile:
+            with open_csv_file(file) as input_csvfile:
                 reader = csv.reader(input_csvfile)
                 if next(reader) != headers:
                     raise RuntimeError(
                         f"Files {input_files[0]} and {file} have different headers"
                     )
-                for row in reader:
-                    writer.writerow(row + [date])
+                writer.writerows(row + [date] for row in reader)
 
 
 def make_cohort_report(input_dir, output_dir):
@@ -360,7 +411,7 @@ def make_cohort_report(input_dir, output_dir):
 def _make_cohort_report(input_dir, output_dir, study_name, suffix):
     study = load_study_definition(study_name)
 
-    df = study.csv_to_df(f"{input_dir}/input{suffix}.csv")
+    df = study.csv_to_df(find_output_file(f"{input_dir}/input{suffix}"))
     descriptives = df.describe(include="all")
 
     for name, dtype in zip(df.columns, df.dtypes):
@@ -448,9 +499,93 @@ def update_codelists():
                 f.write(rsp.text)
 
 
-def dump_cohort_sql(study_definition):
+def dump_cohort_sql(study_definition, explain=None):
     study = load_study_definition(study_definition)
-    print(study.to_sql())
+    if not explain:
+        print(study.to_sql())
+        return
+    summaries = study.explain()
+    if explain == "json":
+        print(json.dumps(summaries, indent=2))
+        return
+    output = PrettyTable()
+    output.field_names = ["query", "estimated rows", "estimated cost", "operators"]
+    output.align = "l"
+    for summary in summaries:
+        operators = "\n".join(
+            f"{operator['operator']}"
+            f"{' on ' + operator['table'] if operator['table'] else ''}"
+            f" (cost {operator['estimated_cost']}, rows {operator['estimated_rows']:.0f})"
+            for operator in summary["operators"]
+        )
+        output.add_row(
+            [
+                summary["query"],
+                f"{summary['estimated_rows']:.0f}",
+                summary["estimated_cost"],
+                operators,
+            ]
+        )
+    print(output)
+
+
+def codelist_cache(action):
+    from .emis_backend import get_codelist_cache
+
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url or not database_url.startswith("presto://"):
+        raise RuntimeError(
+            "DATABASE_URL must be set to an EMIS (Presto) database to manage the "
+            "codelist cache"
+        )
+    cache = get_codelist_cache(database_url)
+    if action == "list":
+        entries = cache.entries()
+        for entry in entries:
+            expired = " (expired)" if entry["expired"] else ""
+            print(
+                f"{entry['table_name']}  rows={entry['row_count']}  "
+                f"created={entry['created_on']}{expired}"
+            )
+        total_rows = sum(entry["row_count"] or 0 for entry in entries)
+        print(f"{len(entries)} entries, {total_rows} rows")
+    elif action == "evict":
+        deleted = cache.evict()
+        print(f"Evicted {len(deleted)} entries")
+    elif action == "purge":
+        deleted = cache.purge()
+        print(f"Deleted {len(deleted)} entries")
+
+
+def column_cache(action):
+    from .tpp_backend import get_column_cache
+
+    database_url = os.environ.get("DATABASE_URL")
+    temporary_database = os.environ.get("TEMP_DATABASE_NAME")
+    if not database_url or not temporary_database:
+        raise RuntimeError(
+            "DATABASE_URL and TEMP_DATABASE_NAME must be set to use the column cache"
+        )
+    cache = get_column_cache(database_url, temporary_database)
+    cache.setup()
+    if action == "list":
+        entries = cache.entries()
+        for entry in entries:
+            expired = " (expired)" if entry["expired"] else ""
+            print(
+                f"{entry['cache_key']}  {entry['database_name']}  "
+                f"{entry['column_name']}  rows={entry['row_count']}  "
+                f"created={entry['created_at']}  "
+                f"last_used={entry['last_used_at']}{expired}"
+            )
+        total_rows = sum(entry["row_count"] or 0 for entry in entries)
+        print(f"{len(entries)} entries, {total_rows} rows")
+    elif action == "evict":
+        deleted = cache.evict()
+        print(f"Evicted {len(deleted)} entries")
+    elif action == "purge":
+        deleted = cache.purge()
+        print(f"Deleted {len(deleted)} entries")
 
 
 def dump_study_yaml(study_definition):
@@ -574,7 +709,41 @@ def main():
     dump_cohort_sql_parser.add_argument(
         "--study-definition", help="Study definition name", type=str, required=True
     )
+    dump_cohort_sql_parser.add_argument(
+        "--explain",
+        help=(
+            "Instead of the SQL, show the database's estimated cost of each query "
+            "as a table (the default) or as JSON"
+        ),
+        nargs="?",
+        const="table",
+        choices=["table", "json"],
+    )
     dump_cohort_sql_parser.set_defaults(which="dump_cohort_sql")
+    column_cache_parser = subparsers.add_parser(
+        "column_cache", help="Manage the cache of column results"
+    )
+    column_cache_parser.add_argument(
+        "action",
+        help=(
+            "'list' entries, 'evict' entries which are too old or exceed the "
+            "maximum size, or 'purge' all entries"
+        ),
+        choices=["list", "evict", "purge"],
+    )
+    column_cache_parser.set_defaults(which="column_cache")
+    codelist_cache_parser = subparsers.add_parser(
+        "codelist_cache", help="Manage the codelist tables kept in the EMIS database"
+    )
+    codelist_cache_parser.add_argument(
+        "action",
+        help=(
+            "'list' codelist tables, 'evict' those which are too old, or 'purge' "
+            "all of them"
+        ),
+        choices=["list", "evict", "purge"],
+    )
+    codelist_cache_parser.set_defaults(which="codelist_cache")
     dump_study_yaml_parser = subparsers.add_parser(
         "dump_study_yaml", help="Show study definition as YAML"
     )
@@ -603,6 +772,74 @@ def main():
         type=str,
         default=os.environ.get("TEMP_DATABASE_NAME", ""),
     )
+    generate_cohort_parser.add_argument(
+        "--max-parallel-queries",
+        help="Number of database connections to use when running queries",
+        type=int,
+        default=os.environ.get("MAX_PARALLEL_QUERIES", 1),
+    )
+    generate_cohort_parser.add_argument(
+        "--max-parallel-downloads",
+        help="Number of database connections to use when downloading results",
+        type=int,
+        default=os.environ.get("MAX_PARALLEL_DOWNLOADS", 1),
+    )
+    generate_cohort_parser.add_argument(
+        "--download-batch-seconds",
+        help=(
+            "Adjust the number of rows fetched at a time when downloading "
+            "results so each batch takes about this long (0 to disable)"
+        ),
+        type=float,
+    )
+    generate_cohort_parser.add_argument(
+        "--restrict-to-population",
+        help="Only run column queries for patients in the population",
+        action="store_true",
+        default=bool(os.environ.get("RESTRICT_TO_POPULATION")),
+    )
+    generate_cohort_parser.add_argument(
+        "--use-merge-join",
+        help=(
+            "Index the table for each column on patient_id and force the query "
+            "which joins all columns to use merge joins"
+        ),
+        action="store_true",
+        default=bool(os.environ.get("USE_MERGE_JOIN")),
+    )
+    generate_cohort_parser.add_argument(
+        "--fuse-event-queries",
+        help="Compute compatible clinical event columns in a single query",
+        action="store_true",
+        default=bool(os.environ.get("FUSE_EVENT_QUERIES")),
+    )
+    generate_cohort_parser.add_argument(
+        "--column-cache",
+        help=(
+            "Save the results of each column in the temporary database and "
+            "reuse them in later runs"
+        ),
+        action="store_true",
+        default=bool(os.environ.get("COLUMN_CACHE")),
+    )
+    generate_cohort_parser.add_argument(
+        "--combine-index-dates",
+        help=(
+            "Extract all the dates in --index-date-range together, sharing work "
+            "between them"
+        ),
+        action="store_true",
+    )
+    generate_cohort_parser.add_argument(
+        "--output-format",
+        help=(
+            "Format of the output files: CSV can be compressed with gzip or zstd "
+            "(requires `zstandard`), and Parquet and Feather files have typed "
+            "columns and are faster to load (requires `pyarrow`)"
+        ),
+        choices=OUTPUT_EXTENSIONS,
+        default="csv",
+    )
     generate_cohort_parser.add_argument(
         "--index-date-range",
         help="Evaluate the study definition at a range of index dates",
@@ -661,6 +898,18 @@ def main():
             os.environ["DATABASE_URL"] = options.database_url
         if options.temp_database_name:
             os.environ["TEMP_DATABASE_NAME"] = options.temp_database_name
+        os.environ["MAX_PARALLEL_QUERIES"] = str(options.max_parallel_queries)
+        os.environ["MAX_PARALLEL_DOWNLOADS"] = str(options.max_parallel_downloads)
+        if options.download_batch_seconds is not None:
+            os.environ["DOWNLOAD_BATCH_SECONDS"] = str(options.download_batch_seconds)
+        if options.restrict_to_population:
+            os.environ["RESTRICT_TO_POPULATION"] = "1"
+        if options.use_merge_join:
+            os.environ["USE_MERGE_JOIN"] = "1"
+        if options.fuse_event_queries:
+            os.environ["FUSE_EVENT_QUERIES"] = "1"
+        if options.column_cache:
+            os.environ["COLUMN_CACHE"] = "1"
         if not options.expectations_population and not os.environ.get("DATABASE_URL"):
             parser.error(
                 "generate_cohort: error: one of the arguments "
@@ -672,6 +921,8 @@ def main():
             selected_study_name=options.study_definition,
             index_date_range=options.index_date_range,
             skip_existing=options.skip_existing,
+            combine_index_dates=options.combine_index_dates,
+            output_format=options.output_format,
         )
     elif options.which == "generate_measures":
         generate_measures(
@@ -714,7 +965,11 @@ def main():
         update_codelists()
         print("Codelists updated. Don't forget to commit them to the repo")
     elif options.which == "dump_cohort_sql":
-        dump_cohort_sql(options.study_definition)
+        dump_cohort_sql(options.study_definition, explain=options.explain)
+    elif options.which == "column_cache":
+        column_cache(options.action)
+    elif options.which == "codelist_cache":
+        codelist_cache(options.action)
     elif options.which == "dump_study_yaml":
         dump_study_yaml(options.study_definition)
 
@@ -188,8 +188,7 @@ class VaccinationsStudyDefinition:
             )
             writer.writeheader()
             output = add_patient_vaccination_dates(patients, vaccination_events)
-            for output_row in output:
-                writer.writerow(output_row)
+            writer.writerows(output)
         # fmt: on
 
     def write_dummy_data(self, filename, num_rows):
@@ -200,8 +199,7 @@ class VaccinationsStudyDefinition:
             writer = csv.DictWriter(output_file, fieldnames=first_patient.keys())
             writer.writeheader()
             writer.writerow(first_patient)
-            for patient in patients:
-                writer.writerow(patient)
+            writer.writerows(patients)
 
     def generate_dummy_data(self, num_rows):
         rand = random.Random()
@@ -258,5 +256,4 @@ def mssql_query_to_csv_file(database_url, query, filename):
     with open(filename, "w", newline="") as csvfile:
         writer = csv.writer(csvfile)
         writer.writerow([x[0] for x in cursor.description])
-        for row in cursor:
-            writer.writerow(row)
+        writer.writerows(cursor)
@@ -1,13 +1,44 @@
+import concurrent.futures
+import contextlib
 import csv
 import datetime
+import hashlib
+import json
 import os
 import re
+import threading
+import time
 import uuid
 
+import prestodb
+
 from .codelistlib import codelist
 from .expressions import format_expression
-from .presto_utils import presto_connection_from_url
-
+from .output_formats import (
+    get_column_types,
+    get_compression,
+    get_output_format,
+    join_csv_parts,
+    open_csv_file,
+    open_output_writer,
+)
+from .presto_utils import fetch_batches, presto_connection_from_url
+from .sql_utils import canonicalise_sql
+from .unique_check import UniqueCheck
+
+
+# Codelists with more codes than this are loaded in several statements
+CODELIST_CHUNK_SIZE = 1000
+
+# Stands in for the prefix of temporary table names while we generate the
+# queries, as the real prefix is derived from a hash of the queries themselves
+# (see `EMISBackend.get_temp_table_prefix`)
+TEMP_TABLE_PREFIX_PLACEHOLDER = "__temp_table_prefix__"
+
+# Appended to the temporary table prefix to name the table which records the
+# run that's using the tables (see `EMISBackend.claim_tables`). Column names
+# can't start with a digit, so no column's table can have this name.
+CLAIM_TABLE_SUFFIX = "0claim"
 
 # Characters that are safe to interpolate into SQL (see
 # `placeholders_and_params` below)
@@ -22,33 +53,106 @@ class EMISBackend:
     def __init__(self, database_url, covariate_definitions, temporary_database=None):
         self.database_url = database_url
         self.covariate_definitions = covariate_definitions
+        self.temporary_database = temporary_database
+        self.max_parallel_queries = int(os.environ.get("MAX_PARALLEL_QUERIES") or 1)
+        # Downloading in parallel needs the results to be written to an output
+        # table in `temporary_database` first
+        self.max_parallel_downloads = int(os.environ.get("MAX_PARALLEL_DOWNLOADS") or 1)
+        # Roughly how much memory results fetched ahead of the consumer may use
+        self.download_max_bytes = (
+            int(os.environ.get("DOWNLOAD_BATCH_MAX_MB") or 256) * 1024 * 1024
+        )
+        # A run which was killed can't give up its claim on its tables, so we
+        # take over claims older than this (see `claim_tables`)
+        self.run_claim_timeout_hours = float(
+            os.environ.get("RUN_CLAIM_TIMEOUT_HOURS") or 12
+        )
+        self.run_id = uuid.uuid4().hex
+        self._claimed = False
+        # Each entry is a list of statements which together create one table
         self.codelist_tables = []
-        self.temp_table_prefix = self.get_temp_table_prefix()
+        self._codelist_table_names = {}
+        self._codelist_staging_tables = []
+        self.temp_table_prefix = TEMP_TABLE_PREFIX_PLACEHOLDER
+        queries = self.get_queries(self.covariate_definitions)
+        # We keep the queries with the placeholder prefix so that we can
+        # switch to a different prefix later if need be (see `claim_tables`)
+        self._query_templates = queries
+        self._codelist_table_templates = self.codelist_tables
+        self._codelist_staging_table_templates = self._codelist_staging_tables
+        self.set_temp_table_prefix(self.get_temp_table_prefix(queries))
+
+    def set_temp_table_prefix(self, temp_table_prefix):
+        self.temp_table_prefix = temp_table_prefix
         self.log(f"temp_table_prefix: {self.temp_table_prefix}")
-        self.queries = self.get_queries(self.covariate_definitions)
+        self.codelist_tables = [
+            [self.replace_temp_table_prefix(sql) for sql in statements]
+            for statements in self._codelist_table_templates
+        ]
+        self._codelist_staging_tables = [
+            self.replace_temp_table_prefix(table_name)
+            for table_name in self._codelist_staging_table_templates
+        ]
+        self.queries = [
+            (name, self.replace_temp_table_prefix(sql))
+            for name, sql in self._query_templates
+        ]
 
     def to_csv(self, filename):
-        result = self.execute_query()
-        unique_check = UniqueCheck()
-        with open(filename, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow([x[0] for x in result.description])
-            for row in result:
-                unique_check.add(row[0])
-                writer.writerow(row)
+        with self.claimed_tables():
+            output_table = self.get_output_table_name(self.temporary_database)
+            if output_table and self.max_parallel_downloads > 1:
+                self.write_output_table(output_table)
+                unique_check = self.download_output_table_in_parallel(
+                    output_table, filename
+                )
+                self.drop_tables()
+                unique_check.assert_unique_ids()
+                return
+            result = self.execute_query()
+            unique_check = UniqueCheck()
+            column_types = get_column_types(self.covariate_definitions)
+            with open_output_writer(filename, column_types) as writer:
+                writer.writerow([x[0] for x in result.description])
+                for rows in fetch_batches(result, 2 ** 14):
+                    unique_check.add_batch([row[0] for row in rows])
+                    writer.writerows(rows)
+            summary = result.get_fetch_summary()
+            if summary:
+                self.log(summary)
+            # Only once the results are safely written can we drop the tables
+            # which would let us resume
+            self.drop_tables()
         unique_check.assert_unique_ids()
 
     def to_dicts(self):
-        result = self.execute_query()
-        keys = [x[0] for x in result.description]
-        # Convert all values to str as that's what will end in the CSV
-        output = [dict(zip(keys, map(str, row))) for row in result]
+        with self.claimed_tables():
+            result = self.execute_query()
+            keys = [x[0] for x in result.description]
+            # Convert all values to str as that's what will end in the CSV
+            output = [dict(zip(keys, map(str, row))) for row in result]
+            self.drop_tables()
         unique_check = UniqueCheck()
         for item in output:
             unique_check.add(item["patient_id"])
         unique_check.assert_unique_ids()
         return output
 
+    def get_result_batches(self, batch_size):
+        """
+        Run the queries and return the names of the output columns along with
+        an iterator over the results in lists of at most `batch_size` rows
+        """
+        with self.claimed_tables():
+            cursor = self.execute_query()
+        headers = [x[0] for x in cursor.description]
+        return headers, self._fetch_batches_then_drop_tables(cursor, batch_size)
+
+    def _fetch_batches_then_drop_tables(self, cursor, batch_size):
+        with self.claimed_tables():
+            yield from fetch_batches(cursor, batch_size)
+            self.drop_tables()
+
     def to_sql(self):
         """
         Generate a single SQL string.
@@ -56,8 +160,9 @@ class EMISBackend:
         Useful for debugging, optimising, etc.
         """
         prepared_sql = ["-- Create codelist tables"]
-        for sql in self.codelist_tables:
-            prepared_sql.append(f"{sql};\n\n")
+        for statements in self.codelist_tables:
+            for sql in statements:
+                prepared_sql.append(f"{sql};\n\n")
         for name, query in self.queries:
             prepared_sql.append(f"-- Query for {name}")
             prepared_sql.append(f"{query};\n\n")
@@ -68,6 +173,10 @@ class EMISBackend:
         column_types = {}
         is_hidden = {}
         table_queries = {}
+        # Maps each column which has a table to the name of that table (which
+        # may belong to an identical column defined earlier, see below)
+        table_names = {}
+        tables_by_sql = {}
         for name, (query_type, query_args) in covariate_definitions.items():
             # So we can safely mutate these below
             query_args = query_args.copy()
@@ -89,19 +198,29 @@ class EMISBackend:
             # `value_from` columns also don't generate a table, they just take
             # a value from another table
             elif query_type == "value_from":
-                assert query_args["source"] in table_queries
+                assert query_args["source"] in table_names
+                query_args["source"] = table_names[query_args["source"]]
                 output_columns[name] = self.get_column_expression(
                     column_type, **query_args
                 )
             else:
                 date_format_args = pop_keys_from_dict(query_args, ["date_format"])
                 cols, sql = self.get_query(name, query_type, query_args)
-                table_name = self.make_temp_table_name(name)
-                table_queries[name] = f"CREATE TABLE {table_name} AS {sql}"
+                # Identical queries (which are common, as codelist tables are
+                # shared between columns) only need running once so we point
+                # any later columns at the table built for the first
+                canonical_sql = canonicalise_sql(sql)
+                if canonical_sql in tables_by_sql:
+                    table_names[name] = tables_by_sql[canonical_sql]
+                else:
+                    table_name = self.make_temp_table_name(name)
+                    table_queries[name] = f"CREATE TABLE {table_name} AS {sql}"
+                    table_names[name] = name
+                    tables_by_sql[canonical_sql] = name
                 # The first column should always be patient_id so we can join on it
                 assert cols[0] == "patient_id"
                 output_columns[name] = self.get_column_expression(
-                    column_type, name, cols[1], **date_format_args
+                    column_type, table_names[name], cols[1], **date_format_args
                 )
         # If the population query defines its own temporary table then we use
         # that as the primary table to query against and left join everything
@@ -162,43 +281,416 @@ class EMISBackend:
             raise ValueError(f"Unhandled column type: {column_type}")
 
     def execute_query(self):
-        cursor = self.get_db_connection().cursor()
-        self.log("Uploading codelists into temporary tables")
-        for sql in self.codelist_tables:
-            cursor.execute(sql)
-        queries = list(self.queries)
-        final_query = queries.pop()[1]
-        for name, sql in queries:
-            self.log(f"Running query: {name}")
-            cursor.execute(sql)
-        output_table = self.get_output_table_name(os.environ.get("TEMP_DATABASE_NAME"))
+        """
+        Run the queries and return a cursor over the results
+
+        All our tables are named after the hash of the queries and the date
+        (see `get_temp_table_prefix`) and are only dropped once the results
+        have been downloaded. So if a previous run of the same study failed
+        earlier the same day we skip any tables it completed (CREATE TABLE AS
+        is atomic, so a table which exists is complete) and, if it got as far
+        as writing the output table, just download that again. The caller
+        must have claimed the tables first (see `claim_tables`).
+        """
+        cursor = self.get_db_connection().cursor(
+            max_buffered_bytes=self.download_max_bytes
+        )
+        output_table = self.get_output_table_name(self.temporary_database)
         if output_table:
-            self.log(f"Running final query and writing output to '{output_table}'")
-            sql = f"CREATE TABLE {output_table} AS {final_query}"
-            cursor.execute(sql)
+            self.write_output_table(output_table)
             self.log(f"Downloading data from '{output_table}'")
             cursor.execute(f"SELECT * FROM {output_table}")
         else:
+            self.create_tables()
             self.log(
                 "No TEMP_DATABASE_NAME defined in environment, downloading results "
                 "directly without writing to output table"
             )
-            cursor.execute(final_query)
+            cursor.execute(self.queries[-1][1])
         return cursor
 
+    def write_output_table(self, output_table):
+        if self.table_exists(output_table):
+            self.log(f"Found existing results in '{output_table}'")
+            return
+        self.create_tables()
+        self.log(f"Running final query and writing output to '{output_table}'")
+        final_query = self.queries[-1][1]
+        cursor = self.get_db_connection().cursor()
+        cursor.execute(f"CREATE TABLE {output_table} AS {final_query}")
+
+    def create_tables(self):
+        """
+        Create the codelist tables and then the column tables which the final
+        query joins together
+        """
+        self.log("Uploading codelists into temporary tables")
+        self.execute_table_queries(
+            [("codelist table", statements) for statements in self.codelist_tables],
+            self._codelist_table_names.values(),
+        )
+        queries = self.queries[:-1]
+        self.execute_table_queries(
+            queries, [self.make_temp_table_name(name) for name, _ in queries]
+        )
+
+    def download_output_table_in_parallel(self, output_table, filename):
+        """
+        Download `output_table` to `filename` over `max_parallel_downloads`
+        connections, each fetching the patients whose IDs hash to its shard
+
+        For CSV output each shard is written (and compressed) to its own part
+        file and the parts are then joined. Parquet and Feather files can't
+        simply be joined so there the shards take turns to write each batch
+        to a single file. Either way the order of the rows is arbitrary, so
+        the patient IDs from all the shards are checked for duplicates at the
+        end.
+        """
+        num_shards = self.max_parallel_downloads
+        self.log(
+            f"Downloading data from '{output_table}' using {num_shards} connections"
+        )
+        cursor = self.get_db_connection().cursor()
+        cursor.execute(f"SELECT * FROM {output_table} LIMIT 0")
+        headers = [x[0] for x in cursor.description]
+        unique_check = UniqueCheck()
+        lock = threading.Lock()
+        stopped = threading.Event()
+
+        def download_shard(shard, write_rows):
+            connection = presto_connection_from_url(self.database_url)
+            try:
+                cursor = connection.cursor(
+                    max_buffered_bytes=self.download_max_bytes // num_shards
+                )
+                condition = get_shard_condition("patient_id", num_shards, shard)
+                cursor.execute(f"SELECT * FROM {output_table} WHERE {condition}")
+                for rows in fetch_batches(cursor, 2 ** 14):
+                    if stopped.is_set():
+                        return
+                    with lock:
+                        unique_check.add_batch([row[0] for row in rows])
+                    write_rows(rows)
+                summary = cursor.get_fetch_summary()
+                if summary:
+                    self.log(f"Shard {shard}: {summary}")
+            finally:
+                connection.close()
+
+        def download_shards(download):
+            with concurrent.futures.ThreadPoolExecutor(num_shards) as executor:
+                futures = [executor.submit(download, n) for n in range(num_shards)]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        future.result()
+                except Exception:
+                    # Let the other shards stop at their next batch
+                    stopped.set()
+                    raise
+
+        if get_output_format(filename) == "csv":
+            compression = get_compression(filename)
+            part_filenames = [f"{filename}.part{n}" for n in range(num_shards)]
+
+            def download_shard_to_part(shard):
+                with open_csv_file(part_filenames[shard], "w", compression) as f:
+                    download_shard(shard, csv.writer(f).writerows)
+
+            try:
+                download_shards(download_shard_to_part)
+                join_csv_parts(filename, headers, part_filenames)
+            finally:
+                for part_filename in part_filenames:
+                    if os.path.exists(part_filename):
+                        os.unlink(part_filename)
+        else:
+            column_types = get_column_types(self.covariate_definitions)
+            with open_output_writer(filename, column_types) as writer:
+                writer.writerow(headers)
+
+                def write_rows_in_turn(rows):
+                    with lock:
+                        writer.writerows(rows)
+
+                download_shards(lambda shard: download_shard(shard, write_rows_in_turn))
+        self.log(f"Downloaded {unique_check.count} results")
+        return unique_check
+
+    def execute_table_queries(self, queries, table_names):
+        """
+        Run `queries` (a list of name, SQL pairs) which create the tables in
+        `table_names`, skipping any tables which already exist and spreading
+        the rest over several connections if `MAX_PARALLEL_QUERIES` is set
+
+        The SQL may also be a list of statements, which are run in order.
+        """
+        missing_queries = []
+        for query, table_name in zip(queries, table_names):
+            if self.table_exists(table_name):
+                self.log(f"Using existing table '{table_name}' for {query[0]}")
+            else:
+                missing_queries.append(query)
+        if self.max_parallel_queries > 1:
+            self.execute_queries_in_parallel(missing_queries)
+        else:
+            cursor = self.get_db_connection().cursor()
+            for name, sql in missing_queries:
+                self.log(f"Running query: {name}")
+                for statement in get_statements(sql):
+                    cursor.execute(statement)
+
+    def table_exists(self, table_name):
+        cursor = self.get_db_connection().cursor()
+        try:
+            cursor.execute(f"SELECT * FROM {table_name} LIMIT 0")
+        except prestodb.exceptions.PrestoUserError as e:
+            if e.error_name == "TABLE_NOT_FOUND":
+                return False
+            raise
+        return True
+
+    def drop_tables(self):
+        """
+        Drop all the tables we've created, once the results are downloaded,
+        apart from the codelist tables which are kept for reuse (see
+        `create_codelist_table`)
+
+        If another run has since taken over the tables (see `claim_tables`)
+        then they're no longer ours to drop and we leave them alone.
+        """
+        if not self.owns_claim():
+            self.log("Not dropping temporary tables as another run has claimed them")
+            self._claimed = False
+            return
+        table_names = list(self._codelist_staging_tables)
+        table_names.extend(
+            self.make_temp_table_name(name) for name, _ in self.queries[:-1]
+        )
+        output_table = self.get_output_table_name(self.temporary_database)
+        if output_table:
+            table_names.append(output_table)
+        # Dropping the claim last means no other run can start using the
+        # tables until we've finished dropping them
+        table_names.append(self.get_claim_table_name())
+        self.log(f"Dropping {len(table_names)} temporary tables")
+        cursor = self.get_db_connection().cursor()
+        for table_name in table_names:
+            cursor.execute(f"DROP TABLE IF EXISTS {table_name}")
+        self._claimed = False
+
+    @contextlib.contextmanager
+    def claimed_tables(self):
+        """
+        Claim the tables for this run (see `claim_tables`) and, if anything in
+        the block fails, give up the claim but keep the tables so that a later
+        run can resume from them
+        """
+        self.claim_tables()
+        try:
+            yield
+        except BaseException:
+            self.release_claim()
+            raise
+
+    def claim_tables(self):
+        """
+        Record that this run is using the tables with our prefix, so that no
+        other run reuses or drops them while we're using them
+
+        Every run of a study on a given day gets the same prefix (see
+        `get_temp_table_prefix`), so that a run can resume from the tables a
+        failed run left behind. A run which fails gives up its claim (see
+        `claimed_tables`) but one which is killed can't, so we take over
+        claims more than `run_claim_timeout_hours` old. If the tables are
+        claimed by a run which may still be going then we use a prefix unique
+        to this run instead, and so start from scratch.
+        """
+        if self._claimed:
+            return
+        cursor = self.get_db_connection().cursor()
+        for _ in range(3):
+            if self.create_claim():
+                self._claimed = True
+                return
+            claim = self.get_claim()
+            # The other run may have finished, or given up, in the meantime
+            if claim is None:
+                continue
+            run_id, claimed_at = claim
+            age_hours = (time.time() - claimed_at) / 3600
+            if age_hours < self.run_claim_timeout_hours:
+                break
+            self.log(
+                f"Taking over tables claimed by run {run_id} "
+                f"{age_hours:.1f} hours ago"
+            )
+            cursor.execute(f"DROP TABLE IF EXISTS {self.get_claim_table_name()}")
+        self.log(
+            f"Tables with prefix '{self.temp_table_prefix}' are in use by "
+            f"another run, so using our own"
+        )
+        self.set_temp_table_prefix(f"{self.temp_table_prefix}_{self.run_id}")
+        if not self.create_claim():
+            raise RuntimeError(f"Failed to claim tables for run {self.run_id}")
+        self._claimed = True
+
+    def create_claim(self):
+        """
+        Try to create the table which records that we're using the tables with
+        our prefix, returning False if another run has already done so
+        """
+        cursor = self.get_db_connection().cursor()
+        try:
+            cursor.execute(
+                f"""
+                CREATE TABLE {self.get_claim_table_name()} AS
+                SELECT
+                  CAST({quote(self.run_id)} AS VARCHAR(32)) AS run_id,
+                  CAST({int(time.time())} AS BIGINT) AS claimed_at
+                """
+            )
+        except prestodb.exceptions.PrestoUserError as e:
+            # CREATE TABLE AS is atomic, so only one run can succeed
+            if "already exists" in str(e):
+                return False
+            raise
+        return True
+
+    def get_claim(self):
+        """
+        Return the ID of the run which has claimed the tables with our prefix
+        and when it did so (as a Unix timestamp), or None if no run has
+        """
+        cursor = self.get_db_connection().cursor()
+        try:
+            cursor.execute(
+                f"SELECT run_id, claimed_at FROM {self.get_claim_table_name()}"
+            )
+        except prestodb.exceptions.PrestoUserError as e:
+            if e.error_name == "TABLE_NOT_FOUND":
+                return None
+            raise
+        rows = list(cursor)
+        return tuple(rows[0]) if rows else None
+
+    def owns_claim(self):
+        claim = self.get_claim()
+        return claim is not None and claim[0] == self.run_id
+
+    def release_claim(self):
+        """
+        Give up our claim on the tables with our prefix, leaving the tables
+        themselves for another run to resume from
+        """
+        if not self._claimed:
+            return
+        self._claimed = False
+        try:
+            if self.owns_claim():
+                cursor = self.get_db_connection().cursor()
+                cursor.execute(f"DROP TABLE IF EXISTS {self.get_claim_table_name()}")
+        # We're already handling an error, which is more important than this
+        # one: at worst a later run has to wait for our claim to time out
+        except Exception as e:
+            self.log(f"Failed to release claim on temporary tables: {e}")
+
+    def get_claim_table_name(self):
+        return self.make_temp_table_name(CLAIM_TABLE_SUFFIX)
+
+    def execute_queries_in_parallel(self, queries):
+        """
+        Run `queries` (a list of name, SQL pairs, where the SQL may be a list
+        of statements) concurrently, each over its own connection and with at
+        most `max_parallel_queries` running at once
+
+        None of the queries may depend on another's results. If one of them
+        fails then we cancel any which are still running, don't start any new
+        ones, and re-raise the error.
+        """
+        if not queries:
+            return
+        self.log(
+            f"Running {len(queries)} queries using up to "
+            f"{self.max_parallel_queries} connections"
+        )
+        running_cursors = {}
+        failed = False
+        lock = threading.Lock()
+
+        def execute(n, name, sql):
+            connection = presto_connection_from_url(self.database_url)
+            try:
+                cursor = connection.cursor()
+                with lock:
+                    if failed:
+                        return
+                    running_cursors[n] = cursor
+                self.log(f"Running query: {name}")
+                for statement in get_statements(sql):
+                    cursor.execute(statement)
+            finally:
+                with lock:
+                    running_cursors.pop(n, None)
+                connection.close()
+
+        with concurrent.futures.ThreadPoolExecutor(
+            self.max_parallel_queries
+        ) as executor:
+            futures = [
+                executor.submit(execute, n, name, sql)
+                for n, (name, sql) in enumerate(queries)
+            ]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except Exception:
+                with lock:
+                    failed = True
+                    cursors_to_cancel = list(running_cursors.values())
+                for future in futures:
+                    future.cancel()
+                for cursor in cursors_to_cancel:
+                    self.cancel_query(cursor)
+                raise
+
+    def cancel_query(self, cursor):
+        try:
+            cursor.cancel()
+        except Exception as e:
+            # The query may have finished, or not quite started, in which case
+            # there's nothing to cancel
+            self.log(f"Failed to cancel query: {e}")
+
     def get_output_table_name(self, temporary_database):
         if not temporary_database:
             return
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
-            "%Y%m%d_%H%M%S"
+        return f"{temporary_database}.Output{self.temp_table_prefix}"
+
+    def get_temp_table_prefix(self, queries):
+        """
+        Derive the prefix for our table names from today's date and a hash of
+        the queries which build them (generated with a placeholder prefix) and
+        the organisation hash, so that rerunning an identical study on the
+        same day finds the tables from the previous run
+
+        Including the date means that we never reuse tables (in particular,
+        results) left behind by a failed run on an earlier day, by which time
+        the data may have changed. Concurrent runs of the same study are kept
+        apart by `claim_tables`.
+        """
+        hash_elements = (
+            [sql for statements in self.codelist_tables for sql in statements]
+            + [sql for _, sql in queries]
+            + [os.environ.get("EMIS_ORGANISATION_HASH", "")]
         )
-        return f"{temporary_database}..Output_{timestamp}"
+        query_hash = hashlib.sha1("\n".join(hash_elements).encode("utf8")).hexdigest()
+        date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+        return f"_{date}_{query_hash}"
 
-    def get_temp_table_prefix(self):
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
-            "%Y%m%d_%H%M%S"
+    def replace_temp_table_prefix(self, sql):
+        return sql.replace(
+            f"{TEMP_TABLE_PREFIX_PLACEHOLDER}_", f"{self.temp_table_prefix}_"
         )
-        return f"_{timestamp}_{uuid.uuid4().hex}"
 
     def make_temp_table_name(self, name):
         return f"{self.temp_table_prefix}_{name}"
@@ -222,37 +714,61 @@ class EMISBackend:
         return cols, sql
 
     def create_codelist_table(self, codelist):
-        table_number = len(self.codelist_tables) + 1
-        # We include the current column name for ease of debugging
-        column_name = self._current_column_name or "unknown"
-        # The underscore prefix is our convention to indicate a temporary table
-        # but has no significance for the database
-        table_name = self.make_temp_table_name(f"{table_number}_{column_name}")
-        cast = int if codelist.system in ("snomed", "snomedct") else str
-        organisation_hash = quote(get_organisation_hash())
+        """
+        Return the name of a table holding the codes (and categories, if any)
+        in `codelist`, arranging for it to be created if necessary
+
+        Codelist tables are named after a hash of their contents (see
+        `get_codelist_table_name`) and aren't dropped at the end of the run, so
+        any later column or run which uses the same codelist finds the table
+        already there. Large codelists are loaded in chunks into a staging
+        table, to keep each statement's VALUES list a manageable size, and
+        then copied into place with a single CREATE TABLE AS so that a
+        codelist table which exists is always complete. See `CodelistCache`
+        for how unused tables are eventually dropped.
+        """
+        # Identical codelists are only uploaded once and then shared between
+        # all the queries which use them
+        cache_key = (codelist.system, codelist.has_categories, tuple(codelist))
+        if cache_key in self._codelist_table_names:
+            return self._codelist_table_names[cache_key]
+        if codelist.system in ("snomed", "snomedct"):
+            cast, code_type = int, "bigint"
+        else:
+            cast, code_type = str, "varchar"
         if codelist.has_categories:
-            values = ", ".join(
-                f"({quote(cast(code))}, {quote(category)})"
-                for code, category in codelist
-            )
-            self.codelist_tables.append(
-                f"""
-                    CREATE TABLE {table_name} AS
-                    SELECT code, category, {organisation_hash} AS hashed_organisation FROM (
-                      VALUES {values}
-                    ) AS t (code, category)
-                    """
-            )
+            columns = {"code": code_type, "category": "varchar"}
+            rows = [(cast(code), category) for code, category in codelist]
         else:
-            values = ", ".join(f"({quote(cast(code))})" for code in codelist)
-            self.codelist_tables.append(
-                f"""
-                    CREATE TABLE {table_name} AS
-                    SELECT code, {organisation_hash} AS hashed_organisation FROM (
-                      VALUES {values}
-                    ) AS t (code)
-                    """
+            columns = {"code": code_type}
+            rows = [(cast(code),) for code in codelist]
+        organisation_hash = get_organisation_hash()
+        table_name = get_codelist_table_name(
+            codelist.system, columns, rows, organisation_hash
+        )
+        queries = [
+            codelist_values_query(
+                columns, rows[i : i + CODELIST_CHUNK_SIZE], organisation_hash
             )
+            for i in range(0, len(rows), CODELIST_CHUNK_SIZE)
+        ]
+        if len(queries) == 1:
+            statements = [f"CREATE TABLE {table_name} AS {queries[0]}"]
+        else:
+            # We include the current column name for ease of debugging
+            column_name = self._current_column_name or "unknown"
+            table_number = len(self.codelist_tables) + 1
+            staging_table = self.make_temp_table_name(f"{table_number}_{column_name}")
+            self._codelist_staging_tables.append(staging_table)
+            statements = [
+                f"DROP TABLE IF EXISTS {staging_table}",
+                f"CREATE TABLE {staging_table} AS {queries[0]}",
+                *(f"INSERT INTO {staging_table} {query}" for query in queries[1:]),
+                f"CREATE TABLE {table_name} AS SELECT * FROM {staging_table}",
+                f"DROP TABLE {staging_table}",
+            ]
+        self.codelist_tables.append(statements)
+        self._codelist_table_names[cache_key] = table_name
         return table_name
 
     def patients_age_as_of(self, reference_date):
@@ -1071,19 +1587,114 @@ def truncate_date(column, date_format):
     return f"date_format({column}, '{date_format}')"
 
 
-class UniqueCheck:
-    def __init__(self):
-        self.count = 0
-        self.ids = set()
+def get_codelist_cache(database_url):
+    """
+    Return a `CodelistCache` configured from the environment
+    """
+    return CodelistCache(
+        presto_connection_from_url(database_url),
+        max_age_days=float(os.environ.get("CODELIST_CACHE_MAX_AGE_DAYS") or 30),
+    )
+
+
+class CodelistCache:
+    """
+    Manages the codelist tables which `EMISBackend.create_codelist_table`
+    leaves behind for reuse
+
+    Each table records the date it was created. Tables more than
+    `max_age_days` old are evicted, so that codelists which are no longer used
+    don't hang around for ever (one which is still in use just gets created
+    again on its next run).
+    """
+
+    table_name_re = re.compile(r"^_codelist_[0-9a-f]{40}$")
+
+    def __init__(self, connection, max_age_days):
+        self.connection = connection
+        self.max_age_days = max_age_days
+
+    def entries(self):
+        cursor = self.connection.cursor()
+        cursor.execute("SHOW TABLES LIKE '_codelist_%'")
+        table_names = [
+            row[0] for row in cursor if self.table_name_re.match(row[0].lower())
+        ]
+        today = datetime.date.today()
+        entries = []
+        for table_name in sorted(table_names):
+            cursor.execute(f"SELECT COUNT(*), MIN(created_on) FROM {table_name}")
+            row_count, created_on = list(cursor)[0]
+            if isinstance(created_on, str):
+                created_on = datetime.date.fromisoformat(created_on)
+            expired = (
+                created_on is None or (today - created_on).days > self.max_age_days
+            )
+            entries.append(
+                {
+                    "table_name": table_name,
+                    "row_count": row_count,
+                    "created_on": created_on,
+                    "expired": expired,
+                }
+            )
+        return entries
+
+    def evict(self):
+        return self.drop([entry for entry in self.entries() if entry["expired"]])
+
+    def purge(self):
+        return self.drop(self.entries())
+
+    def drop(self, entries):
+        cursor = self.connection.cursor()
+        for entry in entries:
+            cursor.execute(f"DROP TABLE IF EXISTS {entry['table_name']}")
+        return entries
+
+
+def get_codelist_table_name(system, columns, rows, organisation_hash):
+    key = json.dumps([system, list(columns), rows, organisation_hash])
+    return f"_codelist_{hashlib.sha1(key.encode('utf8')).hexdigest()}"
+
+
+def codelist_values_query(columns, rows, organisation_hash):
+    """
+    Return a query selecting `rows` as a table with the given `columns` (a
+    dict mapping names to types), plus the organisation hash and the date
+    """
+    values = ", ".join(
+        "(" + ", ".join(quote(value) for value in row) + ")" for row in rows
+    )
+    # The explicit casts make every chunk of a codelist produce the same types
+    # (otherwise e.g. string literals are typed by their length)
+    select = ", ".join(
+        f"CAST({name} AS {column_type}) AS {name}"
+        for name, column_type in columns.items()
+    )
+    return f"""
+        SELECT {select}, {quote(organisation_hash)} AS hashed_organisation,
+          current_date AS created_on
+        FROM (
+          VALUES {values}
+        ) AS t ({", ".join(columns)})
+        """
+
+
+def get_statements(sql):
+    return [sql] if isinstance(sql, str) else sql
 
-    def add(self, item):
-        self.count += 1
-        self.ids.add(item)
 
-    def assert_unique_ids(self):
-        duplicates = self.count - len(self.ids)
-        if duplicates != 0:
-            raise RuntimeError(f"Duplicate IDs found ({duplicates} rows)")
+def get_shard_condition(column, num_shards, shard):
+    """
+    Return a condition selecting the rows whose value in `column` hashes to
+    `shard` (counting from zero), for splitting a table into `num_shards`
+    roughly equal parts whatever the distribution of its values
+    """
+    hash_expr = f"from_big_endian_64(xxhash64(to_utf8(CAST({column} AS varchar))))"
+    # MOD takes the sign of the dividend so we need to map negative remainders
+    # into range
+    return f"MOD(MOD({hash_expr}, {num_shards}) + {num_shards}, {num_shards}) = {shard}"
 
 
 def pop_keys_from_dict(dictionary, keys):
@@ -1,4 +1,5 @@
 from datetime import datetime
+import functools
 from scipy.stats import expon
 from scipy.stats import rv_discrete
 from scipy.stats import norm
@@ -8,35 +9,46 @@ import numpy as np
 import os
 
 
-def generate_ages(population, max_age=110):
-    """Generate a population whose ages approximate UK population shape"""
-
+@functools.lru_cache()
+def get_uk_population_bands():
+    """
+    Return the inclusive upper bound of each age band in the UK population,
+    and the population of each band (in thousands)
+    """
+    # From
+    # https://www.ons.gov.uk/peoplepopulationandcommunity/populationandmigration/populationprojections/datasets/tablea21principalprojectionukpopulationinagegroups
     df = pd.read_csv(
-        os.path.join(os.path.dirname(__file__), "uk_population_bands_2018.csv")
+        os.path.join(os.path.dirname(__file__), "uk_population_bands_2018.csv"),
+        thousands=",",
     )
-    # Reshape the dataframe (from
-    # https://www.ons.gov.uk/peoplepopulationandcommunity/populationandmigration/populationprojections/datasets/tablea21principalprojectionukpopulationinagegroups)
-    bands = df["band"].str.split("-").apply(pd.Series)
-    df = df.join(bands)[[0, 1, "range"]]
-    df.columns = ["start", "end", "count"]
-    df["count"] = df["count"].str.replace(",", "").astype("int")
-    ages = pd.DataFrame(np.arange(max_age), columns=["age"])
-    total = df["count"].sum()
-
-    def lookup_age(age):
-        for index, row in df.iterrows():
-            if age <= int(row["end"]):
-                return row["count"]
-
-    # compute a probability for each age
-    ages["p"] = ages.age.apply(lookup_age) / total / 5
+    ends = df["band"].str.split("-").str[1].astype("int").to_numpy()
+    counts = df["range"].to_numpy(dtype="int")
+    return ends, counts
+
+
+@functools.lru_cache()
+def get_age_probabilities(max_age):
+    """
+    Return the probability of each age from 0 to `max_age - 1`, according to
+    the UK population bands
+
+    The result is cached, so it's read-only.
+    """
+    ends, counts = get_uk_population_bands()
+    ages = np.arange(max_age)
+    # Each age gets a fifth of the population of the band it falls in
+    p = counts[np.searchsorted(ends, ages)] / counts.sum() / 5
     # Ensure p adds up to 1 by trimming a large value
-    excess = ages.p.sum() - 1
-    biggest = ages[ages.p == ages.p.max()]
-    ages.loc[biggest.index[0], "p"] -= excess
-    # Generate ages
-    distribution = rv_discrete(name="uk_population", values=(ages.age, ages.p))
-    return distribution.rvs(size=population)
+    p[np.argmax(p)] -= p.sum() - 1
+    p.flags.writeable = False
+    return p
+
+
+def generate_ages(population, max_age=110):
+    """Generate a population whose ages approximate UK population shape"""
+
+    p = get_age_probabilities(max_age)
+    return np.random.choice(max_age, size=population, p=p)
 
 
 def generate_dates(population, earliest_date, latest_date, rate):
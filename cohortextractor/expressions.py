@@ -55,6 +55,14 @@ def format_expression(expression, name_map, empty_value_map):
     return " ".join(token.value for token in tokens)
 
 
+def get_column_references(expression):
+    """
+    Return the set of column names referenced in the supplied expression
+    """
+    tokens = sqlparse.parse(expression)[0].flatten()
+    return {token.value for token in tokens if token.ttype is ttypes.Name}
+
+
 def remap_names(tokens, name_map):
     """
     Takes an iterable of tokens and remaps any names found within using the
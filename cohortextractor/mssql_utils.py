@@ -1,5 +1,12 @@
+import concurrent.futures
 import csv
+import functools
+import itertools
+import json
+import os
+import queue
 import re
+import threading
 import time
 from urllib.parse import urlparse, unquote
 import warnings
@@ -7,6 +14,14 @@ import warnings
 import sqlalchemy
 from sqlalchemy.engine.url import URL
 
+from .output_formats import (
+    ArrowWriter,
+    estimate_row_size,
+    get_compression,
+    join_csv_parts,
+    open_csv_file,
+)
+
 
 # Some drivers warn about the use of features marked "optional" in the DB-ABI
 # spec, using a standardised set of warnings. See:
@@ -85,6 +100,68 @@ def _ctds_connect(ctds, params):
     return ctds.connect(**params)
 
 
+def _get_driver_name(connection):
+    return connection.__class__.__module__.split(".")[0]
+
+
+class BulkInsert(str):
+    """
+    SQL which inserts a set of rows into a table, along with the rows
+    themselves so that they can be loaded using the driver's bulk-loading
+    mechanism instead (see `mssql_bulk_insert`)
+    """
+
+    def __new__(cls, sql, table, columns, rows):
+        obj = super().__new__(cls, sql)
+        obj.table = table
+        obj.columns = columns
+        obj.rows = rows
+        return obj
+
+
+def mssql_bulk_insert(cursor, table, columns, rows):
+    """
+    Load `rows` into `table` using the fastest method the database driver
+    supports: the TDS bulk copy protocol with cTDS and `fast_executemany` with
+    pyODBC. Rows must be tuples of values for `columns` in order.
+
+    Returns False, without loading anything, if the driver isn't one we know
+    how to bulk load with.
+    """
+    # `connection` is an optional DB-API extension, though both the drivers we
+    # support provide it
+    connection = getattr(cursor, "connection", None)
+    driver = _get_driver_name(connection)
+    if driver == "ctds":
+        import ctds
+
+        # cTDS sends Python strings as NVARCHAR which can't be bulk loaded
+        # into VARCHAR columns, so we need to encode them ourselves. All our
+        # VARCHAR columns use Latin1_General collations, whose code page is
+        # 1252 (not ISO-8859-1). Characters outside it are replaced with "?",
+        # as SQL Server does when it converts a string literal itself.
+        rows = [
+            tuple(
+                ctds.SqlVarChar(value.encode("cp1252", errors="replace"))
+                if isinstance(value, str)
+                else value
+                for value in row
+            )
+            for row in rows
+        ]
+        connection.bulk_insert(table, rows)
+    elif driver == "pyodbc":
+        placeholders = ", ".join(["?"] * len(columns))
+        cursor.fast_executemany = True
+        cursor.executemany(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+            rows,
+        )
+    else:
+        return False
+    return True
+
+
 def mssql_sqlalchemy_engine_from_url(url):
     params = mssql_connection_params_from_url(url)
     params["drivername"] = "mssql+pyodbc"
@@ -92,6 +169,18 @@ def mssql_sqlalchemy_engine_from_url(url):
     return sqlalchemy.create_engine(URL(**params))
 
 
+def fetch_batches(cursor, batch_size):
+    """
+    Yield the results of the last query executed on `cursor` in lists of at
+    most `batch_size` rows
+    """
+    while True:
+        batch = cursor.fetchmany(batch_size)
+        if not batch:
+            break
+        yield batch
+
+
 def mssql_table_to_csv(
     filename,
     cursor,
@@ -100,49 +189,451 @@ def mssql_table_to_csv(
     batch_size=2 ** 14,
     retries=2,
     sleep=0.5,
-    row_callback=None,
+    batch_callback=None,
+    connection_factory=None,
+    parallelism=1,
+    checkpoint_filename=None,
+    target_batch_seconds=None,
+    max_batch_bytes=None,
+    log=None,
 ):
     """
-    Download the contents of a table to a CSV file, calling `row_callback` (if
-    defined) on each row as it does so.
+    Download the contents of a table to a CSV file, calling `batch_callback`
+    (if defined) with each list of rows as it does so. Working a batch at a
+    time rather than a row at a time keeps the per-row Python overhead down.
 
     The table must have a unique integer `key_column` which can be used for
     paging the results. For performance reasons this column should be indexed.
 
     Failed requests are automatically retried after a pause of `sleep`,
     assuming `retries` is greater than zero.
+
+    If `parallelism` is greater than one then the range of keys is split into
+    that many parts which are downloaded concurrently, each over its own
+    connection from `connection_factory` (so the table must be visible to
+    other sessions), and then joined together in key order. In this case
+    `batch_callback` is called from several threads, though never concurrently,
+    and not necessarily in key order.
+
+    If `checkpoint_filename` is supplied then after each batch we record
+    there the last key written and the length of the file at that point. If
+    the download fails, calling this function again with the same arguments
+    truncates the file to that length, discarding any partially written rows,
+    and resumes from the next key. The rows already downloaded are passed to
+    `batch_callback` again as they are read back from the file, so as strings
+    except for the key column which is converted back to an int. Checkpoints
+    are only written when downloading over a single connection.
+
+    If `filename` ends in `.gz` or `.zst` the file is compressed accordingly,
+    on a background thread (or, when downloading in parallel, a thread per
+    connection). Compressed downloads can't be resumed so `checkpoint_filename`
+    is ignored.
+
+    Each batch is `batch_size` rows unless `target_batch_seconds` is given, in
+    which case `batch_size` is just the initial size and is adjusted between
+    batches, see `BatchSizer`. Changes in batch size and overall download
+    rates are reported to `log` (if defined).
     """
-    if row_callback is None:
-        row_callback = lambda x: None
+    if batch_callback is None:
+        batch_callback = lambda x: None
+    new_batch_sizer = functools.partial(
+        BatchSizer,
+        batch_size,
+        target_seconds=target_batch_seconds,
+        max_bytes=max_batch_bytes,
+        log=log,
+    )
 
-    def fetch_batch(min_key=None):
-        return _fetch_batch_with_retries(
-            cursor, table, key_column, batch_size, min_key, retries, sleep
+    compression = get_compression(filename)
+    if compression is not None:
+        checkpoint_filename = None
+
+    checkpoint = None
+    if checkpoint_filename is not None:
+        checkpoint = _read_checkpoint(checkpoint_filename, filename, table)
+
+    if parallelism > 1 and connection_factory is not None and checkpoint is None:
+        _mssql_table_to_csv_in_parallel(
+            filename,
+            cursor,
+            table,
+            key_column,
+            new_batch_sizer,
+            retries,
+            sleep,
+            batch_callback,
+            connection_factory,
+            parallelism,
         )
+        return
+
+    if checkpoint is not None:
+        after_key = checkpoint["last_key"]
+        with open(filename, "r+b") as f:
+            f.truncate(checkpoint["length"])
+        with open(filename, newline="") as f:
+            reader = csv.reader(f)
+            key_column_index = next(reader).index(key_column)
+            while True:
+                rows = list(itertools.islice(reader, batch_size))
+                if not rows:
+                    break
+                for row in rows:
+                    row[key_column_index] = int(row[key_column_index])
+                batch_callback(rows)
+        csvfile = open(filename, "a", newline="")
+    else:
+        after_key = None
+        csvfile = open_csv_file(filename, "w")
 
-    with open(filename, "w", newline="") as csvfile:
+    with csvfile:
         writer = csv.writer(csvfile)
-        result_batch = fetch_batch()
-        headers = [x[0] for x in cursor.description]
-        writer.writerow(headers)
+
+        def save_checkpoint(last_key):
+            csvfile.flush()
+            _write_checkpoint(
+                checkpoint_filename,
+                {
+                    "table": table,
+                    "last_key": last_key,
+                    "length": os.fstat(csvfile.fileno()).st_size,
+                },
+            )
+
+        _write_key_range(
+            writer,
+            cursor,
+            table,
+            key_column,
+            new_batch_sizer(),
+            retries,
+            sleep,
+            batch_callback,
+            after_key=after_key,
+            write_headers=checkpoint is None,
+            checkpoint_callback=save_checkpoint if checkpoint_filename else None,
+        )
+
+
+def mssql_table_to_arrow(
+    filename,
+    cursor,
+    table,
+    key_column,
+    output_format,
+    column_types,
+    batch_size=2 ** 14,
+    retries=2,
+    sleep=0.5,
+    batch_callback=None,
+    target_batch_seconds=None,
+    max_batch_bytes=None,
+    log=None,
+):
+    """
+    Download the contents of a table to a Parquet or Feather file, converting
+    each column to the type given in `column_types`, and otherwise behaving as
+    `mssql_table_to_csv` does. Downloads always run over a single connection
+    and can't be resumed.
+    """
+    if batch_callback is None:
+        batch_callback = lambda x: None
+    batch_sizer = BatchSizer(
+        batch_size,
+        target_seconds=target_batch_seconds,
+        max_bytes=max_batch_bytes,
+        log=log,
+    )
+    with ArrowWriter(filename, output_format, column_types) as writer:
+        _write_key_range(
+            writer,
+            cursor,
+            table,
+            key_column,
+            batch_sizer,
+            retries,
+            sleep,
+            batch_callback,
+            write_headers=True,
+        )
+
+
+def _read_checkpoint(checkpoint_filename, filename, table):
+    """
+    Return the checkpoint for a previous download of `table` into `filename`,
+    or None if there isn't one or the file doesn't match it
+    """
+    try:
+        with open(checkpoint_filename) as f:
+            checkpoint = json.load(f)
+        with open(filename, "rb") as f:
+            # The last byte before the checkpointed length should be the end of
+            # the last complete row
+            f.seek(checkpoint["length"] - 1)
+            last_byte = f.read(1)
+    except (OSError, ValueError, KeyError):
+        return None
+    if checkpoint["table"] != table or last_byte != b"\n":
+        return None
+    return checkpoint
+
+
+def _write_checkpoint(checkpoint_filename, checkpoint):
+    # Write then rename, so the checkpoint is never left half-written
+    temp_filename = f"{checkpoint_filename}.tmp"
+    with open(temp_filename, "w") as f:
+        json.dump(checkpoint, f)
+    os.replace(temp_filename, checkpoint_filename)
+
+
+def _mssql_table_to_csv_in_parallel(
+    filename,
+    cursor,
+    table,
+    key_column,
+    new_batch_sizer,
+    retries,
+    sleep,
+    batch_callback,
+    connection_factory,
+    parallelism,
+):
+    cursor.execute(f"SELECT MIN({key_column}), MAX({key_column}) FROM {table}")
+    min_key, max_key = cursor.fetchall()[0]
+    cursor.execute(f"SELECT TOP 0 * FROM {table}")
+    cursor.fetchall()
+    headers = [x[0] for x in cursor.description]
+    # Each range is specified by an exclusive lower bound and an inclusive
+    # upper bound. We assume keys are roughly evenly distributed.
+    if min_key is None:
+        key_ranges = []
+    else:
+        size = max_key - min_key + 1
+        bounds = [min_key - 1 + (size * i) // parallelism for i in range(parallelism)]
+        bounds.append(max_key)
+        key_ranges = [(lo, hi) for (lo, hi) in zip(bounds, bounds[1:]) if hi > lo]
+    part_filenames = [f"{filename}.part{n}" for n in range(len(key_ranges))]
+    compression = get_compression(filename)
+    lock = threading.Lock()
+
+    def locked_batch_callback(rows):
+        with lock:
+            batch_callback(rows)
+
+    def download_range(n):
+        after_key, up_to_key = key_ranges[n]
+        connection = connection_factory()
+        try:
+            with open_csv_file(part_filenames[n], "w", compression) as csvfile:
+                _write_key_range(
+                    csv.writer(csvfile),
+                    connection.cursor(),
+                    table,
+                    key_column,
+                    new_batch_sizer(),
+                    retries,
+                    sleep,
+                    locked_batch_callback,
+                    after_key=after_key,
+                    up_to_key=up_to_key,
+                )
+        finally:
+            connection.close()
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(parallelism) as executor:
+            futures = [
+                executor.submit(download_range, n) for n in range(len(key_ranges))
+            ]
+            for future in futures:
+                future.result()
+        join_csv_parts(filename, headers, part_filenames)
+    finally:
+        for part_filename in part_filenames:
+            if os.path.exists(part_filename):
+                os.unlink(part_filename)
+
+
+def _write_key_range(
+    writer,
+    cursor,
+    table,
+    key_column,
+    batch_sizer,
+    retries,
+    sleep,
+    batch_callback,
+    after_key=None,
+    up_to_key=None,
+    write_headers=False,
+    checkpoint_callback=None,
+    max_queued=1,
+):
+    """
+    Write all the rows with keys greater than `after_key` and no greater than
+    `up_to_key` (where defined) to `writer`, in key order, fetching as many rows
+    at a time as `batch_sizer` says. Each batch is written with a single call
+    to `writer.writerows()` and then passed to `batch_callback`, after which
+    `checkpoint_callback` (if defined) is called with the last key written.
+
+    Batches are fetched on a background thread so that we can be waiting for
+    the next batch from the server while we write out the current one. At
+    most `max_queued` batches are held waiting to be written.
+    """
+    batches = queue.Queue(max_queued)
+    stopped = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has stopped, rather than blocking forever
+        while not stopped.is_set():
+            try:
+                batches.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def get():
+        item = batches.get()
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def fetch_range_batches():
+        try:
+            min_key = after_key
+            key_column_index = None
+            while not stopped.is_set():
+                batch_size = batch_sizer.size
+                start = time.monotonic()
+                result_batch = _fetch_batch_with_retries(
+                    cursor,
+                    table,
+                    key_column,
+                    batch_size,
+                    min_key,
+                    up_to_key,
+                    retries,
+                    sleep,
+                )
+                batch_sizer.record(result_batch, batch_size, time.monotonic() - start)
+                if key_column_index is None:
+                    headers = [x[0] for x in cursor.description]
+                    key_column_index = headers.index(key_column)
+                    put(headers)
+                put(result_batch)
+                if len(result_batch) < batch_size:
+                    break
+                min_key = result_batch[-1][key_column_index]
+            put(None)
+        except Exception as e:
+            put(e)
+
+    fetcher = threading.Thread(target=fetch_range_batches, daemon=True)
+    fetcher.start()
+    try:
+        headers = get()
+        if write_headers:
+            writer.writerow(headers)
         key_column_index = headers.index(key_column)
-        for row in result_batch:
-            writer.writerow(row)
-            row_callback(row)
-        while len(result_batch) == batch_size:
-            min_key = result_batch[-1][key_column_index]
-            result_batch = fetch_batch(min_key)
-            for row in result_batch:
-                writer.writerow(row)
-                row_callback(row)
+        while True:
+            result_batch = get()
+            if result_batch is None:
+                break
+            if not result_batch:
+                continue
+            writer.writerows(result_batch)
+            batch_callback(result_batch)
+            if checkpoint_callback:
+                checkpoint_callback(result_batch[-1][key_column_index])
+    finally:
+        # Make sure the cursor is no longer in use before we return
+        stopped.set()
+        fetcher.join()
+    batch_sizer.log_summary()
+
+
+class BatchSizer:
+    """
+    Decides how many rows to fetch in each batch of a download
+
+    With no `target_seconds` this is always `initial_size`. Otherwise, after
+    each full batch we estimate how many rows we could fetch in
+    `target_seconds` at the rate we've just seen, and adjust towards that:
+    large batches amortise the cost of each round trip, but are slower to
+    retry and use more memory, and the right size depends on how wide the
+    rows are and how busy the server is. Each adjustment is limited to a
+    factor of two, and small changes are ignored so that noise in the timings
+    doesn't cause constant resizing. If `max_bytes` is given we also keep
+    batches small enough that their rows should take up no more than that
+    much memory (as estimated from the first row in the batch).
+    """
+
+    # Relative changes in size smaller than this aren't worth making
+    TOLERANCE = 1.25
+
+    def __init__(
+        self, initial_size, target_seconds=None, max_bytes=None, min_size=100, log=None
+    ):
+        self.size = initial_size
+        self.target_seconds = target_seconds
+        self.max_bytes = max_bytes
+        self.min_size = min(min_size, initial_size)
+        self.log = log
+        self.sizes = set()
+        self.total_rows = 0
+        self.total_seconds = 0.0
+
+    def record(self, batch, batch_size, seconds):
+        self.sizes.add(batch_size)
+        self.total_rows += len(batch)
+        self.total_seconds += seconds
+        # A short batch is the last one, and tells us nothing about the rate
+        if not self.target_seconds or len(batch) < batch_size:
+            return
+        rows_per_second = len(batch) / max(seconds, 0.001)
+        new_size = rows_per_second * self.target_seconds
+        new_size = min(max(new_size, batch_size / 2), batch_size * 2)
+        if max(new_size / batch_size, batch_size / new_size) < self.TOLERANCE:
+            new_size = batch_size
+        if self.max_bytes:
+            new_size = min(new_size, self.max_bytes / estimate_row_size(batch[0]))
+        new_size = max(int(new_size), self.min_size)
+        if new_size == batch_size:
+            return
+        self.size = new_size
+        if self.log:
+            self.log(
+                f"Changed batch size from {batch_size} to {new_size} rows "
+                f"({rows_per_second:.0f} rows/s)"
+            )
+
+    def log_summary(self):
+        if not self.log or not self.total_rows:
+            return
+        rows_per_second = self.total_rows / max(self.total_seconds, 0.001)
+        sizes = sorted(self.sizes)
+        if len(sizes) > 1:
+            sizes = f"between {sizes[0]} and {sizes[-1]}"
+        else:
+            sizes = f"of {sizes[0]}"
+        self.log(
+            f"Fetched {self.total_rows} rows in batches {sizes} rows "
+            f"({rows_per_second:.0f} rows/s)"
+        )
 
 
 def _fetch_batch_with_retries(
-    cursor, table, key_column, batch_size, min_key, retries, sleep
+    cursor, table, key_column, batch_size, min_key, max_key, retries, sleep
 ):
+    conditions = []
     if min_key is not None:
         assert isinstance(min_key, int)
-        where = f"WHERE {key_column} > {min_key}"
+        conditions.append(f"{key_column} > {min_key}")
+    if max_key is not None:
+        assert isinstance(max_key, int)
+        conditions.append(f"{key_column} <= {max_key}")
+    if conditions:
+        where = "WHERE " + " AND ".join(conditions)
     else:
         where = ""
     query = f"SELECT TOP {batch_size} * FROM {table} {where} ORDER BY {key_column}"
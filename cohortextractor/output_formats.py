@@ -0,0 +1,514 @@
+"""
+Support for writing extracted cohorts in formats other than CSV
+
+As well as CSV we can write Parquet and Feather (i.e. Arrow IPC) files, whose
+columns are typed according to the study definition, so that they can be
+loaded without re-parsing every value. These formats require the optional
+`pyarrow` package.
+
+CSV files can also be compressed with gzip or (given the optional `zstandard`
+package) zstd. The format of a file is determined by its extension.
+"""
+import contextlib
+import csv
+import datetime
+import glob
+import gzip
+import io
+import os
+import queue
+import shutil
+import sys
+import threading
+import zlib
+
+
+OUTPUT_FORMATS = ("csv", "parquet", "feather")
+
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd"}
+
+# All the extensions we write, in order of preference when looking for files
+OUTPUT_EXTENSIONS = ("csv", "csv.gz", "csv.zst", "parquet", "feather")
+
+
+def get_output_format(filename):
+    root, extension = os.path.splitext(filename)
+    if extension.lower() in COMPRESSIONS:
+        root, extension = os.path.splitext(root)
+        if extension.lower() in (".parquet", ".feather"):
+            raise ValueError(f"Only CSV files can be compressed: {filename}")
+    extension = extension.lstrip(".").lower()
+    if extension in OUTPUT_FORMATS:
+        return extension
+    return "csv"
+
+
+def get_compression(filename):
+    extension = os.path.splitext(filename)[1].lower()
+    return COMPRESSIONS.get(extension)
+
+
+def find_output_file(path_without_extension):
+    """
+    Return the file at `path_without_extension` plus whichever extension
+    exists (checking each output format in turn), defaulting to CSV
+    """
+    for extension in OUTPUT_EXTENSIONS:
+        filename = f"{path_without_extension}.{extension}"
+        if os.path.exists(filename):
+            return filename
+    return f"{path_without_extension}.csv"
+
+
+def glob_output_files(pattern_without_extension):
+    filenames = []
+    for extension in OUTPUT_EXTENSIONS:
+        filenames.extend(glob.glob(f"{pattern_without_extension}.{extension}"))
+    return filenames
+
+
+def get_column_types(covariate_definitions):
+    """
+    Map the name of each column in a study's output to its column type
+    """
+    column_types = {"patient_id": "int"}
+    for name, (query_type, query_args) in covariate_definitions.items():
+        column_types[name] = query_args["column_type"]
+    return column_types
+
+
+@contextlib.contextmanager
+def open_output_writer(filename, column_types):
+    """
+    Open `filename` for writing in the format given by its extension and return
+    an object with the same interface as `csv.writer`
+    """
+    output_format = get_output_format(filename)
+    if output_format == "csv":
+        with open_csv_file(filename, "w") as csvfile:
+            yield csv.writer(csvfile)
+    else:
+        with ArrowWriter(filename, output_format, column_types) as writer:
+            yield writer
+
+
+def open_csv_file(filename, mode="r", compression="infer"):
+    """
+    Open a CSV file in text mode, compressing or decompressing it according to
+    its extension (unless `compression` is given explicitly)
+
+    When writing, compression happens on a background thread so that the
+    caller can get on with producing the next rows. A compressed file can be
+    appended to by concatenating another file compressed the same way: gzip
+    files may consist of several members, and zstd files of several frames.
+    """
+    if compression == "infer":
+        compression = get_compression(filename)
+    if compression is None:
+        return open(filename, mode, newline="")
+    if mode == "r":
+        if compression == "gzip":
+            return gzip.open(filename, "rt", newline="")
+        zstandard = import_zstandard()
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(filename, "rb"), read_across_frames=True, closefd=True
+        )
+        return io.TextIOWrapper(io.BufferedReader(reader), newline="")
+    elif mode == "w":
+        return io.TextIOWrapper(
+            io.BufferedWriter(CompressingWriter(filename, compression), 2 ** 20),
+            newline="",
+        )
+    else:
+        raise ValueError(f"Unsupported mode for compressed files: {mode}")
+
+
+def join_csv_parts(filename, headers, part_filenames):
+    """
+    Write a CSV file consisting of `headers` followed by the contents of each
+    of `part_filenames` in turn
+
+    Each part must have been written by `open_csv_file` with the same
+    compression as `filename`. Compressed streams can be concatenated (the
+    result decompresses to the concatenation of their contents) so we can
+    join the parts without decompressing them.
+    """
+    with open_csv_file(filename, "w") as csvfile:
+        csv.writer(csvfile).writerow(headers)
+    with open(filename, "ab") as output:
+        for part_filename in part_filenames:
+            with open(part_filename, "rb") as part:
+                shutil.copyfileobj(part, output)
+
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError(
+            "Reading or writing zstd files requires the `zstandard` package:\n"
+            "    pip install zstandard"
+        )
+    return zstandard
+
+
+class CompressingWriter(io.RawIOBase):
+    """
+    A binary file which compresses everything written to it on a background
+    thread, queueing up to `max_queued` chunks of data before writes block
+    """
+
+    def __init__(self, filename, compression, max_queued=8):
+        if compression == "gzip":
+            # This `wbits` value gives us a gzip header and trailer
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compression == "zstd":
+            self.compressor = import_zstandard().ZstdCompressor().compressobj()
+        else:
+            raise ValueError(f"Unknown compression: {compression}")
+        self.file = open(filename, "wb")
+        self.queue = queue.Queue(max_queued)
+        self.error = None
+        self.thread = threading.Thread(target=self.compress_chunks, daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.raise_any_error()
+        self.queue.put(bytes(data))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.queue.put(None)
+            self.thread.join()
+            self.file.close()
+            super().close()
+        self.raise_any_error()
+
+    def raise_any_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def compress_chunks(self):
+        data = b""
+        try:
+            while True:
+                data = self.queue.get()
+                if data is None:
+                    break
+                self.file.write(self.compressor.compress(data))
+            self.file.write(self.compressor.flush())
+        except Exception as e:
+            self.error = e
+            # Keep consuming chunks so the writer isn't left blocked on a full
+            # queue; the error will be raised on its next write
+            while data is not None:
+                data = self.queue.get()
+
+
+def read_dataframe(filename, columns=None):
+    """
+    Load a Parquet or Feather file written by `ArrowWriter` into a Pandas
+    dataframe
+    """
+    import pandas
+
+    output_format = get_output_format(filename)
+    if output_format == "parquet":
+        return pandas.read_parquet(filename, columns=columns)
+    elif output_format == "feather":
+        return pandas.read_feather(filename, columns=columns)
+    else:
+        raise ValueError(f"Not a Parquet or Feather file: {filename}")
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError(
+            "Writing Parquet or Feather files requires the `pyarrow` package:\n"
+            "    pip install pyarrow"
+        )
+    return pyarrow
+
+
+class ArrowWriter:
+    """
+    Writes rows to a Parquet or Feather file, with the same interface as
+    `csv.writer`: the first row written must be the column headers.
+
+    Each value is converted to the Arrow type corresponding to the column type
+    given in `column_types` (str for any column not listed). Rows are buffered
+    and written out `row_group_size` at a time as a Parquet row group or an
+    Arrow record batch, so memory use doesn't grow with the size of the file.
+    """
+
+    def __init__(self, filename, output_format, column_types, row_group_size=2 ** 16):
+        self.pyarrow = import_pyarrow()
+        self.filename = filename
+        self.output_format = output_format
+        self.column_types = column_types
+        self.row_group_size = row_group_size
+        self.writer = None
+        self.sink = None
+        self.headers = None
+        self.rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def writerow(self, row):
+        if self.headers is None:
+            self.open(list(row))
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def writerows(self, rows):
+        rows = iter(rows)
+        if self.headers is None:
+            headers = next(rows, None)
+            if headers is None:
+                return
+            self.open(list(headers))
+        self.rows.extend(rows)
+        while len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def open(self, headers):
+        pa = self.pyarrow
+        self.headers = headers
+        self.batch_builder = RecordBatchBuilder(pa, headers, self.column_types)
+        schema = self.batch_builder.schema
+        if self.output_format == "parquet":
+            self.writer = pa.parquet.ParquetWriter(self.filename, schema)
+        elif self.output_format == "feather":
+            self.sink = pa.OSFile(str(self.filename), "wb")
+            self.writer = pa.ipc.new_file(
+                self.sink,
+                schema,
+                options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True),
+            )
+        else:
+            raise ValueError(f"Unknown output format: {self.output_format}")
+
+    def flush(self):
+        if not self.rows:
+            return
+        pa = self.pyarrow
+        rows = self.rows[: self.row_group_size]
+        self.rows = self.rows[self.row_group_size :]
+        batch = self.batch_builder.build(rows)
+        if self.output_format == "parquet":
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        if self.writer is None:
+            return
+        self.flush()
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+class RecordBatchBuilder:
+    """
+    Converts batches of rows with the given `headers` into Arrow record
+    batches, with each column typed according to `column_types` (str for any
+    column not listed)
+    """
+
+    def __init__(self, pa, headers, column_types):
+        self.pyarrow = pa
+        types = [column_types.get(name, "str") for name in headers]
+        self.converters = [CONVERTERS[column_type] for column_type in types]
+        self.schema = pa.schema(
+            [
+                (name, get_arrow_type(pa, column_type))
+                for name, column_type in zip(headers, types)
+            ]
+        )
+        # String columns are dictionary encoded. Arrow IPC files only allow a
+        # single dictionary per column, which can be extended but not
+        # replaced, so we keep a dictionary for each column which grows as we
+        # go and emit the additions with each batch
+        self.dictionaries = [{} if t == "str" else None for t in types]
+
+    def build(self, rows):
+        pa = self.pyarrow
+        arrays = []
+        for n, (field, convert, dictionary) in enumerate(
+            zip(self.schema, self.converters, self.dictionaries)
+        ):
+            values = [convert(row[n]) for row in rows]
+            if dictionary is None:
+                arrays.append(pa.array(values, type=field.type))
+            else:
+                indices = [
+                    None
+                    if value is None
+                    else dictionary.setdefault(value, len(dictionary))
+                    for value in values
+                ]
+                arrays.append(
+                    pa.DictionaryArray.from_arrays(
+                        pa.array(indices, type=pa.int32()),
+                        pa.array(list(dictionary), type=pa.string()),
+                    )
+                )
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+
+def estimate_row_size(row):
+    """
+    Roughly how much memory `row` (a tuple of values as fetched from the
+    database) takes up, in bytes
+    """
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+def batches_to_arrow(headers, batches, column_types):
+    """
+    Build an Arrow table from an iterable of batches of rows with the given
+    `headers`, typing each column according to `column_types`
+    """
+    pa = import_pyarrow()
+    builder = RecordBatchBuilder(pa, headers, column_types)
+    record_batches = [builder.build(rows) for rows in batches if rows]
+    return pa.Table.from_batches(record_batches, schema=builder.schema)
+
+
+def batches_to_dataframe(headers, batches, column_types, pandas_csv_args):
+    """
+    Build a Pandas dataframe from an iterable of batches of rows with the given
+    `headers`, giving each column the type that `StudyDefinition.csv_to_df()`
+    would (as specified by `pandas_csv_args`, or `column_types` for columns
+    not listed there)
+
+    Each batch is converted to typed columns as it arrives, so we never hold
+    more than one batch of rows as Python objects.
+    """
+    import pandas
+    from pandas.api.types import union_categoricals
+
+    dtypes = pandas_csv_args["dtype"]
+    parse_dates = set(pandas_csv_args["parse_dates"])
+    kinds = []
+    for name in headers:
+        column_type = column_types.get(name, "str")
+        if name == "patient_id":
+            kinds.append("patient_id")
+        elif name in parse_dates:
+            kinds.append("date")
+        elif dtypes.get(name) == "category" or column_type == "str":
+            kinds.append("category")
+        else:
+            kinds.append(column_type)
+    converters = [
+        CONVERTERS["date" if kind == "date" else column_types.get(name, "str")]
+        for name, kind in zip(headers, kinds)
+    ]
+    chunks = [[] for _ in headers]
+    for rows in batches:
+        if not rows:
+            continue
+        for n, (kind, convert) in enumerate(zip(kinds, converters)):
+            values = [convert(row[n]) for row in rows]
+            chunks[n].append(make_typed_column(pandas, kind, values))
+    columns = {}
+    for name, kind, column_chunks in zip(headers, kinds, chunks):
+        if not column_chunks:
+            column = make_typed_column(pandas, kind, [])
+        elif kind == "category":
+            column = union_categoricals(column_chunks, sort_categories=True)
+        else:
+            column = pandas.concat(column_chunks, ignore_index=True)
+        columns[name] = column
+    return pandas.DataFrame(columns)
+
+
+def make_typed_column(pandas, kind, values):
+    if kind == "category":
+        return pandas.Categorical(values)
+    elif kind == "date":
+        return pandas.to_datetime(pandas.Series(values, dtype=object))
+    elif kind == "patient_id":
+        return pandas.Series(values, dtype="int64")
+    elif kind == "int":
+        return pandas.Series(values, dtype="Int64")
+    elif kind == "float":
+        return pandas.Series(values, dtype="float64")
+    elif kind == "bool":
+        return pandas.Series(values, dtype="bool")
+    else:
+        raise ValueError(f"Unknown column type: {kind}")
+
+
+def get_arrow_type(pa, column_type):
+    if column_type == "str":
+        return pa.dictionary(pa.int32(), pa.string())
+    return {
+        "int": pa.int64(),
+        "float": pa.float64(),
+        "bool": pa.bool_(),
+        "date": pa.date32(),
+    }[column_type]
+
+
+def is_missing(value):
+    # Pandas represents missing values in dummy data as NaN
+    return value is None or value == "" or value != value
+
+
+def to_int(value):
+    return None if is_missing(value) else int(value)
+
+
+def to_float(value):
+    return None if is_missing(value) else float(value)
+
+
+def to_bool(value):
+    # Matches the way we interpret boolean columns in CSV files, see
+    # `StudyDefinition.get_pandas_csv_args()`
+    return not (is_missing(value) or value == 0 or value == "0")
+
+
+def to_date(value):
+    if is_missing(value):
+        return None
+    if isinstance(value, datetime.date):
+        return value
+    # Dates truncated to the year or month are stored as the first day of that
+    # period
+    if len(value) == 4:
+        value += "-01-01"
+    elif len(value) == 7:
+        value += "-01"
+    return datetime.date.fromisoformat(value[:10])
+
+
+def to_str(value):
+    return None if is_missing(value) else str(value)
+
+
+CONVERTERS = {
+    "int": to_int,
+    "float": to_float,
+    "bool": to_bool,
+    "date": to_date,
+    "str": to_str,
+}
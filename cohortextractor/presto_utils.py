@@ -1,9 +1,14 @@
+import collections
+import itertools
+import threading
 import time
 from urllib.parse import urlparse, unquote
 
 import prestodb
 import requests
 
+from .output_formats import estimate_row_size
+
 
 def presto_connection_from_url(url):
     return ConnectionProxy(
@@ -61,6 +66,19 @@ def wait_for_presto_to_be_ready(url, test_query, timeout):
                 raise
 
 
+def fetch_batches(cursor, batch_size):
+    """
+    Yield the results of the last query executed on `cursor` in lists of at
+    most `batch_size` rows
+    """
+    rows = iter(cursor)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
 class ConnectionProxy:
     """Proxy for prestodb.dbapi.Connection, with a more useful cursor."""
 
@@ -72,10 +90,10 @@ class ConnectionProxy:
 
         return getattr(self.connection, attr)
 
-    def cursor(self):
-        """Return a proxied cursor."""
+    def cursor(self, **kwargs):
+        """Return a proxied cursor, passing any arguments to CursorProxy."""
 
-        return CursorProxy(self.connection.cursor())
+        return CursorProxy(self.connection.cursor(), **kwargs)
 
 
 class CursorProxy:
@@ -86,23 +104,27 @@ class CursorProxy:
     * any exceptions caused by an invalid query are raised by .execute() (and
       not later when you fetch the results)
     * the .description attribute is set immediately after calling .execute()
-    * you can iterate over it to yield rows
+    * you can iterate over it to yield rows, which are fetched on a background
+      thread so that Presto can carry on paging results while we process them
     * .fetchone()/.fetchmany()/.fetchall() are disabled (they are not currently
       used by EMISBackend, although they could be implemented if required)
     """
 
     _rows = None
+    _prefetcher = None
 
-    def __init__(self, cursor, batch_size=10 ** 6):
+    def __init__(self, cursor, batch_size=10 ** 4, max_buffered_bytes=2 ** 28):
         """Initialise proxy.
 
         cursor: the presto.dbapi.Cursor to be proxied
-        batch_size: the number of records to fetch at a time (this will need to
-            be tuned)
+        batch_size: the number of records to fetch at a time
+        max_buffered_bytes: roughly how much memory the records fetched ahead
+            of the iterator may use
         """
 
         self.cursor = cursor
         self.batch_size = batch_size
+        self.max_buffered_bytes = max_buffered_bytes
 
     def __getattr__(self, attr):
         """Pass any unhandled attribute lookups to proxied cursor."""
@@ -118,15 +140,38 @@ class CursorProxy:
         * populates the .description attribute of the cursor
         """
 
+        self.stop_prefetching()
         self.cursor.execute(*args, **kwargs)
         self._rows = self.cursor.fetchmany()
 
     def __iter__(self):
         """Iterate over results."""
 
-        while self._rows:
-            yield from iter(self._rows)
-            self._rows = self.cursor.fetchmany(self.batch_size)
+        if not self._rows:
+            return
+        rows, self._rows = self._rows, None
+        # The batch fetched by `execute()` goes through the prefetcher too, so
+        # that it's included in the fetch summary
+        self._prefetcher = Prefetcher(
+            lambda: self.cursor.fetchmany(self.batch_size),
+            self.max_buffered_bytes,
+            first_batch=rows,
+        )
+        try:
+            for batch in self._prefetcher:
+                yield from batch
+        finally:
+            self.stop_prefetching()
+
+    def stop_prefetching(self):
+        if self._prefetcher:
+            self._prefetcher.stop()
+
+    def get_fetch_summary(self):
+        """Describe how quickly the results of the last query were fetched."""
+
+        if self._prefetcher:
+            return self._prefetcher.get_summary()
 
     def fetchone(self):
         raise RuntimeError("Iterate over cursor to get results")
@@ -136,3 +181,103 @@ class CursorProxy:
 
     def fetchall(self):
         raise RuntimeError("Iterate over cursor to get results")
+
+
+class Prefetcher:
+    """
+    Calls `fetch()` on a background thread until it returns an empty batch,
+    queueing up the batches (after `first_batch`, if given) for iteration
+
+    Fetching pauses while the batches waiting in the queue are estimated to
+    take up more than `max_buffered_bytes`, though there's always room for one.
+    We keep count of how often, and for how long, the iterator had to wait for
+    the next batch: if that's a large part of the total time then the
+    bottleneck is the server, otherwise it's whatever is consuming the rows.
+    """
+
+    def __init__(self, fetch, max_buffered_bytes, first_batch=None):
+        self.fetch = fetch
+        self.max_buffered_bytes = max_buffered_bytes
+        self.batches = collections.deque()
+        self.buffered_bytes = 0
+        if first_batch:
+            size = estimate_row_size(first_batch[0]) * len(first_batch)
+            self.batches.append((first_batch, size))
+            self.buffered_bytes += size
+        self.condition = threading.Condition()
+        self.done = False
+        self.stopped = False
+        self.error = None
+        self.rows = 0
+        self.stalls = 0
+        self.stall_seconds = 0.0
+        self.start_time = time.monotonic()
+        self.end_time = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            while True:
+                batch = self.fetch()
+                size = estimate_row_size(batch[0]) * len(batch) if batch else 0
+                with self.condition:
+                    while (
+                        self.batches
+                        and self.buffered_bytes + size > self.max_buffered_bytes
+                        and not self.stopped
+                    ):
+                        self.condition.wait()
+                    if self.stopped:
+                        return
+                    if batch:
+                        self.batches.append((batch, size))
+                        self.buffered_bytes += size
+                    else:
+                        self.done = True
+                    self.condition.notify_all()
+                if not batch:
+                    return
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.done = True
+                self.condition.notify_all()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                if not self.batches and not self.done:
+                    self.stalls += 1
+                    start = time.monotonic()
+                    while not self.batches and not self.done:
+                        self.condition.wait()
+                    self.stall_seconds += time.monotonic() - start
+                if self.batches:
+                    batch, size = self.batches.popleft()
+                    self.buffered_bytes -= size
+                    self.condition.notify_all()
+                elif self.error:
+                    raise self.error
+                else:
+                    self.end_time = time.monotonic()
+                    return
+            self.rows += len(batch)
+            yield batch
+
+    def stop(self):
+        """Stop fetching and wait for any fetch in progress to finish."""
+
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def get_summary(self):
+        duration = (self.end_time or time.monotonic()) - self.start_time
+        rate = self.rows / duration if duration else 0
+        return (
+            f"Fetched {self.rows} rows in {duration:.1f}s ({rate:.0f} rows/s), "
+            f"waiting {self.stall_seconds:.1f}s for results on "
+            f"{self.stalls} occasions"
+        )
@@ -0,0 +1,8 @@
+def canonicalise_sql(sql):
+    """
+    Strip the indentation and blank lines from a query so that queries which
+    differ only in their formatting compare equal. Newlines can't appear inside
+    quoted values so this never changes the meaning of the query.
+    """
+    lines = [line.strip() for line in sql.splitlines()]
+    return "\n".join(line for line in lines if line)
@@ -5,6 +5,17 @@ import os
 import pandas as pd
 
 from .expectation_generators import generate
+from .output_formats import (
+    batches_to_arrow,
+    batches_to_dataframe,
+    get_column_types,
+    get_output_format,
+    import_pyarrow,
+    open_csv_file,
+    open_output_writer,
+    read_dataframe,
+)
+from .unique_check import UniqueCheck, assert_no_duplicates
 from .process_covariate_definitions import process_covariate_definitions
 from .date_expressions import (
     evaluate_date_expressions_in_covariate_definitions,
@@ -72,18 +83,69 @@ class StudyDefinition:
             # term, we don't plan to include this in the output
             df = df.reset_index()
             df = df.rename(columns={"index": "patient_id"})
-            df.to_csv(filename, index=False)
+            if get_output_format(filename) == "csv":
+                with open_csv_file(filename, "w") as csvfile:
+                    df.to_csv(csvfile, index=False)
+            else:
+                column_types = get_column_types(self.covariate_definitions)
+                with open_output_writer(filename, column_types) as writer:
+                    writer.writerow(df.columns)
+                    writer.writerows(df.itertuples(index=False))
         else:
             self.assert_backend_is_configured()
             self.backend.to_csv(filename, **kwargs)
 
+    def to_csvs_for_index_dates(self, filenames):
+        """
+        Extract the study at each of several index dates, writing the results
+        to the corresponding file in `filenames` (a dict mapping index dates
+        to filenames)
+
+        Where the backend supports it, all the dates are extracted together
+        so that work which doesn't depend on the index date is only done once
+        """
+        self.assert_backend_is_configured()
+        if hasattr(self.backend, "to_csvs"):
+            self.backend.to_csvs(
+                {
+                    filename: evaluate_date_expressions_in_covariate_definitions(
+                        self._original_covariates, index_date
+                    )
+                    for index_date, filename in filenames.items()
+                }
+            )
+        else:
+            for index_date, filename in filenames.items():
+                self.set_index_date(index_date)
+                self.backend.to_csv(filename)
+
     def csv_to_df(self, csv_name):
-        return pd.read_csv(
-            csv_name,
-            dtype=self.pandas_csv_args["dtype"],
-            converters=self.pandas_csv_args["converters"],
-            parse_dates=self.pandas_csv_args["parse_dates"],
-        )
+        if get_output_format(csv_name) != "csv":
+            return self.arrow_file_to_df(csv_name)
+        with open_csv_file(csv_name) as csvfile:
+            return pd.read_csv(
+                csvfile,
+                dtype=self.pandas_csv_args["dtype"],
+                converters=self.pandas_csv_args["converters"],
+                parse_dates=self.pandas_csv_args["parse_dates"],
+            )
+
+    def arrow_file_to_df(self, filename):
+        """
+        Load a Parquet or Feather file into a dataframe with the same types as
+        `csv_to_df()` would give for the equivalent CSV file
+        """
+        df = read_dataframe(filename)
+        dtype = {
+            name: dtype
+            for name, dtype in self.pandas_csv_args["dtype"].items()
+            if name in df.columns
+        }
+        df = df.astype(dtype)
+        for name in self.pandas_csv_args["parse_dates"]:
+            if name in df.columns:
+                df[name] = pd.to_datetime(df[name])
+        return df
 
     def to_sql(self):
         self.assert_backend_is_configured()
@@ -93,6 +155,68 @@ class StudyDefinition:
         self.assert_backend_is_configured()
         return self.backend.to_dicts()
 
+    def iter_batches(self, batch_size=2 ** 16):
+        """
+        Extract the study as a stream of lists of at most `batch_size` rows, so
+        that arbitrarily large cohorts can be processed in bounded memory
+
+        Each row is a named tuple with a field for each output column, holding
+        the value as returned by the database. Patient IDs are checked for
+        duplicates as they arrive and an error is raised after the final batch
+        if any are found.
+        """
+        self.assert_backend_is_configured()
+        headers, batches = self.backend.get_result_batches(batch_size)
+        Row = collections.namedtuple("Row", headers, rename=True)
+        id_column = headers.index("patient_id")
+        unique_check = UniqueCheck()
+        for batch in batches:
+            unique_check.add_batch([row[id_column] for row in batch])
+            yield list(map(Row._make, batch))
+        unique_check.assert_unique_ids()
+
+    def to_dataframe(self, batch_size=2 ** 16):
+        """
+        Extract the study into a Pandas dataframe, with the same column types
+        as `csv_to_df()` gives but without going via a CSV file
+        """
+        self.assert_backend_is_configured()
+        headers, batches = self.backend.get_result_batches(batch_size)
+        df = batches_to_dataframe(
+            headers,
+            batches,
+            get_column_types(self.covariate_definitions),
+            self.pandas_csv_args,
+        )
+        assert_no_duplicates(int(df["patient_id"].duplicated().sum()))
+        return df
+
+    def to_arrow(self, batch_size=2 ** 16):
+        """
+        Extract the study into an Arrow table, with the same column types as
+        Parquet and Feather output files (this requires `pyarrow`)
+        """
+        import_pyarrow()
+        import pyarrow.compute
+
+        self.assert_backend_is_configured()
+        headers, batches = self.backend.get_result_batches(batch_size)
+        table = batches_to_arrow(
+            headers, batches, get_column_types(self.covariate_definitions)
+        )
+        distinct_ids = pyarrow.compute.count_distinct(table["patient_id"]).as_py()
+        assert_no_duplicates(len(table) - distinct_ids)
+        return table
+
+    def explain(self):
+        self.assert_backend_is_configured()
+        if not hasattr(self.backend, "explain"):
+            raise ValueError(
+                f"Query plans are not available for the "
+                f"{self.backend.__class__.__name__} backend"
+            )
+        return self.backend.explain()
+
     def to_data(self):
         hidden_columns = []
         covariate_definitions = copy.deepcopy(self.covariate_definitions)
@@ -1,16 +1,27 @@
+import concurrent.futures
 import datetime
 import enum
 import hashlib
 import os
 import re
+import time
 import uuid
+from xml.etree import ElementTree
 
-from .expressions import format_expression
+from .codelistlib import Codelist
+from .expressions import format_expression, get_column_references
 from .mssql_utils import (
+    BulkInsert,
+    mssql_bulk_insert,
     mssql_dbapi_connection_from_url,
+    fetch_batches,
     mssql_connection_params_from_url,
+    mssql_table_to_arrow,
     mssql_table_to_csv,
 )
+from .output_formats import get_column_types, get_compression, get_output_format
+from .sql_utils import canonicalise_sql
+from .unique_check import UniqueCheck
 
 
 # Characters that are safe to interpolate into SQL (see
@@ -18,16 +29,60 @@ from .mssql_utils import (
 safe_punctation = r" _.-+/()"
 SAFE_CHARS_RE = re.compile(f"^[a-zA-Z0-9{re.escape(safe_punctation)}]+$")
 
+# When restricting queries to the population (see `TPPBackend.get_queries`)
+# this is where we store the IDs of the patients in the population. Column
+# tables are named after their columns, and column names are Python
+# identifiers which can't start with a digit, so this can't clash with them.
+POPULATION_TABLE = "#0_population_ids"
+
+# Matches references to session-scoped temporary tables (e.g. `#population`)
+# but not global ones (e.g. `##population`). Note that "#" is not one of the
+# safe characters above so it can't appear in any interpolated values.
+TEMP_TABLE_RE = re.compile(r"(?<![#\w])#\w+")
+
+# Matches the temporary tables which a query creates or writes to
+TEMP_TABLE_WRITE_RE = re.compile(
+    r"(?:\bINTO|\bCREATE TABLE|\bINDEX \w+ ON)\s+((?<![#\w])#\w+)"
+)
+
+# Namespace used in the XML returned by SET SHOWPLAN_XML
+SHOWPLAN_NAMESPACE = "http://schemas.microsoft.com/sqlserver/2004/07/showplan"
+
+# Matches the query which builds a column's table (see `get_table_queries`)
+COLUMN_TABLE_QUERY_RE = re.compile(r"^-- Query for (\w+).*\nSELECT \* INTO #\1 ")
+
 
 class TPPBackend:
     _db_connection = None
     _current_column_name = None
+    _restrict_to_population = False
 
     def __init__(self, database_url, covariate_definitions, temporary_database=None):
         self.database_url = database_url
         self.covariate_definitions = covariate_definitions
         self.temporary_database = temporary_database
+        self.max_parallel_queries = int(os.environ.get("MAX_PARALLEL_QUERIES") or 1)
+        self.restrict_to_population = bool(os.environ.get("RESTRICT_TO_POPULATION"))
+        self.use_merge_join = bool(os.environ.get("USE_MERGE_JOIN"))
+        self.fuse_event_queries = bool(os.environ.get("FUSE_EVENT_QUERIES"))
+        self.max_parallel_downloads = int(os.environ.get("MAX_PARALLEL_DOWNLOADS") or 1)
+        # Setting this to zero fixes the batch size
+        self.download_batch_seconds = float(
+            os.environ.get("DOWNLOAD_BATCH_SECONDS") or 2
+        )
+        self.download_batch_max_bytes = (
+            int(os.environ.get("DOWNLOAD_BATCH_MAX_MB") or 256) * 1024 * 1024
+        )
+        self.use_column_cache = bool(
+            os.environ.get("COLUMN_CACHE") and self.temporary_database
+        )
         self.next_temp_table_id = 1
+        self._worker_connections = []
+        self._temp_table_renames = {}
+        self._codelist_tables = {}
+        self._same_day_tables = {}
+        self._tables_by_sql = {}
+        self._table_suffix = ""
         self.queries = self.get_queries(self.covariate_definitions)
 
     def to_csv(self, filename):
@@ -38,36 +93,139 @@ class TPPBackend:
         # query
         if self.temporary_database:
             output_table = self.save_results_to_temporary_db(queries)
+            # As the results table will still be there if the download fails
+            # we can arrange to resume the download from where it stopped
+            self.download_results_to_csv(output_table, filename, resumable=True)
+        else:
+            final_query = queries.pop()
+            self.execute_table_queries(queries)
+            output_table = self.write_final_output(final_query)
+            self.download_results_to_csv(output_table, filename)
+
+    def to_csvs(self, covariate_definitions_by_filename):
+        """
+        Write the results for several sets of covariate definitions (typically
+        the same study evaluated at a range of index dates) to their respective
+        files, sharing as much work between them as possible
+
+        Every set of definitions is compiled into the same plan: codelists are
+        uploaded once, and any column whose query is identical across sets
+        (i.e. one which doesn't depend on the index date, like `sex`) is built
+        once and joined into every set's results. All the column tables are
+        then built in one go, so with `MAX_PARALLEL_QUERIES` queries for
+        different index dates run side by side. Finally each set's results are
+        joined and downloaded in turn. Unlike `to_csv`, results are never
+        saved to the temporary database.
+        """
+        # The queries built in `__init__` are never run here, so we mustn't
+        # share any tables with them
+        self._codelist_tables = {}
+        self._same_day_tables = {}
+        self._tables_by_sql = {}
+        table_queries = []
+        final_queries = {}
+        for n, (filename, covariate_definitions) in enumerate(
+            covariate_definitions_by_filename.items(), start=1
+        ):
+            # Each set of definitions gets its own namespace of column tables
+            self._table_suffix = f"_{n}"
+            queries = self.get_queries(covariate_definitions)
+            final_queries[filename] = queries.pop()
+            table_queries.extend(queries)
+        self._table_suffix = ""
+        if self.use_column_cache:
+            table_queries = self.apply_column_cache(table_queries)
+        self.execute_table_queries(table_queries)
+        for filename, final_query in final_queries.items():
+            output_table = self.write_final_output(final_query)
+            self.download_results_to_csv(output_table, filename)
+
+    def write_final_output(self, final_query):
+        # When downloading over several connections the results need to be
+        # visible to all of them, so we use a global temporary table
+        if self.max_parallel_downloads > 1:
+            output_table = f"##final_output_{uuid.uuid4().hex[:12]}"
         else:
             output_table = "#final_output"
-            queries[-1] = (
+        start = time.monotonic()
+        self.execute_queries(
+            [
                 f"-- Writing results into {output_table}\n"
-                f"SELECT * INTO {output_table} FROM ({queries[-1]}) t"
-            )
-            queries.append(f"CREATE INDEX ix_patient_id ON {output_table} (patient_id)")
-            self.execute_queries(queries)
-        temp_filename = self._get_temp_filename(filename)
-        unique_check = UniqueCheck()
+                f"SELECT * INTO {output_table} FROM ({final_query}) t"
+                f"{self.get_join_hint()}",
+                f"CREATE INDEX ix_patient_id ON {output_table} (patient_id)",
+            ]
+        )
+        self.log(f"Joined columns in {time.monotonic() - start:.2f}s")
+        return output_table
 
-        def record_patient_id_and_log(row):
-            unique_check.add(row[0])
-            if unique_check.count % 1000000 == 0:
+    def download_results_to_csv(self, output_table, filename, resumable=False):
+        output_format = get_output_format(filename)
+        # Only uncompressed CSV files can be truncated and appended to
+        if resumable and output_format == "csv" and not get_compression(filename):
+            # Name the partial file after the results table (which is named
+            # after the hash of the queries) so that a rerun can find it
+            root, extension = os.path.splitext(filename)
+            table_name = output_table.split(".")[-1]
+            temp_filename = f"{root}.partial.{table_name}{extension}"
+            checkpoint_filename = f"{temp_filename}.checkpoint"
+        else:
+            temp_filename = self._get_temp_filename(filename)
+            checkpoint_filename = None
+        # Results arrive in `patient_id` order, except when they're downloaded
+        # over several connections at once
+        parallel = output_format == "csv" and self.max_parallel_downloads > 1
+        unique_check = UniqueCheck(ordered=not parallel)
+
+        def record_patient_ids_and_log(rows):
+            previous_count = unique_check.count
+            unique_check.add_batch([row[0] for row in rows])
+            if unique_check.count // 1000000 > previous_count // 1000000:
                 self.log(f"Downloaded {unique_check.count} results")
 
         # `batch_size` here was chosen through a bit of unscientific
-        # trial-and-error and some guesswork. It may well need changing in
-        # future.
-        mssql_table_to_csv(
-            temp_filename,
-            cursor=self.get_db_connection().cursor(),
-            table=output_table,
-            key_column="patient_id",
+        # trial-and-error and some guesswork. It's now just where we start
+        # from: unless disabled, the batch size is adjusted as we go to take
+        # about `download_batch_seconds` per batch, while keeping each batch
+        # within `download_batch_max_bytes` of memory.
+        batch_size_args = dict(
             batch_size=32000,
-            row_callback=record_patient_id_and_log,
-            retries=2,
-            sleep=0.5,
+            target_batch_seconds=self.download_batch_seconds,
+            max_batch_bytes=self.download_batch_max_bytes,
+            log=self.log,
         )
+        if output_format == "csv":
+            mssql_table_to_csv(
+                temp_filename,
+                cursor=self.get_db_connection().cursor(),
+                table=output_table,
+                key_column="patient_id",
+                batch_callback=record_patient_ids_and_log,
+                retries=2,
+                sleep=0.5,
+                connection_factory=lambda: mssql_dbapi_connection_from_url(
+                    self.database_url
+                ),
+                parallelism=self.max_parallel_downloads,
+                checkpoint_filename=checkpoint_filename,
+                **batch_size_args,
+            )
+        else:
+            mssql_table_to_arrow(
+                temp_filename,
+                cursor=self.get_db_connection().cursor(),
+                table=output_table,
+                key_column="patient_id",
+                output_format=output_format,
+                column_types=get_column_types(self.covariate_definitions),
+                batch_callback=record_patient_ids_and_log,
+                retries=2,
+                sleep=0.5,
+                **batch_size_args,
+            )
         self.log(f"Downloaded {unique_check.count} results")
+        if checkpoint_filename and os.path.exists(checkpoint_filename):
+            os.unlink(checkpoint_filename)
 
         self.execute_queries(
             [f"-- Deleting '{output_table}'\nDROP TABLE {output_table}"]
@@ -84,7 +242,7 @@ class TPPBackend:
         return f"{root}.partial.{timestamp}{extension}"
 
     def to_dicts(self):
-        result = self.execute_queries(self.queries)
+        result = self.get_results_cursor()
         keys = [x[0] for x in result.description]
         # Convert all values to str as that's what will end in the CSV
         output = [dict(zip(keys, map(str, row))) for row in result]
@@ -94,6 +252,21 @@ class TPPBackend:
         unique_check.assert_unique_ids()
         return output
 
+    def get_result_batches(self, batch_size):
+        """
+        Run the queries and return the names of the output columns along with
+        an iterator over the results in lists of at most `batch_size` rows
+        """
+        cursor = self.get_results_cursor()
+        headers = [x[0] for x in cursor.description]
+        return headers, fetch_batches(cursor, batch_size)
+
+    def get_results_cursor(self):
+        queries = list(self.queries)
+        final_query = queries.pop()
+        self.execute_table_queries(queries)
+        return self.execute_queries([final_query + self.get_join_hint()])
+
     def to_sql(self):
         """
         Generate a single SQL string.
@@ -102,6 +275,54 @@ class TPPBackend:
         """
         return "\nGO\n\n".join(self.queries)
 
+    def explain(self):
+        """
+        Ask the server for the estimated execution plan of each query and
+        return a summary of each (see `summarise_showplan`)
+
+        Queries are only compiled, not run, but later queries can't be compiled
+        unless the temporary tables they read from exist. So we upload the
+        codelists for real (which is cheap and gives the optimiser accurate
+        statistics for them) and create empty versions of every other
+        temporary table. This means that the estimates for queries which read
+        from column tables, like the final join, are not meaningful.
+        """
+        cursor = self.get_db_connection().cursor()
+        summaries = []
+        for query in self.queries:
+            if isinstance(query, BulkInsert) or re.match(
+                r"^\s*(--[^\n]*\n\s*)*CREATE (TABLE|(UNIQUE )?(CLUSTERED )?INDEX)",
+                query,
+            ):
+                self.execute_query(cursor, query)
+                continue
+            cursor.execute("SET SHOWPLAN_XML ON")
+            try:
+                cursor.execute(query)
+                # Each statement in the query gets its own plan, in its own
+                # result set
+                plans = []
+                while True:
+                    if cursor.description is not None:
+                        plans.extend(row[0] for row in cursor.fetchall())
+                    if not cursor.nextset():
+                        break
+            finally:
+                cursor.execute("SET SHOWPLAN_XML OFF")
+            summary = {"query": get_query_label(query)}
+            summary.update(summarise_showplan(plans))
+            summaries.append(summary)
+            if TEMP_TABLE_WRITE_RE.search(query):
+                cursor.execute(
+                    re.sub(
+                        r"^(\s*(?:--[^\n]*\n\s*)*)SELECT\b",
+                        r"\1SELECT TOP 0",
+                        query,
+                        count=1,
+                    )
+                )
+        return summaries
+
     def save_results_to_temporary_db(self, queries):
         """
         Sometimes there are glitches (network issues?) which occur when
@@ -135,7 +356,10 @@ class TPPBackend:
             self.assert_database_exists_and_is_writable(self.temporary_database)
             queries = list(queries)
             final_query = queries.pop()
-            self.execute_queries(queries)
+            if self.use_column_cache:
+                queries = self.apply_column_cache(queries)
+            self.execute_table_queries(queries)
+            final_query = self.rename_temp_tables(final_query)
             # We need to run the final query in a transaction so that we don't end up
             # with an empty output table in the event that the query fails. See:
             # https://docs.microsoft.com/en-us/sql/t-sql/queries/select-into-clause-transact-sql?view=sql-server-ver15#remarks
@@ -144,16 +368,71 @@ class TPPBackend:
             previous_autocommit = conn.autocommit
             conn.autocommit = False
             cursor = conn.cursor()
+            start = time.monotonic()
             cursor.execute("BEGIN TRANSACTION")
-            cursor.execute(f"SELECT * INTO {output_table} FROM ({final_query}) t")
+            cursor.execute(
+                f"SELECT * INTO {output_table} FROM ({final_query}) t"
+                f"{self.get_join_hint()}"
+            )
             cursor.execute(f"CREATE INDEX ix_patient_id ON {output_table} (patient_id)")
             cursor.execute("COMMIT")
             conn.autocommit = previous_autocommit
+            self.log(f"Joined columns in {time.monotonic() - start:.2f}s")
             self.log(f"Downloading results from '{output_table}'")
         else:
             self.log(f"Downloading results from previous run in '{output_table}'")
         return output_table
 
+    def get_column_cache(self):
+        return get_column_cache(
+            self.database_url, self.temporary_database, self.get_db_connection()
+        )
+
+    def apply_column_cache(self, queries):
+        """
+        Rewrite the supplied table queries so that any column tables we've
+        built before are copied from the column cache (see `ColumnCache`)
+        rather than recomputed, and any we haven't are saved to it
+
+        Each column table is keyed by the SQL of the query which builds it and
+        of all the queries which build the tables it reads from (codelists,
+        the population table etc). Any of those queries which are then only
+        needed by cached columns are dropped.
+        """
+        cache = self.get_column_cache()
+        cache.setup()
+        cache.evict(log=self.log)
+        sources = get_temp_table_sources(queries)
+        column_queries = {}
+        for n, query in enumerate(queries):
+            match = COLUMN_TABLE_QUERY_RE.match(query)
+            # Random samples should be different every time
+            if match and "RAND()" not in query:
+                inputs = get_transitive_sources(sources, n)
+                column_queries[n] = (
+                    match.group(1),
+                    cache.get_key([queries[i] for i in sorted(inputs | {n})]),
+                )
+        cached = cache.lookup([key for (_, key) in column_queries.values()])
+        new_queries = list(queries)
+        for n, (column, key) in column_queries.items():
+            if key in cached:
+                new_queries[n] = (
+                    f"-- Query for {column} (from column cache)\n"
+                    f"SELECT * INTO #{column} FROM {cache.get_table_name(key)}"
+                )
+            else:
+                new_queries[n] = [queries[n], cache.get_save_query(key, column)]
+        new_queries = [
+            query
+            for item in new_queries
+            for query in (item if isinstance(item, list) else [item])
+        ]
+        self.log(
+            f"Using {len(cached)} of {len(column_queries)} columns from column cache"
+        )
+        return drop_unused_queries(new_queries)
+
     def table_exists(self, table_name):
         # We don't have access to sys.tables so this seems like the simplest
         # way of testing for table existence
@@ -195,13 +474,53 @@ class TPPBackend:
         if self._db_connection:
             self._db_connection.close()
         self._db_connection = None
+        # Closing the worker connections also drops any global temporary
+        # tables they created
+        while self._worker_connections:
+            self._worker_connections.pop().close()
+        self._temp_table_renames = {}
 
     def get_queries(self, covariate_definitions):
         output_columns = {}
         column_types = {}
         is_hidden = {}
         table_queries = {}
-        for name, (query_type, query_args) in covariate_definitions.items():
+        # Maps each column which has a table to the name of that table (which
+        # may belong to an identical column defined earlier, see below)
+        table_names = {}
+        tables_by_sql = self._tables_by_sql
+        # With `restrict_to_population` enabled we first build just the
+        # columns needed to determine the population, and materialise the
+        # population into its own table. All other column queries are then
+        # restricted to patients in that table so that their cost scales with
+        # the size of the population rather than the size of the database.
+        # Processing the population's dependencies first doesn't affect the
+        # output order of the columns: that's determined by the order of
+        # `covariate_definitions`.
+        if self.restrict_to_population and "population" in covariate_definitions:
+            population_columns = get_column_dependencies(
+                covariate_definitions, "population"
+            )
+        else:
+            population_columns = set(covariate_definitions)
+        definitions = sorted(
+            covariate_definitions.items(),
+            key=lambda item: item[0] not in population_columns,
+        )
+        # Columns which are computed together in a single scan of CodedEvent
+        # (see `get_fused_event_queries`) share a table, and prefix the names
+        # of the fields they read from it with their own name
+        fused_groups = {}
+        if self.fuse_event_queries:
+            for group in get_fusable_event_columns(definitions, population_columns):
+                for column in group:
+                    fused_groups[column] = group
+        field_prefixes = {}
+        population_tables = None
+        for name, (query_type, query_args) in definitions:
+            if name not in population_columns and population_tables is None:
+                population_tables = list(dict.fromkeys(table_names.values()))
+                self._restrict_to_population = True
             # So we can safely mutate these below
             query_args = query_args.copy()
             # These arguments are not used in generating column data and the
@@ -222,7 +541,12 @@ class TPPBackend:
             # `value_from` columns also don't generate a table, they just take
             # a value from another table
             elif query_type == "value_from":
-                assert query_args["source"] in table_queries
+                source = query_args["source"]
+                assert source in table_names
+                query_args["source"] = table_names[source]
+                query_args["returning"] = (
+                    field_prefixes.get(source, "") + query_args["returning"]
+                )
                 output_columns[name] = self.get_column_expression(
                     column_type, **query_args
                 )
@@ -231,43 +555,98 @@ class TPPBackend:
                 output_columns[name] = self.get_aggregate_expression(
                     column_type, output_columns, **query_args
                 )
+            elif name in fused_groups:
+                group = fused_groups[name]
+                # The first column in each group builds the table for all of
+                # them
+                if group[0] == name:
+                    table_name, sql_list = self.get_fused_event_queries(
+                        {column: covariate_definitions[column][1] for column in group}
+                    )
+                    table_queries[table_name] = self.get_table_queries(
+                        table_name, sql_list
+                    )
+                    for column in group:
+                        table_names[column] = table_name
+                        field_prefixes[column] = f"{column}__"
+                output_columns[name] = self.get_column_expression(
+                    column_type,
+                    table_names[name],
+                    returning=field_prefixes[name] + query_args["returning"],
+                    date_format=query_args.get("date_format"),
+                )
             else:
                 date_format_args = pop_keys_from_dict(query_args, ["date_format"])
                 sql_list = self.get_queries_for_column(name, query_type, query_args)
-                # Wrap the final SELECT query so that it writes its results
-                # into the appropriate temporary table
-                sql_list[-1] = (
-                    f"-- Query for {name}\n"
-                    f"SELECT * INTO #{name} FROM ({sql_list[-1]}) t"
-                )
-                table_queries[name] = sql_list
+                # It's common for a study to define the same query more than
+                # once (e.g. a hidden column used in a `categorised_as`
+                # expression and an output column which differ only in what
+                # they return, or in their date format). Codelist tables are
+                # already shared between columns (see `create_codelist_table`)
+                # so identical queries produce identical SQL, and we can just
+                # point the later columns at the table built for the first.
+                # Random samples are deliberately excluded: two of them should
+                # be independent.
+                # A table which isn't restricted to the population (see
+                # `get_table_queries`) can stand in for one which is, but not
+                # the other way round
+                canonical_sql = canonicalise_sql(sql_list[-1])
+                restriction = self.get_population_condition("t.patient_id")
+                existing_tables = [
+                    tables_by_sql[key]
+                    for key in [(canonical_sql, "1=1"), (canonical_sql, restriction)]
+                    if key in tables_by_sql
+                ]
+                if existing_tables and query_type != "random_sample":
+                    table_names[name] = existing_tables[0]
+                else:
+                    table_name = f"{name}{self._table_suffix}"
+                    table_queries[table_name] = self.get_table_queries(
+                        table_name, sql_list
+                    )
+                    table_names[name] = table_name
+                    tables_by_sql.setdefault((canonical_sql, restriction), table_name)
                 # The first column should always be patient_id so we can join on it
                 output_columns[name] = self.get_column_expression(
                     column_type,
-                    name,
+                    table_names[name],
                     returning=query_args.get("returning", "value"),
                     **date_format_args,
                 )
+        self._restrict_to_population = False
         # If the population query defines its own temporary table then we use
         # that as the primary table to query against and left join everything
         # else against that. Otherwise, we use the `Patient` table.
-        if "population" in table_queries:
-            primary_table = "#population"
-            patient_id_expr = "#population.patient_id"
+        if "population" in table_names:
+            primary_table = f"#{table_names['population']}"
+            patient_id_expr = f"{primary_table}.patient_id"
         else:
             primary_table = "Patient"
             patient_id_expr = "Patient.Patient_ID"
-        # Insert `patient_id` as the first column
-        output_columns = dict(patient_id=patient_id_expr, **output_columns)
+        if population_tables is not None:
+            population_query = self.get_population_table_query(
+                population_tables,
+                primary_table,
+                patient_id_expr,
+                output_columns["population"],
+            )
+        # Insert `patient_id` as the first column, and otherwise keep the
+        # columns in the order in which they were defined
+        output_columns = dict(
+            patient_id=patient_id_expr,
+            **{name: output_columns[name] for name in covariate_definitions},
+        )
         output_columns_str = ",\n          ".join(
             f"{expr} AS {name}"
             for (name, expr) in output_columns.items()
             if not is_hidden.get(name) and name != "population"
         )
+        # Some of these tables may have been built for an earlier set of
+        # covariate definitions (see `to_csvs`)
         joins = [
             f"LEFT JOIN #{name} ON #{name}.patient_id = {patient_id_expr}"
-            for name in table_queries
-            if name != "population"
+            for name in dict.fromkeys(table_names.values())
+            if f"#{name}" != primary_table
         ]
         joins_str = "\n          ".join(joins)
         joined_output_query = f"""
@@ -280,11 +659,103 @@ class TPPBackend:
         WHERE {output_columns["population"]} = 1
         """
         all_queries = []
-        for sql_list in table_queries.values():
+        for name, sql_list in table_queries.items():
+            if population_tables is not None:
+                if name not in population_tables:
+                    all_queries.extend(population_query)
+                    population_tables = None
             all_queries.extend(sql_list)
         all_queries.append(joined_output_query)
         return all_queries
 
+    def get_table_queries(self, name, sql_list):
+        """
+        Wrap the final SELECT query in `sql_list` so that it writes its results
+        into the temporary table `name`
+        """
+        population_condition = self.get_population_condition("t.patient_id")
+        sql_list = list(sql_list)
+        index_type = self.get_column_table_index_type(sql_list[-1])
+        sql_list[-1] = (
+            f"-- Query for {name}\n"
+            f"SELECT * INTO #{name} FROM ({sql_list[-1]}) t\n"
+            f"WHERE {population_condition}"
+        )
+        if index_type:
+            sql_list.append(
+                f"CREATE {index_type} INDEX ix_patient_id ON #{name} (patient_id)"
+            )
+        return sql_list
+
+    def get_column_table_index_type(self, sql):
+        """
+        Returns the type of index (if any) to create on patient_id for a
+        column table built by `sql`
+        """
+        # Clustering each table on patient_id lets a merge join walk it in
+        # patient_id order rather than sorting it or building a hash table.
+        # But building the index means sorting every table, which is only
+        # worth doing if we're going to force a merge join (see
+        # `get_join_hint`). Only some queries guarantee at most one row per
+        # patient: others (e.g. household membership) can return several, and
+        # the final join copes with that for patients outside the population,
+        # so we mustn't fail when building the index.
+        if not self.use_merge_join:
+            return None
+        if has_one_row_per_patient(sql):
+            return "UNIQUE CLUSTERED"
+        return "CLUSTERED"
+
+    def get_population_table_query(
+        self, table_names, primary_table, patient_id_expr, population_expr
+    ):
+        joins = [
+            f"LEFT JOIN #{name} ON #{name}.patient_id = {patient_id_expr}"
+            for name in table_names
+            if f"#{name}" != primary_table
+        ]
+        joins_str = "\n              ".join(joins)
+        population_table = f"{POPULATION_TABLE}{self._table_suffix}"
+        return [
+            f"""
+            -- Writing population into {population_table}
+            SELECT {patient_id_expr} AS patient_id
+            INTO {population_table}
+            FROM
+              {primary_table}
+              {joins_str}
+            WHERE {population_expr} = 1
+            """,
+            f"CREATE UNIQUE CLUSTERED INDEX ix_patient_id "
+            f"ON {population_table} (patient_id)",
+        ]
+
+    def get_join_hint(self):
+        """
+        Returns the query hint (if any) to append to the final query which
+        joins all the column tables together
+        """
+        # With every column table clustered on patient_id (see
+        # `get_column_table_index_type`) a merge join needs no sorting and no
+        # memory grant, whereas the hash joins the optimiser sometimes picks
+        # for a very wide join can spill to tempdb
+        if self.use_merge_join:
+            return "\nOPTION (MERGE JOIN)"
+        return ""
+
+    def get_population_condition(self, patient_id_column):
+        """
+        Returns a condition which restricts `patient_id_column` to patients in
+        the population, if we're currently building a column which should be
+        restricted in this way (see `get_queries`)
+        """
+        if not self._restrict_to_population:
+            return "1=1"
+        return (
+            f"{patient_id_column} IN "
+            f"(SELECT patient_id FROM {POPULATION_TABLE}{self._table_suffix})"
+        )
+
     def get_column_expression(self, column_type, source, returning, date_format=None):
         default_value = self.get_default_value_for_type(column_type)
         column_expr = f"#{source}.{returning}"
@@ -309,12 +780,120 @@ class TPPBackend:
     def execute_queries(self, queries):
         cursor = self.get_db_connection().cursor()
         for query in queries:
-            comment_match = re.match(r"^\s*\-\-\s*(.+)\n", query)
-            if comment_match:
-                self.log(f"Running: {comment_match.group(1)}")
-            cursor.execute(query)
+            self.execute_query(cursor, query)
         return cursor
 
+    def execute_query(self, cursor, query):
+        comment_match = re.match(r"^\s*\-\-\s*(.+)\n", query)
+        if comment_match:
+            self.log(f"Running: {comment_match.group(1)}")
+        if isinstance(query, BulkInsert):
+            self.execute_bulk_insert(cursor, query)
+        else:
+            cursor.execute(self.rename_temp_tables(query))
+
+    def execute_bulk_insert(self, cursor, query):
+        table = self.rename_temp_tables(query.table)
+        start = time.monotonic()
+        if mssql_bulk_insert(cursor, table, query.columns, query.rows):
+            method = "bulk load"
+        else:
+            cursor.execute(self.rename_temp_tables(query))
+            method = "INSERT statements"
+        duration = time.monotonic() - start
+        self.log(
+            f"Uploaded {len(query.rows)} rows into {query.table} using {method} "
+            f"in {duration:.2f}s"
+        )
+
+    def execute_table_queries(self, queries):
+        """
+        Run the queries which build the temporary tables used by the final
+        query, spreading them over several connections if
+        `MAX_PARALLEL_QUERIES` is set
+        """
+        if self.max_parallel_queries > 1 and len(queries) > 1:
+            self.execute_queries_in_parallel(queries)
+        else:
+            self.execute_queries(queries)
+
+    def execute_queries_in_parallel(self, queries):
+        """
+        Run `queries` concurrently over a pool of up to `max_parallel_queries`
+        connections
+
+        Each query waits only for the earlier queries which touch the same
+        temporary tables (see `get_temp_table_dependencies`). This means that
+        e.g. a column's codelist upload always completes before the query
+        which uses it, but otherwise unrelated columns run side by side.
+
+        Ordinary `#temp` tables are only visible to the session which created
+        them so, for the duration of this run, we rename every temporary table
+        these queries touch to a global temporary table with a unique prefix.
+        The same renaming is applied to anything subsequently passed to
+        `execute_queries`, so the final query can see them too. Global
+        temporary tables are dropped when the session which created them
+        closes, so we keep the worker connections open until `close()`.
+        """
+        run_id = uuid.uuid4().hex[:12]
+        self._temp_table_renames = {
+            table: f"##{run_id}_{table[1:]}"
+            for query in queries
+            for table in TEMP_TABLE_RE.findall(query)
+        }
+        dependencies = get_temp_table_dependencies(queries)
+        self.log(
+            f"Running {len(queries)} queries using up to "
+            f"{self.max_parallel_queries} connections"
+        )
+        waiting = dict(enumerate(dependencies))
+        completed = set()
+        running = {}
+        with concurrent.futures.ThreadPoolExecutor(
+            self.max_parallel_queries
+        ) as executor:
+            while waiting or running:
+                for n, query_dependencies in list(waiting.items()):
+                    if query_dependencies <= completed:
+                        del waiting[n]
+                        future = executor.submit(
+                            self.execute_query_on_worker, queries[n]
+                        )
+                        running[future] = n
+                done, _ = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    n = running.pop(future)
+                    # This re-raises any error from the worker, after which
+                    # leaving the `with` block waits for any queries still in
+                    # flight but doesn't start any new ones
+                    future.result()
+                    completed.add(n)
+
+    def execute_query_on_worker(self, query):
+        # Popping from and appending to a list are atomic operations so this
+        # is safe to call from multiple threads
+        try:
+            connection = self._worker_connections.pop()
+        except IndexError:
+            connection = mssql_dbapi_connection_from_url(self.database_url)
+        try:
+            self.execute_query(connection.cursor(), query)
+            # Other workers can't see the tables we've created until they're
+            # committed (this is a no-op for autocommit connections)
+            connection.commit()
+        finally:
+            self._worker_connections.append(connection)
+
+    def rename_temp_tables(self, query):
+        if not self._temp_table_renames:
+            return query
+        return TEMP_TABLE_RE.sub(
+            lambda match: self._temp_table_renames.get(match.group(0), match.group(0)),
+            query,
+        )
+
     def log(self, message):
         timestamp = datetime.datetime.now(datetime.timezone.utc).strftime(
             "%Y-%m-%d %H:%M:%S UTC"
@@ -335,21 +914,30 @@ class TPPBackend:
         return return_value
 
     def create_codelist_table(self, codelist, case_sensitive=True):
-        table_name = self.get_temp_table_name("codelist")
         if codelist.has_categories:
             values = list(codelist)
         else:
             values = [(code, "") for code in codelist]
+        # Identical codelists are only uploaded once and then shared between
+        # all the queries which use them
+        cache_key = (case_sensitive, tuple(values))
+        if cache_key in self._codelist_tables:
+            return self._codelist_tables[cache_key], []
+        table_name = self.get_temp_table_name("codelist")
+        self._codelist_tables[cache_key] = table_name
         # Depending on the case-sensitivity of the code system the columns in question
         # use different collations and we need to use a matching one here
         collation = "Latin1_General_BIN" if case_sensitive else "Latin1_General_CI_AS"
         max_code_len = max(len(code) for (code, category) in values)
+        # Bulk loading is much less efficient with some drivers if we use
+        # VARCHAR(MAX) here, so we size the column to fit the data instead
+        max_category_len = max(len(str(category)) for (code, category) in values)
         queries = [
             f"""
             -- Uploading codelist for {self._current_column_name}
             CREATE TABLE {table_name} (
               code VARCHAR({max_code_len}) COLLATE {collation},
-              category VARCHAR(MAX)
+              category VARCHAR({max(max_category_len, 1)})
             )
             """
         ]
@@ -357,13 +945,25 @@ class TPPBackend:
         # There's a limit on how many rows we can insert in one go using this method
         # See: https://docs.microsoft.com/en-us/sql/t-sql/queries/table-value-constructor-transact-sql?view=sql-server-ver15#limitations-and-restrictions
         batch_size = 999
+        insert_statements = []
         for i in range(0, len(values), batch_size):
             values_batch = values[i : i + batch_size]
             values_sql_lines = [
                 "({}, {})".format(*map(quote, row)) for row in values_batch
             ]
             values_sql = ",\n".join(values_sql_lines)
-            queries.append(f"{insert_sql}\n{values_sql}")
+            insert_statements.append(f"{insert_sql}\n{values_sql}")
+        # The INSERT statements are only used if the database driver doesn't
+        # support bulk loading (see `execute_query`), but they're also what
+        # appears in the output of `to_sql()`
+        queries.append(
+            BulkInsert(
+                "\n".join(insert_statements),
+                table=table_name,
+                columns=["code", "category"],
+                rows=[(str(code), str(category)) for (code, category) in values],
+            )
+        )
         return table_name, queries
 
     def get_temp_table_name(self, suffix):
@@ -688,6 +1288,77 @@ class TPPBackend:
                 "CodedEvent", "", "CTV3Code", codes_are_case_sensitive=True, **kwargs
             )
 
+    def get_fused_event_queries(self, columns):
+        """
+        Compute several `with_these_clinical_events` columns in a single scan
+        of the CodedEvent table
+
+        `columns` maps column names to their query arguments, which must
+        satisfy `is_fusable_event_column`. We upload one codelist containing
+        every column's codes, each tagged with the index of its column, and
+        then use conditional aggregation to produce all the columns at once.
+        The resulting table has a `<column>__<field>` field for each of the
+        fields `_patients_with_events` would have produced for each column.
+        Returns the name of the table and the queries which build it.
+        """
+        table_name = self.get_temp_table_name("events")[1:]
+        codes = Codelist()
+        codes.system = "ctv3"
+        codes.has_categories = True
+        for n, query_args in enumerate(columns.values()):
+            codelist = query_args["codelist"]
+            for code in codelist:
+                if codelist.has_categories:
+                    code = code[0]
+                codes.append((code, str(n)))
+        self._current_column_name = table_name
+        codelist_table, codelist_queries = self.create_codelist_table(
+            codes, case_sensitive=True
+        )
+        self._current_column_name = None
+
+        conditions = []
+        aggregates = []
+        for n, (name, query_args) in enumerate(columns.items()):
+            date_condition = make_date_filter("ConsultationDate", query_args["between"])
+            condition = (
+                f"({codelist_table}.category = {quote(str(n))} AND {date_condition})"
+            )
+            conditions.append(condition)
+            if query_args["find_first_match_in_period"]:
+                date_aggregate = "MIN"
+            else:
+                date_aggregate = "MAX"
+            if query_args["returning"] == "number_of_matches_in_period":
+                aggregates.append(
+                    f"COUNT(CASE WHEN {condition} THEN 1 END) "
+                    f"AS {name}__number_of_matches_in_period"
+                )
+            else:
+                aggregates.append(
+                    f"MAX(CASE WHEN {condition} THEN 1 END) AS {name}__binary_flag"
+                )
+            aggregates.append(
+                f"{date_aggregate}(CASE WHEN {condition} THEN ConsultationDate END) "
+                f"AS {name}__date"
+            )
+        conditions_str = "\n              OR ".join(conditions)
+        aggregates_str = ",\n              ".join(aggregates)
+        population_condition = self.get_population_condition("CodedEvent.Patient_ID")
+        sql = f"""
+            SELECT
+              Patient_ID AS patient_id,
+              {aggregates_str}
+            FROM CodedEvent
+            INNER JOIN {codelist_table}
+            ON CTV3Code = {codelist_table}.code
+            WHERE (
+              {conditions_str}
+            ) AND {population_condition}
+            GROUP BY Patient_ID
+            """
+        return table_name, codelist_queries + [sql]
+
     def _patients_with_events(
         self,
         from_table,
@@ -714,6 +1385,7 @@ class TPPBackend:
         ignored_day_condition, extra_queries = self._these_codes_occur_on_same_day(
             from_table, ignore_days_where_these_codes_occur, date_condition
         )
+        population_condition = self.get_population_condition(f"{from_table}.Patient_ID")
 
         # Result ordering
         if find_first_match_in_period:
@@ -764,6 +1436,7 @@ class TPPBackend:
               INNER JOIN {codelist_table}
               ON {code_column} = {codelist_table}.code
               WHERE {date_condition} AND NOT {ignored_day_condition}
+                AND {population_condition}
             ) t
             WHERE rownum = 1
             """
@@ -777,6 +1450,7 @@ class TPPBackend:
             INNER JOIN {codelist_table}
             ON {code_column} = {codelist_table}.code
             WHERE {date_condition} AND NOT {ignored_day_condition}
+              AND {population_condition}
             GROUP BY Patient_ID
             """
 
@@ -797,6 +1471,9 @@ class TPPBackend:
         ignored_day_condition, extra_queries = self._these_codes_occur_on_same_day(
             "MedicationIssue", ignore_days_where_these_codes_occur, date_condition
         )
+        population_condition = self.get_population_condition(
+            "MedicationIssue.Patient_ID"
+        )
         if episode_defined_as is not None:
             pattern = r"^series of events each <= (\d+) days apart$"
             match = re.match(pattern, episode_defined_as)
@@ -831,6 +1508,7 @@ class TPPBackend:
             INNER JOIN {codelist_table}
             ON DMD_ID = {codelist_table}.code
             WHERE {date_condition} AND NOT {ignored_day_condition}
+              AND {population_condition}
         ) t
         GROUP BY Patient_ID
         """
@@ -851,6 +1529,7 @@ class TPPBackend:
         ignored_day_condition, extra_queries = self._these_codes_occur_on_same_day(
             "CodedEvent", ignore_days_where_these_codes_occur, date_condition
         )
+        population_condition = self.get_population_condition("CodedEvent.Patient_ID")
         if episode_defined_as is not None:
             pattern = r"^series of events each <= (\d+) days apart$"
             match = re.match(pattern, episode_defined_as)
@@ -883,6 +1562,7 @@ class TPPBackend:
             INNER JOIN {codelist_table}
             ON CTV3Code = {codelist_table}.code
             WHERE {date_condition} AND NOT {ignored_day_condition}
+              AND {population_condition}
         ) t
         GROUP BY Patient_ID
         """
@@ -906,20 +1586,26 @@ class TPPBackend:
         codelist_table, queries = self.create_codelist_table(
             codelist, case_sensitive=True
         )
-        same_day_table = self.get_temp_table_name("same_day_events")
-        queries += [
-            f"""
-            SELECT Patient_ID, CAST(ConsultationDate AS date) AS day
-            INTO {same_day_table}
-            FROM CodedEvent
-            INNER JOIN {codelist_table}
-            ON CTV3Code = {codelist_table}.code
-            WHERE {date_condition}
-            """,
-            f"""
-            CREATE CLUSTERED INDEX ix ON {same_day_table} (Patient_ID, day)
-            """,
-        ]
+        population_condition = self.get_population_condition("CodedEvent.Patient_ID")
+        cache_key = (codelist_table, date_condition, population_condition)
+        if cache_key in self._same_day_tables:
+            same_day_table = self._same_day_tables[cache_key]
+        else:
+            same_day_table = self.get_temp_table_name("same_day_events")
+            self._same_day_tables[cache_key] = same_day_table
+            queries += [
+                f"""
+                SELECT Patient_ID, CAST(ConsultationDate AS date) AS day
+                INTO {same_day_table}
+                FROM CodedEvent
+                INNER JOIN {codelist_table}
+                ON CTV3Code = {codelist_table}.code
+                WHERE {date_condition} AND {population_condition}
+                """,
+                f"""
+                CREATE CLUSTERED INDEX ix ON {same_day_table} (Patient_ID, day)
+                """,
+            ]
         condition = f"""
         EXISTS (
           SELECT 1 FROM {same_day_table}
@@ -1570,7 +2256,10 @@ class TPPBackend:
         else:
             raise ValueError(f"Unsupported `returning` value: {returning}")
 
-        conditions = [make_date_filter("Admission_Date", between)]
+        conditions = [
+            make_date_filter("Admission_Date", between),
+            self.get_population_condition("APCS.Patient_ID"),
+        ]
 
         if with_these_primary_diagnoses:
             assert with_these_primary_diagnoses.system == "icd10"
@@ -1797,19 +2486,432 @@ def truncate_date(column, date_format):
     return f"CONVERT(VARCHAR({date_length}), {column}, 23)"
 
 
-class UniqueCheck:
-    def __init__(self):
-        self.count = 0
-        self.ids = set()
+def get_column_cache(database_url, temporary_database, connection=None):
+    """
+    Return a `ColumnCache` configured from the environment
+    """
+    if connection is None:
+        connection = mssql_dbapi_connection_from_url(database_url)
+    return ColumnCache(
+        connection,
+        temporary_database,
+        mssql_connection_params_from_url(database_url)["database"],
+        max_age_hours=float(os.environ.get("COLUMN_CACHE_MAX_AGE_HOURS") or 24),
+        max_rows=int(os.environ.get("COLUMN_CACHE_MAX_ROWS") or 0) or None,
+    )
+
+
+class ColumnCache:
+    """
+    Stores the results of individual column queries as tables in the temporary
+    database so that later runs which share those columns can reuse them
+
+    An index table records when each entry was created and last used, and how
+    many rows it holds. Entries are evicted when they're more than
+    `max_age_hours` old (the underlying data changes over time) and, least
+    recently used first, whenever the cache holds more than `max_rows` rows in
+    total. We record rows rather than bytes as we don't have access to the
+    system views which report table sizes.
+    """
 
-    def add(self, item):
-        self.count += 1
-        self.ids.add(item)
+    index_table = "ColumnCacheIndex"
 
-    def assert_unique_ids(self):
-        duplicates = self.count - len(self.ids)
-        if duplicates != 0:
-            raise RuntimeError(f"Duplicate IDs found ({duplicates} rows)")
+    def __init__(
+        self, connection, temporary_database, database_name, max_age_hours, max_rows
+    ):
+        self.connection = connection
+        self.temporary_database = temporary_database
+        self.database_name = database_name
+        self.max_age_hours = max_age_hours
+        self.max_rows = max_rows
+
+    def get_key(self, queries):
+        # Temporary table names depend on the order in which the columns were
+        # defined, so we replace them with names based only on their order of
+        # appearance in these queries. We also drop the comments, which
+        # include column names.
+        renames = {}
+        lines = []
+        for query in queries:
+            for line in canonicalise_sql(query).splitlines():
+                if not line.startswith("--"):
+                    lines.append(line)
+        sql = "\n".join(lines)
+        sql = TEMP_TABLE_RE.sub(
+            lambda match: renames.setdefault(match.group(0), f"#t{len(renames)}"),
+            sql,
+        )
+        # A single server may contain multiple databases (e.g full data and
+        # sample data) which share a single temporary database
+        key_elements = [sql, self.database_name]
+        return hashlib.sha1("\n".join(key_elements).encode("utf8")).hexdigest()
+
+    def get_table_name(self, key):
+        return f"{self.temporary_database}..ColumnCache_{key}"
+
+    def get_save_query(self, key, column):
+        table = self.get_table_name(key)
+        # The DROP is needed in case we previously saved the table but failed
+        # before recording it in the index
+        return f"""
+        -- Saving {column} to column cache
+        IF OBJECT_ID({quote(table)}) IS NOT NULL DROP TABLE {table};
+        SELECT * INTO {table} FROM #{column};
+        INSERT INTO {self.temporary_database}..{self.index_table}
+          (cache_key, database_name, column_name, created_at, last_used_at, row_count)
+        VALUES
+          ({quote(key)}, {quote(self.database_name)}, {quote(column)},
+           GETDATE(), GETDATE(), @@ROWCOUNT)
+        """
+
+    def setup(self):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(
+                f"SELECT 1 FROM {self.temporary_database}..{self.index_table}"
+            )
+            list(cursor)
+        # Because we don't want to depend on a specific database driver we
+        # can't catch a specific exception class here
+        except Exception as e:
+            if "Invalid object name" not in str(e):
+                raise
+            cursor.execute(
+                f"""
+                CREATE TABLE {self.temporary_database}..{self.index_table} (
+                  cache_key VARCHAR(40),
+                  database_name VARCHAR(128),
+                  column_name VARCHAR(128),
+                  created_at DATETIME,
+                  last_used_at DATETIME,
+                  row_count BIGINT
+                )
+                """
+            )
+
+    def lookup(self, keys):
+        """
+        Return those of the supplied keys which have entries in the cache,
+        marking them as used
+        """
+        if not keys:
+            return set()
+        keys_sql = ", ".join(map(quote, keys))
+        cursor = self.connection.cursor()
+        cursor.execute(
+            f"""
+            SELECT cache_key FROM {self.temporary_database}..{self.index_table}
+            WHERE cache_key IN ({keys_sql})
+            """
+        )
+        found = {row[0] for row in cursor}
+        if found:
+            found_sql = ", ".join(map(quote, found))
+            cursor.execute(
+                f"""
+                UPDATE {self.temporary_database}..{self.index_table}
+                SET last_used_at = GETDATE()
+                WHERE cache_key IN ({found_sql})
+                """
+            )
+        return found
+
+    def entries(self):
+        """
+        Return a list of dicts describing each entry in the cache, most
+        recently used first
+        """
+        cursor = self.connection.cursor()
+        # We compare dates on the server to avoid any issues with timezones
+        max_age_minutes = int(self.max_age_hours * 60)
+        cursor.execute(
+            f"""
+            SELECT
+              cache_key, database_name, column_name,
+              created_at, last_used_at, row_count,
+              CASE
+                WHEN created_at < DATEADD(minute, -{max_age_minutes}, GETDATE())
+                THEN 1 ELSE 0
+              END AS expired
+            FROM {self.temporary_database}..{self.index_table}
+            ORDER BY last_used_at DESC
+            """
+        )
+        keys = [x[0] for x in cursor.description]
+        return [dict(zip(keys, row)) for row in cursor]
+
+    def evict(self, log=None):
+        """
+        Delete any entries which are too old or which take the cache over its
+        maximum size
+        """
+        to_delete = []
+        total_rows = 0
+        for entry in self.entries():
+            if entry["expired"]:
+                to_delete.append(entry["cache_key"])
+                continue
+            total_rows += entry["row_count"] or 0
+            if self.max_rows is not None and total_rows > self.max_rows:
+                to_delete.append(entry["cache_key"])
+        self.delete(to_delete)
+        if log and to_delete:
+            log(f"Evicted {len(to_delete)} entries from column cache")
+        return to_delete
+
+    def purge(self):
+        """
+        Delete all entries in the cache
+        """
+        keys = [entry["cache_key"] for entry in self.entries()]
+        self.delete(keys)
+        return keys
+
+    def delete(self, keys):
+        cursor = self.connection.cursor()
+        for key in keys:
+            table = self.get_table_name(key)
+            cursor.execute(
+                f"IF OBJECT_ID({quote(table)}) IS NOT NULL DROP TABLE {table}"
+            )
+            cursor.execute(
+                f"""
+                DELETE FROM {self.temporary_database}..{self.index_table}
+                WHERE cache_key = {quote(key)}
+                """
+            )
+
+
+def is_fusable_event_column(query_type, query_args):
+    """
+    Whether a column can be computed along with others in a single scan of the
+    CodedEvent table (see `TPPBackend.get_fused_event_queries`), which only
+    supports CTV3 codelists
+    """
+    return (
+        query_type == "with_these_clinical_events"
+        and query_args["codelist"].system == "ctv3"
+        and query_args["returning"]
+        in ("binary_flag", "date", "number_of_matches_in_period")
+        and not query_args.get("ignore_days_where_these_codes_occur")
+    )
+
+
+def get_fusable_event_columns(definitions, population_columns):
+    """
+    Group together the columns in `definitions` which can be computed in a
+    single scan of the CodedEvent table, returning a list of groups each
+    containing at least two column names
+
+    Columns on which the population depends are never grouped with those which
+    don't, as the former need to be computed before the latter can be
+    restricted to the population (see `TPPBackend.get_queries`).
+    """
+    groups = {True: [], False: []}
+    for name, (query_type, query_args) in definitions:
+        if is_fusable_event_column(query_type, query_args):
+            groups[name in population_columns].append(name)
+    return [group for group in groups.values() if len(group) > 1]
+
+
+def get_column_dependencies(covariate_definitions, name):
+    """
+    Return the set of column names which must be computed in order to compute
+    column `name`, including `name` itself
+    """
+    dependencies = set()
+    to_visit = [name]
+    while to_visit:
+        column = to_visit.pop()
+        if column in dependencies:
+            continue
+        dependencies.add(column)
+        query_type, query_args = covariate_definitions[column]
+        if query_type == "categorised_as":
+            for expression in query_args["category_definitions"].values():
+                if expression != "DEFAULT":
+                    to_visit.extend(get_column_references(expression))
+        elif query_type == "aggregate_of":
+            to_visit.extend(query_args["column_names"])
+        elif query_type == "value_from":
+            to_visit.append(query_args["source"])
+    return dependencies
+
+
+def has_one_row_per_patient(sql):
+    """
+    Return whether the outermost SELECT of `sql` either groups by patient_id
+    or keeps only the first row for each patient (`WHERE rownum = 1`), and so
+    can't return more than one row per patient
+
+    Anything else is assumed to be capable of returning several.
+    """
+    # Strip quoted values and then parenthesised subqueries (innermost first)
+    # so that we only match clauses which belong to the outermost SELECT
+    sql = re.sub(r"'[^']*'", "''", sql)
+    while True:
+        stripped = re.sub(r"\([^()]*\)", "", sql)
+        if stripped == sql:
+            break
+        sql = stripped
+    return bool(
+        re.search(
+            r"\bGROUP BY\s+(\w+\.)?patient_id\s*(\bHAVING\b.*)?$",
+            sql,
+            flags=re.IGNORECASE | re.DOTALL,
+        )
+        or re.search(r"\bWHERE\s+(\w+\.)?rownum\s*=\s*1\s*$", sql, flags=re.IGNORECASE)
+    )
+
+
+def get_temp_table_dependencies(queries):
+    """
+    Given a list of queries which are valid when run in order, return a list
+    containing, for each query, the set of indices of the earlier queries which
+    must complete before it can start
+
+    A query depends on the most recent earlier query to touch each of the
+    temporary tables it references, so all access to a given table happens in
+    the original order, while queries with no tables in common are independent
+    """
+    last_query_to_touch = {}
+    dependencies = []
+    for n, query in enumerate(queries):
+        tables = set(TEMP_TABLE_RE.findall(query))
+        dependencies.append(
+            {
+                last_query_to_touch[table]
+                for table in tables
+                if table in last_query_to_touch
+            }
+        )
+        for table in tables:
+            last_query_to_touch[table] = n
+    return dependencies
+
+
+def get_query_label(query):
+    """
+    Return a short description of a query, taken from its leading comment if it
+    has one
+    """
+    comment_match = re.match(r"^\s*\-\-\s*(.+)\n", query)
+    if comment_match:
+        return comment_match.group(1)
+    return query.strip().splitlines()[0]
+
+
+def summarise_showplan(plans, max_operators=3):
+    """
+    Given the XML plans returned by SET SHOWPLAN_XML for a query, return its
+    estimated cost and number of rows along with the `max_operators` most
+    expensive operators in its plan
+
+    The cost of each operator excludes the cost of its inputs, so a scan of a
+    large table shows up as expensive but the join which consumes it doesn't.
+    """
+    ns = {"p": SHOWPLAN_NAMESPACE}
+    relop_tag = f"{{{SHOWPLAN_NAMESPACE}}}RelOp"
+    object_tag = f"{{{SHOWPLAN_NAMESPACE}}}Object"
+    operators = []
+
+    def visit(element, operator):
+        for child in element:
+            if child.tag == relop_tag:
+                child_operator = {
+                    "operator": child.get("PhysicalOp"),
+                    "table": None,
+                    "estimated_rows": float(child.get("EstimateRows", 0)),
+                    "estimated_cost": float(child.get("EstimatedTotalSubtreeCost", 0)),
+                }
+                if operator is not None:
+                    operator["estimated_cost"] -= child_operator["estimated_cost"]
+                operators.append(child_operator)
+                visit(child, child_operator)
+            else:
+                if child.tag == object_tag and operator and not operator["table"]:
+                    operator["table"] = child.get("Table", "").strip("[]") or None
+                visit(child, operator)
+
+    estimated_cost = 0.0
+    estimated_rows = 0.0
+    for plan in plans:
+        root = ElementTree.fromstring(plan)
+        for statement in root.iterfind(".//p:StmtSimple", ns):
+            estimated_cost += float(statement.get("StatementSubTreeCost", 0))
+            estimated_rows = float(statement.get("StatementEstRows", 0))
+            visit(statement, None)
+    operators.sort(key=lambda operator: operator["estimated_cost"], reverse=True)
+    for operator in operators:
+        operator["estimated_cost"] = round(operator["estimated_cost"], 4)
+    return {
+        "estimated_rows": estimated_rows,
+        "estimated_cost": round(estimated_cost, 4),
+        "operators": operators[:max_operators],
+    }
+
+
+def get_temp_table_sources(queries):
+    """
+    Given a list of queries which are valid when run in order, return a list
+    containing, for each query, the set of indices of the earlier queries which
+    create or write to the temporary tables it references
+
+    Unlike `get_temp_table_dependencies` this ignores queries which merely
+    read from the same tables, so it captures what each query's results
+    depend on rather than the order in which the queries must run
+    """
+    writers = {}
+    sources = []
+    for n, query in enumerate(queries):
+        sources.append(
+            {
+                writer
+                for table in set(TEMP_TABLE_RE.findall(query))
+                for writer in writers.get(table, [])
+            }
+        )
+        for table in set(TEMP_TABLE_WRITE_RE.findall(query)):
+            writers.setdefault(table, []).append(n)
+    return sources
+
+
+def get_transitive_sources(sources, n):
+    """
+    Return the indices of all the queries which query `n` depends on, directly
+    or indirectly (see `get_temp_table_sources`)
+    """
+    found = set()
+    to_visit = list(sources[n])
+    while to_visit:
+        i = to_visit.pop()
+        if i not in found:
+            found.add(i)
+            to_visit.extend(sources[i])
+    return found
+
+
+def drop_unused_queries(queries):
+    """
+    Drop any queries which only build temporary tables (e.g. codelists) that
+    aren't used, directly or indirectly, to build a column table
+
+    Queries which don't write to any temporary table, or which write to a
+    column table, are always kept.
+    """
+    column_tables = {
+        f"#{match.group(1)}"
+        for match in map(COLUMN_TABLE_QUERY_RE.match, queries)
+        if match
+    }
+    sources = get_temp_table_sources(queries)
+    needed = set()
+    for n, query in enumerate(queries):
+        tables_written = set(TEMP_TABLE_WRITE_RE.findall(query))
+        if not tables_written or tables_written & column_tables:
+            needed.add(n)
+            needed.update(get_transitive_sources(sources, n))
+    return [query for n, query in enumerate(queries) if n in needed]
 
 
 def pop_keys_from_dict(dictionary, keys):
@@ -0,0 +1,118 @@
+import array
+import operator
+
+import numpy as np
+
+
+class UniqueCheck:
+    """
+    Counts the patient IDs passed to `add()` and checks that none is repeated
+
+    If the IDs arrive in increasing order (as they do when paging through
+    results by `patient_id`) then pass `ordered=True`: we only need to compare
+    each ID with the one before, so memory use is constant. Otherwise integer
+    IDs are stored in a compact array, using 8 bytes each rather than the 60
+    or so needed by a set of Python ints, and checked by sorting them at the
+    end. Any IDs which aren't integers are kept in a set. Either way, IDs are
+    duplicates if and only if they would be in a set, so e.g. `"1"` and `1`
+    are different IDs.
+    """
+
+    def __init__(self, ordered=False):
+        self.ordered = ordered
+        self.count = 0
+        self.duplicates = 0
+        self.last_id = None
+        self.ids = array.array("q")
+        self.other_ids = set()
+
+    def add(self, item):
+        self.count += 1
+        if self.ordered:
+            self.add_in_order(item)
+            return
+        # Only genuine integers are stored in the array (as they are by
+        # `add_batch`), anything else which `int()` would accept might not
+        # compare equal to the integer it converts to
+        try:
+            self.ids.append(operator.index(item))
+        except (TypeError, OverflowError):
+            self.other_ids.add(item)
+
+    def add_batch(self, items):
+        """
+        Equivalent to calling `add()` on each of `items` but, for integer IDs,
+        without any per-item Python overhead
+        """
+        try:
+            ids = array.array("q", items)
+        except (TypeError, ValueError, OverflowError):
+            for item in items:
+                self.add(item)
+            return
+        if not ids:
+            return
+        self.count += len(ids)
+        if not self.ordered:
+            self.ids.extend(ids)
+            return
+        ids = np.frombuffer(ids, dtype=np.int64)
+        if self.last_id is not None:
+            ids = np.concatenate([[self.last_id], ids])
+        steps = np.diff(ids)
+        if (steps < 0).any():
+            n = int(np.argmax(steps < 0))
+            raise RuntimeError(
+                f"Patient IDs out of order ({ids[n + 1]} after {ids[n]})"
+            )
+        self.duplicates += int(np.count_nonzero(steps == 0))
+        self.last_id = int(ids[-1])
+
+    def add_in_order(self, item):
+        if self.last_id is not None:
+            if item == self.last_id:
+                self.duplicates += 1
+            elif item < self.last_id:
+                raise RuntimeError(
+                    f"Patient IDs out of order ({item} after {self.last_id})"
+                )
+        self.last_id = item
+
+    def assert_unique_ids(self):
+        if self.ordered:
+            duplicates = self.duplicates
+        else:
+            # Duplicates amongst the IDs which aren't integers
+            duplicates = self.count - len(self.ids) - len(self.other_ids)
+            if self.ids:
+                # Sort a copy, as sorting a view of the array in place would
+                # leave its buffer exported and so stop it growing again
+                ids = np.sort(np.frombuffer(self.ids, dtype=np.int64))
+                duplicates += int(np.count_nonzero(ids[1:] == ids[:-1]))
+                duplicates += count_integer_values_in(self.other_ids, ids)
+        assert_no_duplicates(duplicates)
+
+
+def count_integer_values_in(items, sorted_ids):
+    """
+    Count the `items` which aren't integers but which are equal to one of the
+    integers in `sorted_ids` (e.g. `1.0`), as they would be duplicates in a set
+    """
+    values = []
+    for item in items:
+        try:
+            value = int(item)
+        except (TypeError, ValueError, OverflowError):
+            continue
+        if value == item and -(2 ** 63) <= value < 2 ** 63:
+            values.append(value)
+    if not values:
+        return 0
+    values = np.array(values, dtype=np.int64)
+    positions = np.searchsorted(sorted_ids, values).clip(max=len(sorted_ids) - 1)
+    return int(np.count_nonzero(sorted_ids[positions] == values))
+
+
+def assert_no_duplicates(duplicates):
+    if duplicates != 0:
+        raise RuntimeError(f"Duplicate IDs found ({duplicates} rows)")
@@ -24,6 +24,12 @@ setup(
         "sqlparse",
         "tinynetrc",
     ],
+    extras_require={
+        # Needed for writing and reading Parquet and Feather output files
+        "arrow": ["pyarrow"],
+        # Needed for writing and reading zstd compressed CSV files
+        "zstd": ["zstandard"],
+    },
     entry_points={
         "console_scripts": ["cohortextractor=cohortextractor.cohortextractor:main"]
     },
@@ -20,7 +20,8 @@ from cohortextractor import (
     patients,
     codelist,
 )
-from cohortextractor.emis_backend import quote
+from cohortextractor import emis_backend
+from cohortextractor.emis_backend import get_codelist_cache, quote
 from cohortextractor.presto_utils import presto_connection_params_from_url
 
 
@@ -57,12 +58,17 @@ def delete_temporary_tables():
     """Delete all temporary tables."""
     session = make_session()
     with session.bind.connect() as conn:
-        sql = r"SELECT NAME FROM sys.tables WHERE NAME LIKE '\_%' ESCAPE '\'"
-        tables = [row[0] for row in conn.execute(sql)]
-        for table in tables:
+        for table in list_temporary_tables():
             conn.execute(f"DROP TABLE {table}")
 
 
+def list_temporary_tables():
+    session = make_session()
+    with session.bind.connect() as conn:
+        sql = r"SELECT NAME FROM sys.tables WHERE NAME LIKE '\_%' ESCAPE '\'"
+        return [row[0] for row in conn.execute(sql)]
+
+
 def test_minimal_study_to_csv():
     session = make_session()
     patient_1 = Patient(date_of_birth="1900-01-01", gender=1, hashed_organisation="abc")
@@ -87,6 +93,180 @@ def test_minimal_study_to_csv():
         ]
 
 
+def test_parallel_query_execution(monkeypatch):
+    monkeypatch.setenv("MAX_PARALLEL_QUERIES", "4")
+    session = make_session()
+    patient_with_med = Patient(date_of_birth="1950-06-01", gender=1)
+    patient_with_med.medications = [Medication(snomed_concept_id=0)]
+    patient_without_med = Patient(date_of_birth="1980-06-01", gender=2)
+    session.add_all([patient_with_med, patient_without_med])
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+        asthma_meds=patients.with_these_medications(codelist([0], "snomed")),
+        other_meds=patients.with_these_medications(codelist([1], "snomed")),
+    )
+    results = study.to_dicts()
+    assert [x["sex"] for x in results] == ["M", "F"]
+    assert [x["age"] for x in results] == ["69", "39"]
+    assert [x["asthma_meds"] for x in results] == ["1", "0"]
+    assert [x["other_meds"] for x in results] == ["0", "0"]
+
+
+def test_parallel_query_errors_propagate(monkeypatch):
+    monkeypatch.setenv("MAX_PARALLEL_QUERIES", "4")
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+    )
+    # Replace one of the column queries with something which will fail
+    name, sql = study.backend.queries[1]
+    study.backend.queries[1] = (name, "SELECT Foo FROM Bar")
+    with pytest.raises(Exception):
+        study.to_dicts()
+
+
+def test_tables_are_reused_after_failure_and_dropped_after_success(tmp_path):
+    session = make_session()
+    patient = Patient(date_of_birth="1900-01-01", gender=1)
+    session.add(patient)
+    session.commit()
+
+    def make_study():
+        return StudyDefinition(
+            population=patients.all(),
+            sex=patients.sex(),
+            asthma_meds=patients.with_these_medications(codelist([0], "snomed")),
+        )
+
+    study = make_study()
+    # Make the final query fail, after all the column tables are built
+    name, sql = study.backend.queries[-1]
+    study.backend.queries[-1] = (name, "SELECT Foo FROM Bar")
+    with pytest.raises(Exception):
+        study.to_csv(tmp_path / "output.csv")
+    tables = list_temporary_tables()
+
+    # The same study gets the same table names so it picks up where the
+    # failed run left off
+    study = make_study()
+    expected_tables = list(study.backend._codelist_table_names.values()) + [
+        study.backend.make_temp_table_name(name)
+        for name, _ in study.backend.queries[:-1]
+    ]
+    assert sorted(tables) == sorted(expected_tables)
+    study.to_csv(tmp_path / "output.csv")
+    with open(tmp_path / "output.csv") as f:
+        results = list(csv.DictReader(f))
+    assert [x["sex"] for x in results] == ["M"]
+    # Only the codelist table is kept, for reuse
+    assert list_temporary_tables() == list(study.backend._codelist_table_names.values())
+
+
+def test_tables_claimed_by_another_run_are_not_reused_or_dropped(tmp_path):
+    session = make_session()
+    patient = Patient(date_of_birth="1900-01-01", gender=1)
+    session.add(patient)
+    session.commit()
+
+    def make_study():
+        return StudyDefinition(population=patients.all(), sex=patients.sex())
+
+    # Simulate a run of the same study which is still going
+    other_run = make_study().backend
+    other_run.claim_tables()
+    other_claim_table = other_run.get_claim_table_name()
+
+    study = make_study()
+    study.to_csv(tmp_path / "output.csv")
+    with open(tmp_path / "output.csv") as f:
+        results = list(csv.DictReader(f))
+    assert [x["sex"] for x in results] == ["M"]
+    # We used tables of our own, and left the other run's claim alone
+    assert study.backend.temp_table_prefix.endswith(study.backend.run_id)
+    assert list_temporary_tables() == [other_claim_table]
+
+
+def test_stale_claims_are_taken_over(tmp_path, monkeypatch):
+    session = make_session()
+    patient = Patient(date_of_birth="1900-01-01", gender=1)
+    session.add(patient)
+    session.commit()
+
+    def make_study():
+        return StudyDefinition(population=patients.all(), sex=patients.sex())
+
+    # Simulate a run of the same study which was killed
+    make_study().backend.claim_tables()
+
+    monkeypatch.setenv("RUN_CLAIM_TIMEOUT_HOURS", "0")
+    study = make_study()
+    prefix = study.backend.temp_table_prefix
+    study.to_csv(tmp_path / "output.csv")
+    assert study.backend.temp_table_prefix == prefix
+    assert list_temporary_tables() == []
+
+
+@pytest.mark.parametrize("extension", ["csv", "csv.gz"])
+def test_parallel_download(tmp_path, monkeypatch, extension):
+    # Write the output table into the same schema as everything else
+    monkeypatch.setenv("TEMP_DATABASE_NAME", "dbo")
+    monkeypatch.setenv("MAX_PARALLEL_DOWNLOADS", "3")
+    session = make_session()
+    session.add_all([Patient(gender=1 + n % 2) for n in range(20)])
+    session.commit()
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    filename = tmp_path / f"output.{extension}"
+    study.to_csv(filename)
+    df = study.csv_to_df(filename)
+    assert sorted(df["patient_id"]) == sorted(
+        patient.registration_id for patient in session.query(Patient)
+    )
+    assert sorted(df["sex"]) == ["F"] * 10 + ["M"] * 10
+    assert not (tmp_path / f"output.{extension}.part0").exists()
+
+
+def test_codelist_tables_are_loaded_in_chunks_and_reused(monkeypatch):
+    monkeypatch.setattr(emis_backend, "CODELIST_CHUNK_SIZE", 2)
+    session = make_session()
+    patient_with_med = Patient()
+    patient_with_med.medications = [Medication(snomed_concept_id=2)]
+    patient_without_med = Patient()
+    session.add_all([patient_with_med, patient_without_med])
+    session.commit()
+
+    def make_study():
+        return StudyDefinition(
+            population=patients.all(),
+            asthma_meds=patients.with_these_medications(
+                codelist([0, 1, 2, 3, 4], "snomed")
+            ),
+        )
+
+    study = make_study()
+    results = study.to_dicts()
+    assert [x["asthma_meds"] for x in results] == ["1", "0"]
+    codelist_table = list(study.backend._codelist_table_names.values())[0]
+    assert list_temporary_tables() == [codelist_table]
+
+    study = make_study()
+    assert list(study.backend._codelist_table_names.values()) == [codelist_table]
+    results = study.to_dicts()
+    assert [x["asthma_meds"] for x in results] == ["1", "0"]
+
+    cache = get_codelist_cache(os.environ["DATABASE_URL"])
+    entries = cache.entries()
+    assert [entry["table_name"] for entry in entries] == [codelist_table]
+    assert entries[0]["row_count"] == 5
+    assert not entries[0]["expired"]
+    assert cache.evict() == []
+    assert len(cache.purge()) == 1
+    assert list_temporary_tables() == []
+
+
 def test_meds():
     session = make_session()
 
@@ -1247,6 +1427,46 @@ def test_duplicate_id_checking():
             study.to_csv(f.name)
 
 
+def test_identical_queries_are_only_run_once():
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                observations=[
+                    Observation(snomed_concept_id=123, effective_date="2018-01-01"),
+                    Observation(snomed_concept_id=123, effective_date="2019-02-01"),
+                ]
+            ),
+            Patient(),
+        ]
+    )
+    session.commit()
+    foo_codes = codelist([123], system="snomedct")
+    study = StudyDefinition(
+        population=patients.all(),
+        has_foo=patients.with_these_clinical_events(foo_codes),
+        foo_date=patients.with_these_clinical_events(
+            foo_codes, returning="date", date_format="YYYY-MM-DD"
+        ),
+        foo_category=patients.categorised_as(
+            {"yes": "has_foo_hidden", "no": "DEFAULT"},
+            has_foo_hidden=patients.with_these_clinical_events(
+                codelist([123], system="snomedct")
+            ),
+        ),
+        foo_count=patients.with_these_clinical_events(
+            foo_codes, returning="number_of_matches_in_period"
+        ),
+    )
+    assert len(study.backend.codelist_tables) == 1
+    assert len(study.backend.queries) == 4
+    results = study.to_dicts()
+    assert [x["has_foo"] for x in results] == ["1", "0"]
+    assert [x["foo_date"] for x in results] == ["2019-02-01", ""]
+    assert [x["foo_category"] for x in results] == ["yes", "no"]
+    assert [x["foo_count"] for x in results] == ["2", "0"]
+
+
 def test_column_name_clashes_produce_errors():
     with pytest.raises(ValueError):
         StudyDefinition(
@@ -7,7 +7,11 @@ from math import isclose
 from cohortextractor import StudyDefinition
 from cohortextractor import patients
 from cohortextractor import codelist
-from cohortextractor.expectation_generators import generate
+from cohortextractor.expectation_generators import (
+    generate,
+    generate_ages,
+    get_age_probabilities,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -345,6 +349,24 @@ def test_data_generator_age():
     assert result.int.min() < 5 and result.int.max() > 95
 
 
+def test_age_probabilities():
+    p = get_age_probabilities(110)
+    assert len(p) == 110
+    assert isclose(p.sum(), 1)
+    # Ages in the same five year band are equally likely
+    assert p[0] == p[4]
+    assert p[5] != p[4]
+    # The result is cached and so mustn't be modified
+    assert get_age_probabilities(110) is p
+    assert not p.flags.writeable
+
+
+def test_generate_ages():
+    ages = generate_ages(10000, max_age=50)
+    assert len(ages) == 10000
+    assert ages.min() == 0 and ages.max() == 49
+
+
 def test_make_df_from_expectations_with_categories():
     categorised_codelist = codelist([("1", "A"), ("2", "B")], system="ctv3")
     categorised_codelist.has_categories = True
@@ -0,0 +1,193 @@
+import csv
+import json
+import re
+import sys
+import types
+
+import pytest
+
+from cohortextractor.mssql_utils import (
+    BatchSizer,
+    mssql_bulk_insert,
+    mssql_table_to_csv,
+)
+from cohortextractor.output_formats import estimate_row_size
+
+
+def test_batch_sizer_without_target_is_fixed():
+    sizer = BatchSizer(1000)
+    sizer.record([(1, "a")] * 1000, 1000, 10.0)
+    assert sizer.size == 1000
+
+
+def test_batch_sizer_grows_and_shrinks_towards_target():
+    messages = []
+    sizer = BatchSizer(1000, target_seconds=2, log=messages.append)
+    # 10,000 rows/s would suggest 20,000 rows but we only double each time
+    sizer.record([(1, "a")] * 1000, 1000, 0.1)
+    assert sizer.size == 2000
+    # Close enough to the target to leave alone
+    sizer.record([(1, "a")] * 2000, 2000, 1.9)
+    assert sizer.size == 2000
+    # 500 rows/s
+    sizer.record([(1, "a")] * 2000, 2000, 4.0)
+    assert sizer.size == 1000
+    assert messages == [
+        "Changed batch size from 1000 to 2000 rows (10000 rows/s)",
+        "Changed batch size from 2000 to 1000 rows (500 rows/s)",
+    ]
+    sizer.log_summary()
+    assert messages[-1] == (
+        "Fetched 5000 rows in batches between 1000 and 2000 rows (833 rows/s)"
+    )
+
+
+def test_batch_sizer_ignores_final_short_batch():
+    sizer = BatchSizer(1000, target_seconds=2)
+    sizer.record([(1, "a")] * 10, 1000, 0.001)
+    assert sizer.size == 1000
+
+
+def test_batch_sizer_respects_memory_limit():
+    row = (1, "a" * 1000)
+    sizer = BatchSizer(1000, target_seconds=2, max_bytes=estimate_row_size(row) * 300)
+    sizer.record([row] * 1000, 1000, 2.0)
+    assert sizer.size == 300
+
+
+class FakeCursor:
+    """
+    Just enough of a cursor to page through `rows` with the queries that
+    `mssql_table_to_csv` makes, optionally failing on the nth query
+    """
+
+    description = [("patient_id",), ("value",)]
+
+    def __init__(self, rows, fail_on_query=None):
+        self.rows = sorted(rows)
+        self.fail_on_query = fail_on_query
+        self.queries = 0
+        self.executed = []
+
+    def execute(self, query):
+        self.queries += 1
+        self.executed.append(query)
+        if self.queries == self.fail_on_query:
+            raise RuntimeError("deliberate error")
+        match = re.search(r"TOP (\d+) .*?(?:patient_id > (\d+))?\s+ORDER BY", query)
+        limit, min_key = int(match.group(1)), int(match.group(2) or -1)
+        self.results = [row for row in self.rows if row[0] > min_key][:limit]
+
+    def fetchall(self):
+        return self.results
+
+
+def test_mssql_table_to_csv_pipelines_batches_in_order(tmp_path):
+    rows = [(i, f"v{i}") for i in range(1000)]
+    seen = []
+    filename = tmp_path / "test.csv"
+    mssql_table_to_csv(
+        filename,
+        FakeCursor(rows),
+        "table",
+        "patient_id",
+        batch_size=64,
+        batch_callback=seen.extend,
+    )
+    with open(filename) as f:
+        results = list(csv.reader(f))
+    assert results[0] == ["patient_id", "value"]
+    assert results[1:] == [[str(i), v] for (i, v) in rows]
+    assert seen == rows
+
+
+def test_mssql_table_to_csv_calls_batch_callback_once_per_batch(tmp_path):
+    rows = [(i, f"v{i}") for i in range(100)]
+    batch_lengths = []
+    mssql_table_to_csv(
+        tmp_path / "test.csv",
+        FakeCursor(rows),
+        "table",
+        "patient_id",
+        batch_size=40,
+        batch_callback=lambda batch: batch_lengths.append(len(batch)),
+    )
+    assert batch_lengths == [40, 40, 20]
+
+
+def test_mssql_table_to_csv_raises_errors_from_fetching_thread(tmp_path):
+    rows = [(i, f"v{i}") for i in range(1000)]
+    with pytest.raises(RuntimeError, match="deliberate error"):
+        mssql_table_to_csv(
+            tmp_path / "test.csv",
+            FakeCursor(rows, fail_on_query=5),
+            "table",
+            "patient_id",
+            batch_size=64,
+            retries=0,
+        )
+
+
+def test_mssql_table_to_csv_resumes_from_checkpoint(tmp_path):
+    rows = [(i, f"v{i}") for i in range(1000)]
+    filename = tmp_path / "test.csv"
+    checkpoint_filename = tmp_path / "test.csv.checkpoint"
+    download_args = dict(
+        table="table",
+        key_column="patient_id",
+        batch_size=100,
+        retries=0,
+        checkpoint_filename=checkpoint_filename,
+    )
+    # Fail after five batches have been written
+    with pytest.raises(RuntimeError, match="deliberate error"):
+        mssql_table_to_csv(
+            filename, cursor=FakeCursor(rows, fail_on_query=6), **download_args
+        )
+    with open(checkpoint_filename) as f:
+        checkpoint = json.load(f)
+    assert checkpoint["last_key"] == 499
+    assert checkpoint["length"] == filename.stat().st_size
+    # Simulate a row which was only partly written when the process died
+    with open(filename, "a") as f:
+        f.write("500,v5")
+    cursor = FakeCursor(rows)
+    seen = []
+    mssql_table_to_csv(
+        filename, cursor=cursor, batch_callback=seen.extend, **download_args
+    )
+    # We carry on from the key after the last one in the checkpoint
+    assert "patient_id > 499" in cursor.executed[0]
+    with open(filename) as f:
+        results = list(csv.reader(f))
+    assert results[0] == ["patient_id", "value"]
+    assert results[1:] == [[str(i), v] for (i, v) in rows]
+    # The rows from before the failure are read back from the file
+    assert [tuple(row) for row in seen] == rows
+
+
+def test_mssql_bulk_insert_encodes_strings_for_ctds(monkeypatch):
+    ctds = types.ModuleType("ctds")
+    ctds.SqlVarChar = lambda value: ("varchar", value)
+    monkeypatch.setitem(sys.modules, "ctds", ctds)
+
+    class Connection:
+        __module__ = "ctds.connection"
+
+        def bulk_insert(self, table, rows):
+            self.inserted = (table, rows)
+
+    class Cursor:
+        connection = Connection()
+
+    cursor = Cursor()
+    rows = [("abc", "Test \u2013 \u201cquoted\u201d \u20ac5"), ("def", "\u03b1")]
+    assert mssql_bulk_insert(cursor, "#codelist", ["code", "category"], rows)
+    assert cursor.connection.inserted == (
+        "#codelist",
+        [
+            (("varchar", b"abc"), ("varchar", b"Test \x96 \x93quoted\x94 \x805")),
+            # Characters outside code page 1252 can't be stored in the column
+            (("varchar", b"def"), ("varchar", b"?")),
+        ],
+    )
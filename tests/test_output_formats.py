@@ -0,0 +1,70 @@
+import datetime
+
+import pytest
+
+from cohortextractor.output_formats import (
+    ArrowWriter,
+    batches_to_arrow,
+    batches_to_dataframe,
+    read_dataframe,
+)
+
+HEADERS = ["patient_id", "sex", "age", "bmi", "died", "died_on"]
+
+COLUMN_TYPES = {
+    "patient_id": "int",
+    "sex": "str",
+    "age": "int",
+    "bmi": "float",
+    "died": "bool",
+    "died_on": "date",
+}
+
+BATCHES = [
+    [(1, "M", 60, 21.5, 1, "2020-03"), (2, "F", None, None, 0, None)],
+    [],
+    [(3, "I", 40, 30.0, 0, "")],
+]
+
+
+def test_batches_to_dataframe():
+    pandas_csv_args = {
+        "dtype": {"sex": "category", "age": "Int64", "died": "bool"},
+        "parse_dates": ["died_on"],
+    }
+    df = batches_to_dataframe(HEADERS, BATCHES, COLUMN_TYPES, pandas_csv_args)
+    assert list(df["patient_id"]) == [1, 2, 3]
+    assert list(df.index) == [0, 1, 2]
+    assert list(df["sex"].cat.categories) == ["F", "I", "M"]
+    assert list(df["sex"]) == ["M", "F", "I"]
+    assert df["age"].dtype == "Int64"
+    assert df["age"].isnull().tolist() == [False, True, False]
+    assert df["bmi"].isnull().tolist() == [False, True, False]
+    assert list(df["died"]) == [True, False, False]
+    assert str(df["died_on"][0].date()) == "2020-03-01"
+    assert df["died_on"].isnull().tolist() == [False, True, True]
+
+
+def test_batches_to_arrow():
+    pytest.importorskip("pyarrow")
+    table = batches_to_arrow(HEADERS, BATCHES, COLUMN_TYPES)
+    assert table["patient_id"].to_pylist() == [1, 2, 3]
+    assert table["sex"].to_pylist() == ["M", "F", "I"]
+    assert table["age"].to_pylist() == [60, None, 40]
+    assert table["died"].to_pylist() == [True, False, False]
+    assert table["died_on"].to_pylist() == [datetime.date(2020, 3, 1), None, None]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_arrow_writer_writerows_splits_into_row_groups(tmp_path, output_format):
+    pytest.importorskip("pyarrow")
+    filename = tmp_path / f"test.{output_format}"
+    rows = [(i, "M" if i % 2 else "F") for i in range(25)]
+    with ArrowWriter(
+        filename, output_format, {"patient_id": "int", "sex": "str"}, row_group_size=10
+    ) as writer:
+        writer.writerows([("patient_id", "sex")] + rows[:5])
+        writer.writerows(rows[5:])
+    df = read_dataframe(filename)
+    assert list(df["patient_id"]) == list(range(25))
+    assert list(df["sex"]) == [sex for (_, sex) in rows]
@@ -0,0 +1,72 @@
+import threading
+
+import pytest
+
+from cohortextractor.output_formats import estimate_row_size
+from cohortextractor.presto_utils import CursorProxy, Prefetcher
+
+
+class FakeCursor:
+    """
+    Just enough of a prestodb cursor to page through `rows`, optionally
+    failing after `fail_after` rows
+    """
+
+    description = [("patient_id",)]
+
+    def __init__(self, rows, fail_after=None):
+        self.rows = rows
+        self.fail_after = fail_after
+        self.position = 0
+
+    def execute(self, sql):
+        self.position = 0
+
+    def fetchmany(self, size=1):
+        if self.fail_after is not None and self.position >= self.fail_after:
+            raise RuntimeError("deliberate error")
+        batch = self.rows[self.position : self.position + size]
+        self.position += len(batch)
+        return batch
+
+
+def test_cursor_proxy_iterates_over_all_rows():
+    rows = [(i,) for i in range(1000)]
+    cursor = CursorProxy(FakeCursor(rows), batch_size=64)
+    cursor.execute("SELECT patient_id FROM patient")
+    assert list(cursor) == rows
+    assert cursor.get_fetch_summary().startswith("Fetched 1000 rows")
+
+
+def test_cursor_proxy_raises_errors_from_prefetching_thread():
+    rows = [(i,) for i in range(1000)]
+    cursor = CursorProxy(FakeCursor(rows, fail_after=500), batch_size=64)
+    cursor.execute("SELECT patient_id FROM patient")
+    results = []
+    with pytest.raises(RuntimeError, match="deliberate error"):
+        for row in cursor:
+            results.append(row)
+    assert results == rows[: len(results)]
+
+
+def test_prefetcher_limits_memory_used_by_buffered_batches():
+    batches = [[(i, "x" * 100)] * 10 for i in range(20)] + [[]]
+    fetched = []
+    fetched_fourth_batch = threading.Event()
+
+    def fetch():
+        fetched.append(None)
+        if len(fetched) == 4:
+            fetched_fourth_batch.set()
+        return batches[len(fetched) - 1]
+
+    batch_bytes = estimate_row_size(batches[0][0]) * 10
+    prefetcher = Prefetcher(fetch, max_buffered_bytes=batch_bytes * 3)
+    assert fetched_fourth_batch.wait(timeout=10)
+    # The fourth batch doesn't fit in the buffer, so until we take a batch
+    # out the background thread can only wait for room to put it in
+    with prefetcher.condition:
+        assert len(prefetcher.batches) == 3
+        assert len(fetched) == 4
+    assert list(prefetcher) == batches[:-1]
+    assert len(fetched) == len(batches)
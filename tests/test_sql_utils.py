@@ -0,0 +1,13 @@
+from cohortextractor.sql_utils import canonicalise_sql
+
+
+def test_canonicalise_sql():
+    query_1 = """
+        SELECT Patient_ID, 1 AS value
+        FROM Patient
+
+        WHERE Sex = 'F'
+        """
+    query_2 = "SELECT Patient_ID, 1 AS value\n  FROM Patient\nWHERE Sex = 'F'"
+    assert canonicalise_sql(query_1) == canonicalise_sql(query_2)
+    assert canonicalise_sql(query_1) != canonicalise_sql(query_2 + " AND 1=1")
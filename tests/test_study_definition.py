@@ -39,6 +39,63 @@ def test_create_dummy_data_works_without_database_url(tmp_path, monkeypatch):
     assert "age" in columns
 
 
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_create_dummy_data_in_columnar_format(tmp_path, monkeypatch, output_format):
+    pytest.importorskip("pyarrow")
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(
+        default_expectations={
+            "rate": "universal",
+            "date": {"earliest": "1900-01-01", "latest": "2020-01-01"},
+        },
+        population=patients.all(),
+        sex=patients.sex(
+            return_expectations={"category": {"ratios": {"M": 0.49, "F": 0.51}}}
+        ),
+        age=patients.age_as_of(
+            "2020-01-01",
+            return_expectations={"int": {"distribution": "population_ages"}},
+        ),
+        registered=patients.registered_as_of(
+            "2020-01-01", return_expectations={"incidence": 0.8}
+        ),
+    )
+    study.to_csv(tmp_path / "dummy_data.csv", expectations_population=10)
+    filename = tmp_path / f"dummy_data.{output_format}"
+    study.to_csv(filename, expectations_population=10)
+    df = study.csv_to_df(filename)
+    assert len(df) == 10
+    assert list(df.columns) == ["patient_id", "sex", "age", "registered"]
+    # We should get the same types as we would from the equivalent CSV
+    csv_df = study.csv_to_df(tmp_path / "dummy_data.csv")
+    assert df.dtypes.to_dict() == csv_df.dtypes.to_dict()
+    assert set(df["sex"].dropna()) <= {"M", "F"}
+
+
+@pytest.mark.parametrize("extension", ["csv.gz", "csv.zst"])
+def test_create_compressed_dummy_data(tmp_path, monkeypatch, extension):
+    if extension == "csv.zst":
+        pytest.importorskip("zstandard")
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(
+            return_expectations={
+                "rate": "universal",
+                "date": {"earliest": "1900-01-01", "latest": "today"},
+                "category": {"ratios": {"M": 0.49, "F": 0.51}},
+            }
+        ),
+    )
+    filename = tmp_path / f"dummy_data.{extension}"
+    study.to_csv(filename, expectations_population=10)
+    with open(filename, "rb") as f:
+        assert not f.read().startswith(b"patient_id")
+    df = study.csv_to_df(filename)
+    assert list(df.columns) == ["patient_id", "sex"]
+    assert len(df) == 10
+
+
 def test_export_data_without_database_url_raises_error(tmp_path, monkeypatch):
     monkeypatch.delenv("DATABASE_URL", raising=False)
     study = StudyDefinition(
@@ -138,3 +195,43 @@ def test_syntax_errors_in_expressions_are_raised():
                 age=patients.age_as_of("2010-01-01"),
             ),
         )
+
+
+class FakeBackend:
+    def __init__(self, headers, rows):
+        self.headers = headers
+        self.rows = rows
+
+    def get_result_batches(self, batch_size):
+        batches = (
+            self.rows[i : i + batch_size] for i in range(0, len(self.rows), batch_size)
+        )
+        return self.headers, batches
+
+
+def test_iter_batches(monkeypatch):
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    rows = [(i, "M" if i % 2 else "F") for i in range(10)]
+    study.backend = FakeBackend(["patient_id", "sex"], rows)
+    batches = list(study.iter_batches(batch_size=4))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+    assert batches[0][1].patient_id == 1
+    assert batches[0][1].sex == "M"
+    assert [row for batch in batches for row in batch] == rows
+
+
+def test_iter_batches_raises_error_on_duplicate_ids(monkeypatch):
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    study.backend = FakeBackend(["patient_id", "sex"], [(1, "M"), (2, "F"), (1, "M")])
+    with pytest.raises(RuntimeError, match=r"Duplicate IDs found \(1 rows\)"):
+        list(study.iter_batches(batch_size=2))
+
+
+def test_explain_raises_error_for_backend_without_explain(monkeypatch):
+    monkeypatch.delenv("DATABASE_URL", raising=False)
+    study = StudyDefinition(population=patients.all())
+    study.backend = FakeBackend(["patient_id"], [])
+    with pytest.raises(ValueError, match="not available for the FakeBackend backend"):
+        study.explain()
@@ -1,5 +1,6 @@
 import csv
 import glob
+import gzip
 from unittest.mock import patch
 import os
 import subprocess
@@ -38,7 +39,16 @@ from cohortextractor import (
     codelist,
 )
 from cohortextractor.mssql_utils import mssql_connection_params_from_url
-from cohortextractor.tpp_backend import quote, AppointmentStatus
+from cohortextractor.tpp_backend import (
+    quote,
+    AppointmentStatus,
+    drop_unused_queries,
+    get_column_dependencies,
+    get_fusable_event_columns,
+    get_temp_table_dependencies,
+    has_one_row_per_patient,
+    is_fusable_event_column,
+)
 
 
 @pytest.fixture(autouse=True)
@@ -98,6 +108,133 @@ def test_minimal_study_to_csv(tmp_path):
     ]
 
 
+@pytest.mark.parametrize("temporary_database", [True, False])
+def test_parallel_download(tmp_path, monkeypatch, temporary_database):
+    monkeypatch.setenv("MAX_PARALLEL_DOWNLOADS", "3")
+    if temporary_database:
+        monkeypatch.setenv("TEMP_DATABASE_NAME", os.environ["TPP_TEMP_DATABASE_NAME"])
+    session = make_session()
+    patients_list = [Patient(Sex="M" if i % 2 else "F") for i in range(20)]
+    session.add_all(patients_list)
+    session.commit()
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    study.to_csv(tmp_path / "test.csv")
+    with open(tmp_path / "test.csv") as f:
+        results = list(csv.DictReader(f))
+    assert results == [
+        {"patient_id": str(patient.Patient_ID), "sex": patient.Sex}
+        for patient in patients_list
+    ]
+
+
+@pytest.mark.parametrize("max_parallel_downloads", ["1", "3"])
+def test_compressed_output(tmp_path, monkeypatch, max_parallel_downloads):
+    monkeypatch.setenv("MAX_PARALLEL_DOWNLOADS", max_parallel_downloads)
+    session = make_session()
+    patients_list = [Patient(Sex="M" if i % 2 else "F") for i in range(20)]
+    session.add_all(patients_list)
+    session.commit()
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    study.to_csv(tmp_path / "test.csv.gz")
+    with gzip.open(tmp_path / "test.csv.gz", "rt", newline="") as f:
+        results = list(csv.DictReader(f))
+    assert results == [
+        {"patient_id": str(patient.Patient_ID), "sex": patient.Sex}
+        for patient in patients_list
+    ]
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "feather"])
+def test_columnar_output_formats(tmp_path, output_format):
+    pytest.importorskip("pyarrow")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                DateOfBirth="1960-01-01",
+                Sex="M",
+                ONSDeath=[ONSDeaths(dod="2020-03-04")],
+            ),
+            Patient(DateOfBirth="1980-01-01", Sex="F"),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+        died=patients.died_from_any_cause(),
+        died_on=patients.died_from_any_cause(
+            returning="date_of_death", date_format="YYYY-MM"
+        ),
+    )
+    filename = tmp_path / f"test.{output_format}"
+    study.to_csv(filename)
+    study.to_csv(tmp_path / "test.csv")
+    df = study.csv_to_df(filename)
+    assert list(df["sex"]) == ["M", "F"]
+    assert list(df["age"]) == [60, 40]
+    assert list(df["died"]) == [True, False]
+    assert str(df["died_on"][0].date()) == "2020-03-01"
+    assert df["died_on"].isnull()[1]
+    # We should get the same types as we would from the equivalent CSV
+    csv_df = study.csv_to_df(tmp_path / "test.csv")
+    assert df.dtypes.to_dict() == csv_df.dtypes.to_dict()
+
+
+def test_to_dataframe_and_to_arrow(tmp_path):
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                DateOfBirth="1960-01-01",
+                Sex="M",
+                ONSDeath=[ONSDeaths(dod="2020-03-04")],
+            ),
+            Patient(DateOfBirth="1980-01-01", Sex="F"),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+        died=patients.died_from_any_cause(),
+        died_on=patients.died_from_any_cause(
+            returning="date_of_death", date_format="YYYY-MM"
+        ),
+    )
+    # Use a tiny batch size to check that batches are joined up correctly
+    df = study.to_dataframe(batch_size=1)
+    assert list(df["sex"]) == ["M", "F"]
+    assert list(df["age"]) == [60, 40]
+    assert list(df["died"]) == [True, False]
+    assert str(df["died_on"][0].date()) == "2020-03-01"
+    assert df["died_on"].isnull()[1]
+    # We should get the same types as we would from the equivalent CSV
+    study.to_csv(tmp_path / "test.csv")
+    csv_df = study.csv_to_df(tmp_path / "test.csv")
+    assert df.dtypes.to_dict() == csv_df.dtypes.to_dict()
+
+    pytest.importorskip("pyarrow")
+    table = study.to_arrow(batch_size=1)
+    assert table.column_names == list(csv_df.columns)
+    assert table["sex"].to_pylist() == ["M", "F"]
+    assert table["age"].to_pylist() == [60, 40]
+    assert str(table["died_on"][0]) == "2020-03-01"
+
+
+def test_iter_batches():
+    session = make_session()
+    session.add_all([Patient(Sex="M"), Patient(Sex="F"), Patient(Sex="M")])
+    session.commit()
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    batches = list(study.iter_batches(batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    results = [row.sex for batch in batches for row in batch]
+    assert sorted(results) == ["F", "M", "M"]
+
+
 def test_sql_error_propagates(tmp_path):
     study = StudyDefinition(population=patients.all(), sex=patients.sex())
     # A bit hacky: fiddle with the list of queries to insert a deliberate error
@@ -2678,6 +2815,541 @@ def test_temporary_database_with_failure(tmp_path, monkeypatch):
     assert final_temporary_tables == initial_temporary_tables
 
 
+@pytest.mark.parametrize("temporary_database", [False, True])
+def test_parallel_query_execution(tmp_path, monkeypatch, temporary_database):
+    monkeypatch.setenv("MAX_PARALLEL_QUERIES", "4")
+    if temporary_database:
+        monkeypatch.setenv("TEMP_DATABASE_NAME", os.environ["TPP_TEMP_DATABASE_NAME"])
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                DateOfBirth="1960-01-01",
+                Sex="M",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01"),
+                    CodedEvent(CTV3Code="bar", ConsultationDate="2019-01-01"),
+                ],
+            ),
+            Patient(
+                DateOfBirth="1980-01-01",
+                Sex="F",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2017-01-01"),
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2020-01-01"),
+                ],
+            ),
+            Patient(DateOfBirth="1990-01-01", Sex="M"),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-06-01"),
+        foo_count=patients.with_these_clinical_events(
+            codelist(["foo"], system="ctv3"),
+            returning="number_of_matches_in_period",
+            ignore_days_where_these_codes_occur=codelist(["bar"], system="ctv3"),
+        ),
+        bar_date=patients.with_these_clinical_events(
+            codelist(["bar"], system="ctv3"),
+            returning="date",
+            date_format="YYYY-MM-DD",
+        ),
+        foo_date=patients.date_of("foo_count", date_format="YYYY"),
+        has_foo_or_bar=patients.satisfying("foo_count > 0 OR bar_date"),
+    )
+    assert study.backend.max_parallel_queries == 4
+    expected = dict(
+        sex=["M", "F", "M"],
+        age=["60", "40", "30"],
+        foo_count=["1", "2", "0"],
+        bar_date=["2019-01-01", "", ""],
+        foo_date=["2018", "2020", ""],
+        has_foo_or_bar=["1", "1", "0"],
+    )
+    assert_results(study.to_dicts(), **expected)
+    study.to_csv(tmp_path / "test.csv")
+    with open(tmp_path / "test.csv") as f:
+        assert_results(list(csv.DictReader(f)), **expected)
+    study.backend.close()
+
+
+def test_identical_queries_are_only_run_once():
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01"),
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2019-02-01"),
+                ]
+            ),
+            Patient(),
+        ]
+    )
+    session.commit()
+    foo_codes = codelist(["foo"], system="ctv3")
+    study = StudyDefinition(
+        population=patients.all(),
+        has_foo=patients.with_these_clinical_events(foo_codes),
+        foo_date=patients.with_these_clinical_events(
+            foo_codes, returning="date", date_format="YYYY-MM-DD"
+        ),
+        foo_category=patients.categorised_as(
+            {"yes": "has_foo_hidden", "no": "DEFAULT"},
+            has_foo_hidden=patients.with_these_clinical_events(
+                codelist(["foo"], system="ctv3")
+            ),
+        ),
+        foo_count=patients.with_these_clinical_events(
+            foo_codes, returning="number_of_matches_in_period"
+        ),
+    )
+    sql = study.to_sql()
+    assert sql.count("-- Uploading codelist") == 1
+    assert sql.count("-- Query for") == 3
+    assert_results(
+        study.to_dicts(),
+        has_foo=["1", "0"],
+        foo_date=["2019-02-01", ""],
+        foo_category=["yes", "no"],
+        foo_count=["2", "0"],
+    )
+
+
+def test_get_temp_table_dependencies():
+    queries = [
+        "CREATE TABLE #tmp1_foo_codelist (code VARCHAR(5))",
+        "INSERT INTO #tmp1_foo_codelist (code) VALUES ('abc')",
+        "CREATE TABLE #tmp2_bar_codelist (code VARCHAR(5))",
+        "SELECT * INTO #foo FROM CodedEvent JOIN #tmp1_foo_codelist ON 1=1",
+        "SELECT * INTO #bar FROM CodedEvent JOIN #tmp2_bar_codelist ON 1=1",
+        "SELECT 1 FROM Patient",
+        "SELECT * FROM #foo JOIN #bar ON #foo.patient_id = #bar.patient_id",
+    ]
+    assert get_temp_table_dependencies(queries) == [
+        set(),
+        {0},
+        set(),
+        {1},
+        {2},
+        set(),
+        {3, 4},
+    ]
+
+
+def test_restrict_to_population(monkeypatch):
+    monkeypatch.setenv("RESTRICT_TO_POPULATION", "1")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="F",
+                DateOfBirth="1980-01-01",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01"),
+                    CodedEvent(CTV3Code="bar", ConsultationDate="2019-01-01"),
+                ],
+            ),
+            Patient(
+                Sex="M",
+                DateOfBirth="1970-01-01",
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01"),
+                    CodedEvent(CTV3Code="bar", ConsultationDate="2019-01-01"),
+                ],
+            ),
+            Patient(Sex="F", DateOfBirth="1990-01-01"),
+        ]
+    )
+    session.commit()
+    foo_codes = codelist(["foo"], system="ctv3")
+    study = StudyDefinition(
+        population=patients.satisfying(
+            "has_foo AND sex = 'F'",
+            has_foo=patients.with_these_clinical_events(foo_codes),
+        ),
+        sex=patients.sex(),
+        age=patients.age_as_of("2020-01-01"),
+        foo_date=patients.with_these_clinical_events(
+            foo_codes, returning="date", date_format="YYYY-MM-DD"
+        ),
+        bar_count=patients.with_these_clinical_events(
+            codelist(["bar"], system="ctv3"),
+            returning="number_of_matches_in_period",
+            ignore_days_where_these_codes_occur=foo_codes,
+        ),
+    )
+    sql = study.to_sql()
+    assert "INTO #0_population_ids" in sql
+    # The population's own dependencies are built before the population table
+    # and so can't be restricted by it
+    population_index = sql.index("INTO #0_population_ids")
+    assert sql.index("-- Query for sex") < population_index
+    assert sql.index("-- Query for has_foo") < population_index
+    assert sql.index("-- Query for age") > population_index
+    assert_results(
+        study.to_dicts(),
+        sex=["F"],
+        age=["40"],
+        foo_date=["2018-01-01"],
+        bar_count=["1"],
+    )
+
+
+def test_restrict_to_population_with_column_named_after_population_table(
+    monkeypatch,
+):
+    monkeypatch.setenv("RESTRICT_TO_POPULATION", "1")
+    session = make_session()
+    session.add_all([Patient(Sex="F"), Patient(Sex="M")])
+    session.commit()
+    study = StudyDefinition(
+        population=patients.satisfying("sex = 'F'"),
+        sex=patients.sex(),
+        population_ids=patients.all(),
+    )
+    assert_results(study.to_dicts(), sex=["F"], population_ids=["1"])
+
+
+def test_column_tables_are_not_indexed_without_merge_join(monkeypatch):
+    monkeypatch.delenv("USE_MERGE_JOIN", raising=False)
+    study = StudyDefinition(population=patients.all(), sex=patients.sex())
+    assert "INDEX ix_patient_id" not in study.to_sql()
+
+
+def test_merge_join(monkeypatch):
+    monkeypatch.setenv("USE_MERGE_JOIN", "1")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="F",
+                CodedEvents=[CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01")],
+            ),
+            Patient(Sex="M"),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        has_foo=patients.with_these_clinical_events(codelist(["foo"], system="ctv3")),
+    )
+    sql = study.to_sql()
+    assert "CREATE CLUSTERED INDEX ix_patient_id ON #sex" in sql
+    assert "CREATE UNIQUE CLUSTERED INDEX ix_patient_id ON #has_foo" in sql
+    assert_results(study.to_dicts(), sex=["F", "M"], has_foo=["1", "0"])
+
+
+def test_column_tables_with_several_rows_per_patient_are_indexed(monkeypatch):
+    monkeypatch.setenv("USE_MERGE_JOIN", "1")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(Sex="F"),
+            # This patient belongs to two households but isn't in the
+            # population, so the duplicate rows shouldn't cause an error
+            Patient(
+                Sex="M",
+                HouseholdMemberships=[
+                    HouseholdMember(
+                        Household=Household(
+                            Household_ID=123,
+                            HouseholdSize=2,
+                            Prison=False,
+                            MixedSoftwareHousehold=False,
+                            TppPercentage=100,
+                            MSOA="S02001286",
+                        )
+                    ),
+                    HouseholdMember(
+                        Household=Household(
+                            Household_ID=456,
+                            HouseholdSize=3,
+                            Prison=False,
+                            MixedSoftwareHousehold=False,
+                            TppPercentage=100,
+                            MSOA="S02001354",
+                        )
+                    ),
+                ],
+            ),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        population=patients.satisfying("sex = 'F'"),
+        sex=patients.sex(),
+        household_size=patients.household_as_of(
+            "2020-02-01", returning="household_size"
+        ),
+    )
+    sql = study.to_sql()
+    assert "CREATE CLUSTERED INDEX ix_patient_id ON #household_size" in sql
+    assert_results(study.to_dicts(), sex=["F"], household_size=["0"])
+
+
+def test_has_one_row_per_patient():
+    assert has_one_row_per_patient(
+        """
+        SELECT Patient_ID AS patient_id, MAX(ConsultationDate) AS date
+        FROM CodedEvent
+        WHERE ConsultationDate >= '2020-01-01'
+        GROUP BY Patient_ID
+        HAVING COUNT(*) > 1
+        """
+    )
+    assert has_one_row_per_patient(
+        """
+        SELECT Patient_ID AS patient_id, NumericValue AS value
+        FROM (
+          SELECT Patient_ID, NumericValue, ROW_NUMBER() OVER (
+            PARTITION BY Patient_ID ORDER BY ConsultationDate DESC
+          ) AS rownum
+          FROM CodedEvent
+        ) t
+        WHERE t.rownum = 1
+        """
+    )
+    # Grouping or filtering by rownum within a subquery isn't enough
+    assert not has_one_row_per_patient(
+        """
+        SELECT days.Patient_ID AS patient_id, CodedEvent.NumericValue AS value
+        FROM (
+          SELECT Patient_ID, MAX(ConsultationDate) AS date
+          FROM CodedEvent
+          GROUP BY Patient_ID
+        ) AS days
+        LEFT JOIN CodedEvent ON CodedEvent.Patient_ID = days.Patient_ID
+        """
+    )
+    assert not has_one_row_per_patient(
+        """
+        SELECT DISTINCT Patient_ID AS patient_id, icd10u AS value
+        FROM ONS_Deaths
+        WHERE dod >= 'GROUP BY patient_id'
+        """
+    )
+
+
+@pytest.mark.parametrize("fuse_event_queries", [True, False])
+def test_fused_clinical_event_queries(monkeypatch, fuse_event_queries):
+    if fuse_event_queries:
+        monkeypatch.setenv("FUSE_EVENT_QUERIES", "1")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                CodedEvents=[
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01"),
+                    CodedEvent(CTV3Code="bar", ConsultationDate="2018-06-01"),
+                    CodedEvent(CTV3Code="foo", ConsultationDate="2019-02-01"),
+                ]
+            ),
+            Patient(
+                CodedEvents=[
+                    CodedEvent(CTV3Code="bar", ConsultationDate="2020-03-01"),
+                ]
+            ),
+            Patient(),
+        ]
+    )
+    session.commit()
+    foo_codes = codelist(["foo"], system="ctv3")
+    foo_bar_codes = codelist([("foo", "a"), ("bar", "b")], system="ctv3")
+    study = StudyDefinition(
+        population=patients.all(),
+        has_foo=patients.with_these_clinical_events(foo_codes),
+        foo_count=patients.with_these_clinical_events(
+            foo_codes,
+            on_or_before="2018-12-31",
+            returning="number_of_matches_in_period",
+        ),
+        first_foo_or_bar=patients.with_these_clinical_events(
+            foo_bar_codes,
+            returning="date",
+            find_first_match_in_period=True,
+            date_format="YYYY-MM-DD",
+        ),
+        has_foo_or_bar_in_2020=patients.with_these_clinical_events(
+            foo_bar_codes,
+            between=["2020-01-01", "2020-12-31"],
+            include_date_of_match=True,
+            date_format="YYYY-MM",
+        ),
+    )
+    sql = study.to_sql()
+    assert sql.count("FROM CodedEvent") == (1 if fuse_event_queries else 4)
+    assert_results(
+        study.to_dicts(),
+        has_foo=["1", "0", "0"],
+        foo_count=["1", "0", "0"],
+        first_foo_or_bar=["2018-01-01", "2020-03-01", ""],
+        has_foo_or_bar_in_2020=["0", "1", "0"],
+        has_foo_or_bar_in_2020_date=["", "2020-03", ""],
+    )
+
+
+def test_get_fusable_event_columns():
+    foo_codes = codelist(["foo"], system="ctv3")
+    study = StudyDefinition(
+        population=patients.satisfying(
+            "a AND b", a=patients.with_these_clinical_events(foo_codes)
+        ),
+        b=patients.with_these_clinical_events(foo_codes, returning="date"),
+        c=patients.with_these_clinical_events(
+            foo_codes, returning="number_of_matches_in_period"
+        ),
+        d=patients.with_these_clinical_events(foo_codes, returning="code"),
+        e=patients.with_these_clinical_events(
+            foo_codes, ignore_days_where_these_codes_occur=foo_codes
+        ),
+        f=patients.with_these_clinical_events(foo_codes, on_or_after="2020-01-01"),
+    )
+    definitions = study.covariate_definitions
+    population_columns = get_column_dependencies(definitions, "population")
+    assert get_fusable_event_columns(definitions.items(), population_columns) == [
+        ["b", "a"],
+        ["c", "f"],
+    ]
+    assert get_fusable_event_columns(definitions.items(), set(definitions)) == [
+        ["b", "c", "f", "a"]
+    ]
+
+
+def test_is_fusable_event_column_requires_ctv3_codelist():
+    query_args = {"returning": "binary_flag"}
+    ctv3_codes = codelist(["foo"], system="ctv3")
+    snomed_codes = codelist(["123"], system="snomed")
+    query_type = "with_these_clinical_events"
+    assert is_fusable_event_column(query_type, dict(query_args, codelist=ctv3_codes))
+    assert not is_fusable_event_column(
+        query_type, dict(query_args, codelist=snomed_codes)
+    )
+
+
+def test_get_column_dependencies():
+    covariate_definitions = {
+        "a": ("age_as_of", {}),
+        "b": ("registered_as_of", {}),
+        "c": ("with_these_clinical_events", {}),
+        "d": ("value_from", {"source": "c"}),
+        "e": ("aggregate_of", {"column_names": ["a", "d"]}),
+        "population": (
+            "categorised_as",
+            {"category_definitions": {1: "e > 10 AND b", 0: "DEFAULT"}},
+        ),
+    }
+    assert get_column_dependencies(covariate_definitions, "population") == {
+        "population",
+        "a",
+        "b",
+        "c",
+        "d",
+        "e",
+    }
+    assert get_column_dependencies(covariate_definitions, "e") == {"a", "c", "d", "e"}
+
+
+def test_column_cache(tmp_path, monkeypatch, capsys):
+    temporary_database = os.environ["TPP_TEMP_DATABASE_NAME"]
+    monkeypatch.setenv("TEMP_DATABASE_NAME", temporary_database)
+    monkeypatch.setenv("COLUMN_CACHE", "1")
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="M",
+                CodedEvents=[CodedEvent(CTV3Code="foo", ConsultationDate="2018-01-01")],
+            ),
+            Patient(Sex="F"),
+        ]
+    )
+    session.commit()
+
+    def make_study(codes):
+        return StudyDefinition(
+            population=patients.all(),
+            sex=patients.sex(),
+            has_code=patients.with_these_clinical_events(
+                codelist(codes, system="ctv3")
+            ),
+        )
+
+    study = make_study(["foo"])
+    study.backend.get_column_cache().purge()
+    study.to_csv(tmp_path / "first.csv")
+    assert "Using 0 of 3 columns from column cache" in capsys.readouterr().out
+    # Changing the codelist changes the key for `has_code` only
+    study = make_study(["bar"])
+    study.to_csv(tmp_path / "second.csv")
+    assert "Using 2 of 3 columns from column cache" in capsys.readouterr().out
+    with open(tmp_path / "second.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, sex=["M", "F"], has_code=["0", "0"])
+    study = make_study(["foo"])
+    study.to_csv(tmp_path / "third.csv")
+    assert "Using 3 of 3 columns from column cache" in capsys.readouterr().out
+    with open(tmp_path / "third.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, sex=["M", "F"], has_code=["1", "0"])
+    cache = study.backend.get_column_cache()
+    assert len(cache.entries()) == 4
+    assert len(cache.purge()) == 4
+    assert cache.entries() == []
+
+
+def test_explain():
+    study = StudyDefinition(
+        population=patients.all(),
+        sex=patients.sex(),
+        has_foo=patients.with_these_clinical_events(codelist(["foo"], system="ctv3")),
+    )
+    summaries = study.explain()
+    assert [summary["query"] for summary in summaries] == [
+        "Query for sex",
+        "Query for has_foo",
+        "Query for population",
+        "Join all columns for final output",
+    ]
+    has_foo = summaries[1]
+    assert has_foo["estimated_cost"] > 0
+    assert "CodedEvent" in [operator["table"] for operator in has_foo["operators"]]
+
+
+def test_explain_includes_every_statement_in_a_query():
+    study = StudyDefinition(population=patients.all())
+    study.backend.queries = [
+        """
+        -- Two statements
+        SELECT Patient_ID FROM Patient
+        SELECT Patient_ID FROM CodedEvent
+        """
+    ]
+    summaries = study.explain()
+    assert len(summaries) == 1
+    tables = [operator["table"] for operator in summaries[0]["operators"]]
+    assert "Patient" in tables
+    assert "CodedEvent" in tables
+
+
+def test_drop_unused_queries():
+    queries = [
+        "CREATE TABLE #tmp1_foo_codelist (code VARCHAR(5))",
+        "INSERT INTO #tmp1_foo_codelist (code) VALUES ('abc')",
+        "CREATE TABLE #tmp2_bar_codelist (code VARCHAR(5))",
+        "INSERT INTO #tmp2_bar_codelist (code) VALUES ('abc')",
+        "-- Query for foo (from column cache)\nSELECT * INTO #foo FROM db..cached",
+        "CREATE UNIQUE CLUSTERED INDEX ix_patient_id ON #foo (patient_id)",
+        "-- Query for bar\nSELECT * INTO #bar FROM (SELECT * FROM #tmp2_bar_codelist) t",
+        "SELECT * INTO db..saved FROM #bar",
+    ]
+    assert drop_unused_queries(queries) == queries[2:]
+
+
 def _list_table_in_db(session, database_name):
     conn = session.connection()
     results = conn.execute(
@@ -2689,9 +3361,16 @@ def _list_table_in_db(session, database_name):
     return sorted(row[0] for row in results)
 
 
-def test_large_codelists_upload_correctly():
-    # 999 is the limit we can upload in a single batch so we want to be well
-    # above that
+@pytest.mark.parametrize("bulk_insert_supported", [True, False])
+def test_large_codelists_upload_correctly(monkeypatch, bulk_insert_supported):
+    if not bulk_insert_supported:
+        # Simulate a driver which doesn't support bulk loading so we exercise
+        # the fallback path
+        monkeypatch.setattr(
+            "cohortextractor.tpp_backend.mssql_bulk_insert", lambda *args: False
+        )
+    # 999 is the limit we can upload in a single batch using INSERT statements
+    # so we want to be well above that
     codes = [f"foo{i}" for i in range(3000)]
     session = make_session()
     # Select codes from the beginning, middle and end of the codelist
@@ -2856,3 +3535,99 @@ def test_extracting_at_different_index_dates():
     study.set_index_date("2020-02-01")
     results = study.to_dicts()
     assert_results(results, value=["", "2020-02-10"])
+
+
+def test_extracting_at_several_index_dates_together(tmp_path):
+    session = make_session()
+    session.add_all(
+        [
+            Patient(
+                Sex="M",
+                CodedEvents=[CodedEvent(CTV3Code="foo", ConsultationDate="2020-01-14")],
+            ),
+            Patient(
+                Sex="F",
+                CodedEvents=[CodedEvent(CTV3Code="foo", ConsultationDate="2020-02-10")],
+            ),
+        ]
+    )
+    session.commit()
+    study = StudyDefinition(
+        index_date="2020-01-01",
+        population=patients.all(),
+        sex=patients.sex(),
+        value=patients.with_these_clinical_events(
+            codelist(["foo"], system="ctv3"),
+            returning="date",
+            date_format="YYYY-MM-DD",
+            between=["index_date", "index_date + 1 month"],
+        ),
+    )
+    study.to_csvs_for_index_dates(
+        {
+            "2020-01-01": tmp_path / "input_2020-01-01.csv",
+            "2020-02-01": tmp_path / "input_2020-02-01.csv",
+        }
+    )
+    with open(tmp_path / "input_2020-01-01.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, sex=["M", "F"], value=["2020-01-14", ""])
+    with open(tmp_path / "input_2020-02-01.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, sex=["M", "F"], value=["", "2020-02-10"])
+
+
+def test_temporary_database_resumes_interrupted_download(tmp_path, monkeypatch):
+    temporary_database = os.environ["TPP_TEMP_DATABASE_NAME"]
+    monkeypatch.setenv("TEMP_DATABASE_NAME", temporary_database)
+    session = make_session()
+    session.add_all(
+        [
+            Patient(DateOfBirth="1960-01-01", Sex="M"),
+            Patient(DateOfBirth="1980-01-01", Sex="F"),
+        ]
+    )
+    session.commit()
+    study_args = dict(
+        population=patients.all(),
+        sex=patients.sex(),
+        age=patients.age_as_of("2000-01-01"),
+    )
+    from cohortextractor import mssql_utils, tpp_backend
+
+    # Download a row at a time so that there's more than one batch to fetch
+    # (otherwise the download would be over before our error could trigger)
+    monkeypatch.setenv("DOWNLOAD_BATCH_SECONDS", "0")
+    table_to_csv = tpp_backend.mssql_table_to_csv
+
+    def table_to_csv_in_small_batches(*args, **kwargs):
+        kwargs["batch_size"] = 1
+        return table_to_csv(*args, **kwargs)
+
+    monkeypatch.setattr(
+        tpp_backend, "mssql_table_to_csv", table_to_csv_in_small_batches
+    )
+    fetch_batch = mssql_utils._fetch_batch_with_retries
+    calls = []
+
+    def fail_after_first_batch(*args, **kwargs):
+        calls.append(args)
+        if len(calls) > 1:
+            raise ValueError("deliberate error")
+        return fetch_batch(*args, **kwargs)
+
+    # Trigger an error after the first batch has been written
+    with patch.object(mssql_utils, "_fetch_batch_with_retries", fail_after_first_batch):
+        with pytest.raises(ValueError, match="deliberate error"):
+            StudyDefinition(**study_args).to_csv(tmp_path / "test.csv")
+    checkpoints = glob.glob(str(tmp_path / "test.partial.*.csv.checkpoint"))
+    assert len(checkpoints) == 1
+    # Delete all patient data so we can be sure the rows below come from the
+    # partial file and the existing results table
+    session.query(Patient).delete()
+    session.commit()
+    StudyDefinition(**study_args).to_csv(tmp_path / "test.csv")
+    with open(tmp_path / "test.csv") as f:
+        results = list(csv.DictReader(f))
+    assert_results(results, sex=["M", "F"], age=["40", "20"])
+    assert os.listdir(tmp_path) == ["test.csv"]
@@ -0,0 +1,86 @@
+import pytest
+
+from cohortextractor.unique_check import UniqueCheck
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_unique_check_passes_unique_ids(ordered):
+    unique_check = UniqueCheck(ordered=ordered)
+    for patient_id in range(1000):
+        unique_check.add(patient_id)
+    unique_check.assert_unique_ids()
+    assert unique_check.count == 1000
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_unique_check_counts_duplicates(ordered):
+    unique_check = UniqueCheck(ordered=ordered)
+    for patient_id in [1, 2, 2, 3, 3, 3, 4]:
+        unique_check.add(patient_id)
+    with pytest.raises(RuntimeError, match=r"Duplicate IDs found \(3 rows\)"):
+        unique_check.assert_unique_ids()
+
+
+def test_unique_check_handles_unordered_ids_of_any_type():
+    unique_check = UniqueCheck()
+    for patient_id in [3, "1", 1, "abc", 2 ** 70, "abc", 2, 1.5, 2.0, 2 ** 70]:
+        unique_check.add(patient_id)
+    # Only "abc", 2.0 and 2 ** 70 are repeated: IDs are compared as they
+    # would be in a set, so "1" and 1.5 are different from 1
+    with pytest.raises(RuntimeError, match=r"Duplicate IDs found \(3 rows\)"):
+        unique_check.assert_unique_ids()
+
+
+@pytest.mark.parametrize("patient_id", ["1", 1.5])
+def test_unique_check_only_treats_integers_as_integers(patient_id):
+    unique_check = UniqueCheck()
+    unique_check.add(1)
+    unique_check.add_batch([patient_id, 2])
+    unique_check.assert_unique_ids()
+
+
+def test_unique_check_can_add_ids_after_checking():
+    unique_check = UniqueCheck()
+    unique_check.add_batch([1, 2, 2])
+    try:
+        unique_check.assert_unique_ids()
+    except RuntimeError as e:
+        # The traceback keeps the checking function's locals alive
+        error = e
+    assert "Duplicate IDs" in str(error)
+    unique_check.add(3)
+    unique_check.add_batch([4, 5])
+    assert unique_check.count == 6
+
+
+def test_ordered_unique_check_rejects_ids_out_of_order():
+    unique_check = UniqueCheck(ordered=True)
+    unique_check.add(2)
+    with pytest.raises(RuntimeError, match="out of order"):
+        unique_check.add(1)
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_unique_check_add_batch(ordered):
+    unique_check = UniqueCheck(ordered=ordered)
+    unique_check.add_batch([1, 2, 2])
+    unique_check.add_batch([])
+    unique_check.add_batch([2, 3, 4])
+    assert unique_check.count == 6
+    with pytest.raises(RuntimeError, match=r"Duplicate IDs found \(2 rows\)"):
+        unique_check.assert_unique_ids()
+
+
+def test_unique_check_add_batch_handles_ids_of_any_type():
+    unique_check = UniqueCheck()
+    unique_check.add_batch([1, "abc", 2 ** 70])
+    unique_check.add_batch(["abc", 1])
+    with pytest.raises(RuntimeError, match=r"Duplicate IDs found \(2 rows\)"):
+        unique_check.assert_unique_ids()
+
+
+def test_ordered_unique_check_add_batch_rejects_ids_out_of_order():
+    unique_check = UniqueCheck(ordered=True)
+    unique_check.add_batch([1, 2, 3])
+    with pytest.raises(RuntimeError, match=r"out of order \(2 after 5\)"):
+        unique_check.add_batch([4, 5, 2])